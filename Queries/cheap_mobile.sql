@@ -1,4 +0,0 @@
-SELECT region
-FROM trips
-WHERE datasource = 'cheap_mobile'
-GROUP BY region;
@@ -0,0 +1,5 @@
+SELECT region
+FROM trip_rollups
+WHERE datasource = :datasource
+GROUP BY region
+ORDER BY region;
@@ -1,12 +1,12 @@
 SELECT DISTINCT ON (region)
     region,
     datasource
-FROM trips
+FROM trip_rollups
 WHERE region IN (SELECT
                     region
-                FROM trips
+                FROM trip_rollups
                 GROUP BY region
-                ORDER BY count(*) DESC
+                ORDER BY sum(trip_count) DESC
                 LIMIT 2
             )
-ORDER BY region, datetime DESC;
+ORDER BY region, latest_datetime DESC;
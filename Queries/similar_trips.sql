@@ -0,0 +1,40 @@
+WITH candidates AS (
+    (
+    SELECT id, datetime
+    FROM trips
+    WHERE datetime BETWEEN :start AND :end
+        AND ST_DWithin(origin_coord, ST_GeomFromText(:origin, 4326), :max_distance)
+        AND ST_DWithin(destination_coord, ST_GeomFromText(:destination, 4326), :max_distance)
+    ORDER BY origin_coord <-> ST_GeomFromText(:origin, 4326)
+    LIMIT :candidates
+    )
+    UNION
+    (
+    SELECT id, datetime
+    FROM trips
+    WHERE datetime BETWEEN :start AND :end
+        AND ST_DWithin(origin_coord, ST_GeomFromText(:origin, 4326), :max_distance)
+        AND ST_DWithin(destination_coord, ST_GeomFromText(:destination, 4326), :max_distance)
+    ORDER BY destination_coord <-> ST_GeomFromText(:destination, 4326)
+    LIMIT :candidates
+    )
+    ),
+distances AS (
+    SELECT trips.id, trips.region, ST_X(trips.origin_coord) AS "origin_x", ST_Y(trips.origin_coord) AS "origin_y",
+        ST_X(trips.destination_coord) AS "destination_x", ST_Y(trips.destination_coord) AS "destination_y",
+        to_char(trips.datetime, 'YYYY-MM-DD HH24:MI:SS') AS "datetime", trips.datasource,
+        ST_Distance(trips.origin_coord, ST_GeomFromText(:origin, 4326)) AS "origin_distance",
+        ST_Distance(trips.destination_coord, ST_GeomFromText(:destination, 4326)) AS "destination_distance",
+        CAST(abs(extract(epoch FROM trips.datetime - CAST(:datetime AS timestamp))) AS float8) AS "time_difference"
+    FROM candidates
+    JOIN trips ON trips.id = candidates.id AND trips.datetime = candidates.datetime
+    WHERE trips.datetime BETWEEN :start AND :end
+        AND trips.id <> :exclude_id
+    )
+SELECT id, region, origin_x, origin_y, destination_x, destination_y, datetime, datasource,
+    origin_distance, destination_distance, time_difference,
+    origin_distance / CAST(:max_distance AS float8) + destination_distance / CAST(:max_distance AS float8)
+        + time_difference / CAST(:max_seconds AS float8) AS "score"
+FROM distances
+ORDER BY score, id
+LIMIT :k;
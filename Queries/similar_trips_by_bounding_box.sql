@@ -1,31 +1,21 @@
-WITH clustered_trips AS (
+WITH filtered_trips AS (
     SELECT
-        *,
-        unnest(ST_ClusterWithin(origin_coord, 1.5)) AS "origin_cluster",
-        unnest(ST_ClusterWithin(destination_coord, 1.5)) AS "destination_cluster"
-    FROM trips 
-    GROUP BY id),
-filtered_trips AS (
-    SELECT
-        max(region) AS "region",
-        ST_Union(origin_coord) AS "origin_coord",
-        ST_Union(destination_coord) AS "destination_coord",
-        date_trunc('minute', datetime) AS "datetime",
-        count(*) AS "similar_trips"
-    FROM clustered_trips
-    WHERE ST_Contains(ST_MakeBox2D(ST_PointFromText('{bottom_left}', 4326), ST_PointFromText('{top_right}', 4326)), ST_MakeBox2D(origin_coord,origin_coord)) AND
-        ST_Contains(ST_MakeBox2D(ST_PointFromText('{bottom_left}', 4326), ST_PointFromText('{top_right}', 4326)), ST_MakeBox2D(destination_coord, destination_coord))
-    GROUP BY date_trunc('minute', datetime), origin_cluster, destination_cluster
+        similarity_group,
+        date_trunc('week', datetime) AS "week"
+    FROM trips
+    WHERE origin_coord && ST_MakeEnvelope(ST_X(ST_PointFromText(:bottom_left, 4326)), ST_Y(ST_PointFromText(:bottom_left, 4326)),
+                                          ST_X(ST_PointFromText(:top_right, 4326)), ST_Y(ST_PointFromText(:top_right, 4326)), 4326) AND
+        destination_coord && ST_MakeEnvelope(ST_X(ST_PointFromText(:bottom_left, 4326)), ST_Y(ST_PointFromText(:bottom_left, 4326)),
+                                             ST_X(ST_PointFromText(:top_right, 4326)), ST_Y(ST_PointFromText(:top_right, 4326)), 4326)
     ),
 weekly_trips AS (
     SELECT
-        '{bottom_left}' AS "bottom_left",
-        '{top_right}' AS "top_right",
-        date_trunc('week', datetime) AS "week",
-        count(*) AS "weekly_trips"
+        CAST(:bottom_left AS text) AS "bottom_left",
+        CAST(:top_right AS text) AS "top_right",
+        week,
+        count(DISTINCT similarity_group) AS "weekly_trips"
     FROM filtered_trips
-    GROUP BY date_trunc('week', datetime)
-    ORDER BY bottom_left, top_right, date_trunc('week', datetime)
+    GROUP BY week
     ),
 weekly_averages AS (
     SELECT
@@ -0,0 +1,9 @@
+WITH weekly_trips AS (
+    SELECT region AS "region", date_trunc('week', hour) AS "week", sum(similar_trips) AS "weekly_trips"
+    FROM trip_rollups
+    GROUP BY region, date_trunc('week', hour)
+    )
+SELECT region, avg(weekly_trips) AS "weekly_average"
+FROM weekly_trips
+GROUP BY region
+ORDER BY region;
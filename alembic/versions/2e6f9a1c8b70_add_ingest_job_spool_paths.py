@@ -0,0 +1,26 @@
+"""add ingest job spool paths
+
+Revision ID: 2e6f9a1c8b70
+Revises: 7d4b1e8a3c52
+Create Date: 2026-10-19 10:14:52.603418
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '2e6f9a1c8b70'
+down_revision = '7d4b1e8a3c52'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('ingest_jobs', sa.Column('spool_host', sa.String(), nullable=True))
+    op.add_column('ingest_jobs', sa.Column('spool_path', sa.String(), nullable=True))
+
+
+def downgrade():
+    op.drop_column('ingest_jobs', 'spool_path')
+    op.drop_column('ingest_jobs', 'spool_host')
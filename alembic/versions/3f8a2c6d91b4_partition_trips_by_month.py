@@ -0,0 +1,109 @@
+"""partition trips by month
+
+Revision ID: 3f8a2c6d91b4
+Revises: 9b1e4c7d2a36
+Create Date: 2026-10-18 19:12:40.281305
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '3f8a2c6d91b4'
+down_revision = '9b1e4c7d2a36'
+branch_labels = None
+depends_on = None
+
+#Months of partitions created past the current one, later ones are created by the API (see app/partitions.py).
+MONTHS_AHEAD = 3
+
+#Columns of the trips table, in their order.
+COLUMNS = "id, region, origin_coord, destination_coord, datetime, datasource, similarity_group"
+
+#Indexes of the trips table, created on the partitioned table so every partition gets them.
+INDEXES = (
+    ('idx_trips_origin_coord', 'USING gist (origin_coord)'),
+    ('idx_trips_destination_coord', 'USING gist (destination_coord)'),
+    ('idx_trips_region_datetime', '(region, datetime)'),
+    ('idx_trips_datasource', '(datasource)'),
+    ('idx_trips_datetime', '(datetime)'),
+)
+
+
+def upgrade():
+    #Keep the old table aside, its indexes and primary key free their names for the new one.
+    op.execute("ALTER TABLE trips RENAME TO trips_unpartitioned")
+    op.execute("ALTER TABLE trips_unpartitioned RENAME CONSTRAINT trips_pkey TO trips_unpartitioned_pkey")
+    for name, definition in INDEXES:
+        op.execute(f"ALTER INDEX {name} RENAME TO {name.replace('idx_trips', 'idx_trips_unpartitioned')}")
+
+    #The partition key has to be part of the primary key, the ids stay unique through the sequence.
+    op.execute("""
+        CREATE TABLE trips (
+            id integer NOT NULL DEFAULT nextval('trips_id_seq'),
+            region varchar NOT NULL,
+            origin_coord geometry(POINT, 4326) NOT NULL,
+            destination_coord geometry(POINT, 4326) NOT NULL,
+            datetime timestamp without time zone NOT NULL,
+            datasource varchar NOT NULL,
+            similarity_group varchar,
+            CONSTRAINT trips_pkey PRIMARY KEY (id, datetime)
+        ) PARTITION BY RANGE (datetime)
+    """)
+    op.execute("ALTER SEQUENCE trips_id_seq OWNED BY trips.id")
+    for name, definition in INDEXES:
+        op.execute(f"CREATE INDEX {name} ON trips {definition}")
+    #Catches trips outside every partition, the API moves them to their own partition.
+    op.execute("CREATE TABLE trips_default PARTITION OF trips DEFAULT")
+
+    #Every partition holds whole weeks, from the week of the 1st of its month to the week of the next 1st,
+    #so the weekly aggregations and any query over a single week touch a single partition.
+    op.execute(f"""
+        DO $$
+        DECLARE
+            month timestamp;
+        BEGIN
+            FOR month IN
+                SELECT generate_series(
+                    COALESCE((SELECT date_trunc('month', date_trunc('week', min(datetime)) + interval '6 days') FROM trips_unpartitioned),
+                             date_trunc('month', now()::timestamp)),
+                    GREATEST((SELECT date_trunc('month', date_trunc('week', max(datetime)) + interval '6 days') FROM trips_unpartitioned),
+                             date_trunc('month', now()::timestamp)) + interval '{MONTHS_AHEAD} months',
+                    interval '1 month')
+            LOOP
+                EXECUTE format('CREATE TABLE %I PARTITION OF trips FOR VALUES FROM (%L) TO (%L)',
+                               'trips_p' || to_char(month, 'YYYY_MM'),
+                               date_trunc('week', month),
+                               date_trunc('week', month + interval '1 month'));
+            END LOOP;
+        END $$
+    """)
+    op.execute(f"INSERT INTO trips ({COLUMNS}) SELECT {COLUMNS} FROM trips_unpartitioned")
+    op.execute("DROP TABLE trips_unpartitioned")
+    op.execute("ANALYZE trips")
+
+
+def downgrade():
+    op.execute("ALTER TABLE trips RENAME TO trips_partitioned")
+    op.execute("ALTER TABLE trips_partitioned RENAME CONSTRAINT trips_pkey TO trips_partitioned_pkey")
+    for name, definition in INDEXES:
+        op.execute(f"ALTER INDEX {name} RENAME TO {name.replace('idx_trips', 'idx_trips_partitioned')}")
+    op.execute("""
+        CREATE TABLE trips (
+            id integer NOT NULL DEFAULT nextval('trips_id_seq'),
+            region varchar NOT NULL,
+            origin_coord geometry(POINT, 4326) NOT NULL,
+            destination_coord geometry(POINT, 4326) NOT NULL,
+            datetime timestamp without time zone NOT NULL,
+            datasource varchar NOT NULL,
+            similarity_group varchar,
+            CONSTRAINT trips_pkey PRIMARY KEY (id)
+        )
+    """)
+    op.execute("ALTER SEQUENCE trips_id_seq OWNED BY trips.id")
+    op.execute(f"INSERT INTO trips ({COLUMNS}) SELECT {COLUMNS} FROM trips_partitioned")
+    #Dropping the partitioned table drops every partition along.
+    op.execute("DROP TABLE trips_partitioned")
+    for name, definition in INDEXES:
+        op.execute(f"CREATE INDEX {name} ON trips {definition}")
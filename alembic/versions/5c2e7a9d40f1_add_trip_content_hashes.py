@@ -0,0 +1,63 @@
+"""add trip content hashes
+
+Revision ID: 5c2e7a9d40f1
+Revises: 3f8a2c6d91b4
+Create Date: 2026-10-18 20:41:07.553912
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+
+# revision identifiers, used by Alembic.
+revision = '5c2e7a9d40f1'
+down_revision = '3f8a2c6d91b4'
+branch_labels = None
+depends_on = None
+
+#Same hash the API computes at ingest time, see app/dedupe.py.
+CONTENT_HASH_SQL = """
+    decode(md5(concat_ws(E'\\x1f', region,
+                         upper(encode(ST_AsEWKB(origin_coord, 'NDR'), 'hex')),
+                         upper(encode(ST_AsEWKB(destination_coord, 'NDR'), 'hex')),
+                         to_char(datetime, 'YYYY-MM-DD HH24:MI:SS'),
+                         datasource)), 'hex')
+"""
+
+
+def upgrade():
+    op.add_column('trips', sa.Column('content_hash', sa.LargeBinary(), nullable=True))
+    op.execute(f"UPDATE trips SET content_hash = {CONTENT_HASH_SQL}")
+    #Keep the first copy of the trips stored more than once.
+    op.execute("""
+        DELETE FROM trips USING (
+            SELECT id, datetime, row_number() OVER (PARTITION BY content_hash, datetime ORDER BY id) AS copy
+            FROM trips
+        ) copies
+        WHERE trips.id = copies.id AND trips.datetime = copies.datetime AND copies.copy > 1
+    """)
+    op.alter_column('trips', 'content_hash', nullable=False)
+    op.create_index('uq_trips_content_hash', 'trips', ['content_hash', 'datetime'], unique=True)
+    #The rollups may count removed copies, run python -m app.cli rebuild-rollups; cached responses are invalidated.
+    op.execute("UPDATE data_versions SET version = version + 1")
+
+    op.add_column('ingest_jobs', sa.Column('duplicates', sa.BigInteger(), nullable=False, server_default='0'))
+
+    op.create_table('idempotency_keys',
+    sa.Column('key', sa.String(), nullable=False),
+    sa.Column('endpoint', sa.String(), nullable=False),
+    sa.Column('status_code', sa.Integer(), nullable=True),
+    sa.Column('response', postgresql.JSONB(astext_type=sa.Text()), nullable=True),
+    sa.Column('created_at', sa.DateTime(), nullable=False),
+    sa.PrimaryKeyConstraint('key')
+    )
+    op.create_index('idx_idempotency_keys_created_at', 'idempotency_keys', ['created_at'], unique=False)
+
+
+def downgrade():
+    op.drop_index('idx_idempotency_keys_created_at', table_name='idempotency_keys')
+    op.drop_table('idempotency_keys')
+    op.drop_column('ingest_jobs', 'duplicates')
+    op.drop_index('uq_trips_content_hash', table_name='trips')
+    op.drop_column('trips', 'content_hash')
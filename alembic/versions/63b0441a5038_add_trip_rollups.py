@@ -0,0 +1,33 @@
+"""add trip rollups
+
+Revision ID: 63b0441a5038
+Revises: ee5ef12fa142
+Create Date: 2026-10-18 13:05:52.160447
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '63b0441a5038'
+down_revision = 'ee5ef12fa142'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Fill the rollups for the existing trips with: python -m app.cli rebuild-rollups
+    op.create_table('trip_rollups',
+    sa.Column('region', sa.String(), nullable=False),
+    sa.Column('datasource', sa.String(), nullable=False),
+    sa.Column('hour', sa.DateTime(), nullable=False),
+    sa.Column('trip_count', sa.BigInteger(), nullable=False),
+    sa.Column('similar_trips', sa.BigInteger(), nullable=False),
+    sa.Column('latest_datetime', sa.DateTime(), nullable=False),
+    sa.PrimaryKeyConstraint('region', 'datasource', 'hour')
+    )
+
+
+def downgrade():
+    op.drop_table('trip_rollups')
@@ -0,0 +1,28 @@
+"""add trip knn indexes
+
+Revision ID: 7d4b1e8a3c52
+Revises: 5c2e7a9d40f1
+Create Date: 2026-10-18 23:02:44.190337
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '7d4b1e8a3c52'
+down_revision = '5c2e7a9d40f1'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    #btree_gist lets the datetime share a GiST index with the coordinates, so the nearest trips of a time window come from a single index scan.
+    op.execute("CREATE EXTENSION IF NOT EXISTS btree_gist")
+    op.create_index('idx_trips_origin_coord_datetime', 'trips', ['origin_coord', 'datetime'], unique=False, postgresql_using='gist')
+    op.create_index('idx_trips_destination_coord_datetime', 'trips', ['destination_coord', 'datetime'], unique=False, postgresql_using='gist')
+
+
+def downgrade():
+    op.drop_index('idx_trips_destination_coord_datetime', table_name='trips', postgresql_using='gist')
+    op.drop_index('idx_trips_origin_coord_datetime', table_name='trips', postgresql_using='gist')
@@ -0,0 +1,29 @@
+"""add trip filter indexes
+
+Revision ID: c550aff072ed
+Revises: 44a0cc7e47f0
+Create Date: 2026-10-18 10:12:31.482913
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c550aff072ed'
+down_revision = '44a0cc7e47f0'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # The composite index also serves the region only filters through its leading column.
+    op.create_index('idx_trips_region_datetime', 'trips', ['region', 'datetime'], unique=False)
+    op.create_index('idx_trips_datasource', 'trips', ['datasource'], unique=False)
+    op.create_index('idx_trips_datetime', 'trips', ['datetime'], unique=False)
+
+
+def downgrade():
+    op.drop_index('idx_trips_datetime', table_name='trips')
+    op.drop_index('idx_trips_datasource', table_name='trips')
+    op.drop_index('idx_trips_region_datetime', table_name='trips')
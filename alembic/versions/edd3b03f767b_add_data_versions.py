@@ -0,0 +1,28 @@
+"""add data versions
+
+Revision ID: edd3b03f767b
+Revises: 63b0441a5038
+Create Date: 2026-10-18 14:21:36.604218
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'edd3b03f767b'
+down_revision = '63b0441a5038'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('data_versions',
+    sa.Column('scope', sa.String(), nullable=False),
+    sa.Column('version', sa.BigInteger(), nullable=False),
+    sa.PrimaryKeyConstraint('scope')
+    )
+
+
+def downgrade():
+    op.drop_table('data_versions')
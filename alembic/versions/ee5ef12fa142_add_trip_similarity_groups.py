@@ -0,0 +1,34 @@
+"""add trip similarity groups
+
+Revision ID: ee5ef12fa142
+Revises: c550aff072ed
+Create Date: 2026-10-18 11:40:07.915284
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'ee5ef12fa142'
+down_revision = 'c550aff072ed'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Existing trips are left without a group, fill them with: python -m app.cli backfill-similarity
+    op.add_column('trips', sa.Column('similarity_group', sa.String(), nullable=True))
+    op.create_table('similarity_groups',
+    sa.Column('similarity_group', sa.String(), nullable=False),
+    sa.Column('region', sa.String(), nullable=False),
+    sa.Column('datetime', sa.DateTime(), nullable=False),
+    sa.PrimaryKeyConstraint('similarity_group', 'region')
+    )
+    op.create_index('idx_similarity_groups_region_datetime', 'similarity_groups', ['region', 'datetime'], unique=False)
+
+
+def downgrade():
+    op.drop_index('idx_similarity_groups_region_datetime', table_name='similarity_groups')
+    op.drop_table('similarity_groups')
+    op.drop_column('trips', 'similarity_group')
@@ -0,0 +1,318 @@
+from datetime import datetime, timedelta
+import numpy as np
+from sqlalchemy import event, select
+from sqlalchemy.orm import Session
+from sqlalchemy.sql import func
+from .config import settings
+from .database import SessionLocal
+from . import models
+
+"""
+    This file defines the optional in-memory analytics store.
+    When ANALYTICS_ENABLED is set the trips are loaded at startup into NumPy columns, with the
+    region, datasource and similarity group dictionary encoded, and a uniform grid index over the
+    origins and destinations. The weekly averages and the trip filters are then answered with
+    vectorized scans instead of going to PostGIS. Ingest stages the trips it writes on its session
+    and they are added to the store once the transaction commits.
+    The store lives in each API process and only sees the trips ingested by that process after
+    startup, so it is meant for deployments where one process runs the ingest jobs and the queries.
+"""
+
+#Store used by the endpoints, None while disabled.
+store = None
+
+#Rows the columns grow by at least when appending.
+MIN_CAPACITY = 1024
+
+#Tail of rows left out of the grid index before it is rebuilt, as a fraction of the indexed rows.
+INDEX_TAIL_FRACTION = 0.125
+
+#Largest amount of grid columns looked up for a bounding box before a full scan is cheaper.
+MAX_INDEX_COLUMNS = 4096
+
+#Added to the grid rows before packing them in the low 32 bits of a key, so negative rows keep their order.
+ROW_OFFSET = 1 << 31
+
+# Returns the Monday starting the week of each datetime, like date_trunc('week', datetime).
+def week_starts(datetimes):
+    days = datetimes.astype('datetime64[D]').astype(np.int64)
+    #The epoch was a Thursday.
+    return days - (days + 3) % 7
+
+class Dictionary:
+    def __init__(self):
+        self.codes = {}
+        self.values = []
+
+    # Returns the code of every value, adding the new ones. None is encoded as -1.
+    def encode(self, values):
+        return np.fromiter((self.add(value) for value in values), dtype=np.int64, count=len(values))
+
+    def add(self, value):
+        if value is None:
+            return -1
+        code = self.codes.get(value)
+        if code is None:
+            code = self.codes[value] = len(self.values)
+            self.values.append(value)
+        return code
+
+    # Returns the code of a value, or None when it was never seen.
+    def get(self, value):
+        return self.codes.get(value)
+
+class GridIndex:
+    def __init__(self, cell_size):
+        self.cell_size = cell_size
+        self.order = np.empty(0, dtype=np.int64)
+        self.keys = np.empty(0, dtype=np.int64)
+        #Rows covered by the index, the following ones are scanned linearly.
+        self.size = 0
+
+    # Packs the cell of each point in a single key, sorting by column first and row second.
+    def cell_keys(self, x, y):
+        columns = np.floor(x / self.cell_size).astype(np.int64)
+        rows = np.floor(y / self.cell_size).astype(np.int64)
+        return (columns << 32) + (rows + ROW_OFFSET)
+
+    def rebuild(self, x, y):
+        keys = self.cell_keys(x, y)
+        self.order = np.argsort(keys, kind='stable')
+        self.keys = keys[self.order]
+        self.size = len(x)
+
+    # Returns the rows whose point may be inside the box, None when a full scan is cheaper.
+    def candidates(self, bbox, size):
+        min_x, min_y, max_x, max_y = bbox
+        first, last = int(np.floor(min_x / self.cell_size)), int(np.floor(max_x / self.cell_size))
+        if last - first >= MAX_INDEX_COLUMNS:
+            return None
+        low, high = int(np.floor(min_y / self.cell_size)), int(np.floor(max_y / self.cell_size))
+        columns = np.arange(first, last + 1, dtype=np.int64) << 32
+        starts = np.searchsorted(self.keys, columns + (low + ROW_OFFSET), side='left')
+        ends = np.searchsorted(self.keys, columns + (high + ROW_OFFSET), side='right')
+        ranges = [ self.order[start:end] for start, end in zip(starts.tolist(), ends.tolist()) if end > start ]
+        ranges.append(np.arange(self.size, size, dtype=np.int64))
+        return np.concatenate(ranges)
+
+class TripStore:
+    COLUMNS = ('id', 'origin_x', 'origin_y', 'destination_x', 'destination_y', 'datetime', 'region', 'datasource', 'group')
+
+    def __init__(self, cell_size=None, cutoff=None):
+        #Trips older than the cutoff are not kept, None keeps every trip.
+        self.cutoff = cutoff
+        self.size = 0
+        self.id = np.empty(0, dtype=np.int64)
+        self.origin_x = np.empty(0)
+        self.origin_y = np.empty(0)
+        self.destination_x = np.empty(0)
+        self.destination_y = np.empty(0)
+        self.datetime = np.empty(0, dtype='datetime64[s]')
+        self.region = np.empty(0, dtype=np.int32)
+        self.datasource = np.empty(0, dtype=np.int32)
+        self.group = np.empty(0, dtype=np.int64)
+        self.regions = Dictionary()
+        self.datasources = Dictionary()
+        self.groups = Dictionary()
+        cell_size = cell_size or settings.ANALYTICS_GRID_SIZE
+        self.origin_index = GridIndex(cell_size)
+        self.destination_index = GridIndex(cell_size)
+
+    def __len__(self):
+        return self.size
+
+    # Whether the store holds every trip needed to answer for datetimes from start on.
+    def covers(self, start=None):
+        return self.cutoff is None or (start is not None and np.datetime64(start, 's') >= self.cutoff)
+
+    # Appends trips given as columns, growing the arrays geometrically.
+    def append(self, id, origin, destination, datetimes, region, datasource, group):
+        datetimes = np.asarray(datetimes, dtype='datetime64[s]')
+        keep = np.ones(len(datetimes), dtype=bool) if self.cutoff is None else datetimes >= self.cutoff
+        if not keep.any():
+            return
+        origin = np.asarray(origin, dtype=float).reshape(-1, 2)[keep]
+        destination = np.asarray(destination, dtype=float).reshape(-1, 2)[keep]
+        values = {
+            'id' : np.asarray(id, dtype=np.int64)[keep],
+            'origin_x' : origin[:, 0],
+            'origin_y' : origin[:, 1],
+            'destination_x' : destination[:, 0],
+            'destination_y' : destination[:, 1],
+            'datetime' : datetimes[keep],
+            'region' : self.regions.encode(np.asarray(region, dtype=object)[keep].tolist()),
+            'datasource' : self.datasources.encode(np.asarray(datasource, dtype=object)[keep].tolist()),
+            'group' : self.groups.encode(np.asarray(group, dtype=object)[keep].tolist())
+            }
+        count = len(values['id'])
+        end = self.size + count
+        if end > len(self.id):
+            capacity = max(end, 2 * len(self.id), MIN_CAPACITY)
+            for name in self.COLUMNS:
+                column = getattr(self, name)
+                grown = np.empty(capacity, dtype=column.dtype)
+                grown[:self.size] = column[:self.size]
+                setattr(self, name, grown)
+        for name in self.COLUMNS:
+            getattr(self, name)[self.size:end] = values[name]
+        self.size = end
+
+    # Returns a column trimmed to the stored trips.
+    def column(self, name):
+        return getattr(self, name)[:self.size]
+
+    # Rebuilds the grid indexes when too many trips were appended since they were built.
+    def refresh_indexes(self):
+        for index, x, y in ((self.origin_index, 'origin_x', 'origin_y'), (self.destination_index, 'destination_x', 'destination_y')):
+            if self.size - index.size > max(MIN_CAPACITY, index.size * INDEX_TAIL_FRACTION):
+                index.rebuild(self.column(x), self.column(y))
+
+    # Returns the rows matching any combination of the trip filters, in ID order.
+    """
+        Uses the same semantics as filters.trip_filters: the datetime range is half-open and points
+        on the edges of a bounding box are inside it. The grid index narrows the candidate rows for
+        the origin box, or the destination one when only that one is given.
+    """
+    def search(self, region=None, datasource=None, start=None, end=None, origin_bbox=None, destination_bbox=None, after=None):
+        self.refresh_indexes()
+        rows = None
+        if origin_bbox is not None:
+            rows = self.origin_index.candidates(origin_bbox, self.size)
+        elif destination_bbox is not None:
+            rows = self.destination_index.candidates(destination_bbox, self.size)
+        if rows is None:
+            rows = np.arange(self.size, dtype=np.int64)
+        mask = np.ones(len(rows), dtype=bool)
+        for name, value, dictionary in (('region', region, self.regions), ('datasource', datasource, self.datasources)):
+            if value is not None:
+                code = dictionary.get(value)
+                if code is None:
+                    return rows[:0]
+                mask &= self.column(name)[rows] == code
+        if start is not None:
+            mask &= self.column('datetime')[rows] >= np.datetime64(start, 's')
+        if end is not None:
+            mask &= self.column('datetime')[rows] < np.datetime64(end, 's')
+        if after is not None:
+            mask &= self.column('id')[rows] > after
+        for bbox, x, y in ((origin_bbox, 'origin_x', 'origin_y'), (destination_bbox, 'destination_x', 'destination_y')):
+            if bbox is not None:
+                mask &= self.inside(rows, bbox, x, y)
+        rows = rows[mask]
+        return rows[np.argsort(self.column('id')[rows], kind='stable')]
+
+    # Whether the given points of each row are inside the box, edges included like &&.
+    def inside(self, rows, bbox, x, y):
+        min_x, min_y, max_x, max_y = bbox
+        x = self.column(x)[rows]
+        y = self.column(y)[rows]
+        return (x >= min_x) & (x <= max_x) & (y >= min_y) & (y <= max_y)
+
+    # Returns the listing rows of the given store rows, in the order of TRIP_RESPONSE_COLUMNS.
+    def trip_rows(self, rows):
+        regions = np.asarray(self.regions.values, dtype=object)
+        datasources = np.asarray(self.datasources.values, dtype=object)
+        datetimes = np.char.replace(np.datetime_as_string(self.column('datetime')[rows], unit='s'), 'T', ' ')
+        return zip(
+            self.column('id')[rows].tolist(),
+            regions[self.column('region')[rows]].tolist(),
+            self.column('origin_x')[rows].tolist(),
+            self.column('origin_y')[rows].tolist(),
+            self.column('destination_x')[rows].tolist(),
+            self.column('destination_y')[rows].tolist(),
+            datetimes.tolist(),
+            datasources[self.column('datasource')[rows]].tolist()
+            )
+
+    # Averages the amount of similarity groups per week over the given rows.
+    """
+        Like the SQL path, every week with trips counts even when none of them has a group yet.
+        Returns None when there are no rows.
+    """
+    def weekly_average(self, rows):
+        if not len(rows):
+            return None
+        weeks = week_starts(self.column('datetime')[rows])
+        groups = self.column('group')[rows]
+        grouped = groups >= 0
+        #A group only spans one minute, so it falls in the week of any of its trips.
+        unique_groups, first = np.unique(groups[grouped], return_index=True)
+        all_weeks = np.unique(weeks)
+        counts = np.bincount(np.searchsorted(all_weeks, weeks[grouped][first]), minlength=len(all_weeks))
+        return float(counts.mean())
+
+    # Returns the weekly average of similar trips for a region, None when it has no trips.
+    def weekly_average_by_region(self, region):
+        code = self.regions.get(region)
+        if code is None:
+            return None
+        return self.weekly_average(np.flatnonzero(self.column('region') == code))
+
+    # Returns the weekly average of similar trips starting and ending inside a box, None when there are none.
+    """
+        Points on the edges of the box are inside it, like the && of the SQL path.
+    """
+    def weekly_average_by_bbox(self, bbox):
+        self.refresh_indexes()
+        rows = self.origin_index.candidates(bbox, self.size)
+        if rows is None:
+            rows = np.arange(self.size, dtype=np.int64)
+        rows = rows[self.inside(rows, bbox, 'origin_x', 'origin_y') & self.inside(rows, bbox, 'destination_x', 'destination_y')]
+        return self.weekly_average(rows)
+
+    # Loads the stored trips from the DB in partitions.
+    async def load(self, db, batch_size=100000):
+        query = select(
+            models.Trip.id,
+            func.ST_X(models.Trip.origin_coord),
+            func.ST_Y(models.Trip.origin_coord),
+            func.ST_X(models.Trip.destination_coord),
+            func.ST_Y(models.Trip.destination_coord),
+            models.Trip.datetime,
+            models.Trip.region,
+            models.Trip.datasource,
+            models.Trip.similarity_group
+            )
+        if self.cutoff is not None:
+            query = query.where(models.Trip.datetime >= self.cutoff.item())
+        result = await db.stream(query.execution_options(yield_per=batch_size))
+        async for partition in result.partitions():
+            id, origin_x, origin_y, destination_x, destination_y, datetimes, region, datasource, group = zip(*partition)
+            self.append(id, np.column_stack([origin_x, origin_y]), np.column_stack([destination_x, destination_y]), datetimes, region, datasource, group)
+        self.refresh_indexes()
+
+# Creates the store and loads it from the DB, called at startup when ANALYTICS_ENABLED is set.
+async def start():
+    global store
+    cutoff = None
+    if settings.ANALYTICS_WINDOW_DAYS is not None:
+        cutoff = np.datetime64(datetime.utcnow() - timedelta(days=settings.ANALYTICS_WINDOW_DAYS), 's')
+    loaded = TripStore(cutoff=cutoff)
+    async with SessionLocal() as db:
+        await loaded.load(db)
+    store = loaded
+
+# Stages the trips written by a transaction, to be added to the store when it commits.
+"""
+    The IDs are given for the trips at the indexes of the parsed batch, in the same order.
+"""
+def stage(db, ids, parsed, keys, indexes):
+    if store is None or not len(indexes):
+        return
+    indexes = np.asarray(indexes, dtype=np.int64)
+    db.sync_session.info.setdefault('analytics', []).append((ids, parsed, [ keys[index] for index in indexes.tolist() ], indexes))
+
+#Savepoints also dispatch after_commit, only the outermost transaction adds the staged trips.
+@event.listens_for(Session, 'after_commit')
+def append_staged(session):
+    if session.in_nested_transaction():
+        return
+    for ids, parsed, groups, indexes in session.info.pop('analytics', []):
+        if store is not None:
+            store.append(ids, parsed.origin[indexes], parsed.destination[indexes], parsed.datetime[indexes], parsed.region[indexes], parsed.datasource[indexes], groups)
+
+#Whatever is left staged when the outermost transaction ends was rolled back.
+@event.listens_for(Session, 'after_transaction_end')
+def discard_staged(session, transaction):
+    if transaction.parent is None:
+        session.info.pop('analytics', None)
@@ -0,0 +1,227 @@
+import hashlib
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from contextlib import closing
+import orjson
+from fastapi import Response, status
+from fastapi.responses import StreamingResponse
+from starlette.concurrency import run_in_threadpool
+from .config import settings
+
+"""
+    This file defines the read-through cache of the API responses.
+    Entries are keyed by the route, its parameters and the data version of the scope the route
+    reads, so an ingest bumping the version makes every entry built before it unreachable without
+    purging anything, and the stale entries age out of the LRU. The backend holding the entries is
+    pluggable: the in-process one is the fastest, the SQLite one is shared by every uvicorn worker
+    on the node.
+"""
+
+class CacheEntry:
+    def __init__(self, body, media_type, etag, expires):
+        self.body = body
+        self.media_type = media_type
+        self.etag = etag
+        self.expires = expires
+
+    def __len__(self):
+        return len(self.body)
+
+#In-process LRU of the entries, bounded by the total size of their bodies.
+class MemoryBackend:
+    #Calls are cheap enough to run on the event loop.
+    blocking = False
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.size = 0
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            if entry.expires <= time.time():
+                self.remove(key)
+                return None
+            self.entries.move_to_end(key)
+            return entry
+
+    def set(self, key, entry):
+        with self.lock:
+            if key in self.entries:
+                self.remove(key)
+            self.entries[key] = entry
+            self.size += len(entry)
+            while self.size > self.max_bytes:
+                self.remove(next(iter(self.entries)))
+
+    # Helper function to drop an entry, called with the lock held.
+    def remove(self, key):
+        self.size -= len(self.entries.pop(key))
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+
+    def usage(self):
+        return len(self.entries), self.size
+
+#LRU of the entries in a local SQLite file, shared by the processes of the node.
+"""
+    Every call opens its own connection, since they run in the threadpool. The last use of each
+    entry is recorded on reads, and the least recently used ones are deleted after every write
+    while the bodies exceed max_bytes.
+"""
+class SQLiteBackend:
+    blocking = True
+
+    def __init__(self, path, max_bytes):
+        self.path = path
+        self.max_bytes = max_bytes
+        with closing(self.connect()) as connection:
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("""
+                CREATE TABLE IF NOT EXISTS response_cache (
+                    key TEXT PRIMARY KEY,
+                    body BLOB NOT NULL,
+                    media_type TEXT NOT NULL,
+                    etag TEXT NOT NULL,
+                    expires REAL NOT NULL,
+                    used REAL NOT NULL
+                )""")
+            connection.execute("CREATE INDEX IF NOT EXISTS idx_response_cache_used ON response_cache (used)")
+
+    #Opens a connection in autocommit mode, closed after every call, which rolls back a transaction left open by an error.
+    def connect(self):
+        return sqlite3.connect(self.path, timeout=5, isolation_level=None)
+
+    def get(self, key):
+        now = time.time()
+        with closing(self.connect()) as connection:
+            row = connection.execute("SELECT body, media_type, etag, expires FROM response_cache WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            if row[3] <= now:
+                connection.execute("DELETE FROM response_cache WHERE key = ?", (key,))
+                return None
+            connection.execute("UPDATE response_cache SET used = ? WHERE key = ?", (now, key))
+            return CacheEntry(*row)
+
+    def set(self, key, entry):
+        with closing(self.connect()) as connection:
+            connection.execute("BEGIN IMMEDIATE")
+            connection.execute("INSERT OR REPLACE INTO response_cache VALUES (?, ?, ?, ?, ?, ?)",
+                               (key, entry.body, entry.media_type, entry.etag, entry.expires, time.time()))
+            connection.execute("DELETE FROM response_cache WHERE expires <= ?", (time.time(),))
+            size = connection.execute("SELECT COALESCE(SUM(LENGTH(body)), 0) FROM response_cache").fetchone()[0]
+            for used_key, length in connection.execute("SELECT key, LENGTH(body) FROM response_cache ORDER BY used").fetchall():
+                if size <= self.max_bytes:
+                    break
+                connection.execute("DELETE FROM response_cache WHERE key = ?", (used_key,))
+                size -= length
+            connection.execute("COMMIT")
+
+    def clear(self):
+        with closing(self.connect()) as connection:
+            connection.execute("DELETE FROM response_cache")
+
+    def usage(self):
+        with closing(self.connect()) as connection:
+            return connection.execute("SELECT COUNT(*), COALESCE(SUM(LENGTH(body)), 0) FROM response_cache").fetchone()
+
+class ResponseCache:
+    def __init__(self, backend, ttl, max_age):
+        self.backend = backend
+        self.ttl = ttl
+        self.max_age = max_age
+        #Requests answered by this process, whichever the backend.
+        self.hits = 0
+        self.misses = 0
+
+    # Helper function to call the backend, off the event loop when it blocks.
+    async def call(self, method, *args):
+        if self.backend.blocking:
+            return await run_in_threadpool(method, *args)
+        return method(*args)
+
+    # Returns the response of a request from the cache, building and storing it on a miss.
+    """
+        build is awaited on a miss and returns the response content, either a dict, validated with
+        the response model when given, or a Response. Streamed and non-200 responses are returned
+        as they are, without being stored. The ETag is a hash of the body, so it is the same in
+        every worker, and a matching If-None-Match is answered with a 304.
+    """
+    async def respond(self, request, version, build, model=None):
+        key = cache_key(request, version)
+        entry = await self.call(self.backend.get, key)
+        if entry is not None:
+            self.hits += 1
+        else:
+            self.misses += 1
+            content = await build()
+            if isinstance(content, StreamingResponse):
+                return content
+            if isinstance(content, Response):
+                if content.status_code != status.HTTP_200_OK:
+                    return content
+                body, media_type = content.body, content.media_type
+            else:
+                if model is not None:
+                    content = model(**content).dict()
+                body, media_type = orjson.dumps(content), 'application/json'
+            entry = CacheEntry(body, media_type, f'"{hashlib.blake2b(body, digest_size=16).hexdigest()}"', time.time() + self.ttl)
+            await self.call(self.backend.set, key, entry)
+        headers = {'ETag': entry.etag, 'Cache-Control': f"max-age={self.max_age}" if self.max_age else 'no-cache'}
+        if etag_matches(request.headers.get('if-none-match'), entry.etag):
+            return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+        return Response(entry.body, media_type=entry.media_type, headers=headers)
+
+    async def stats(self):
+        entries, size = await self.call(self.backend.usage)
+        requests = self.hits + self.misses
+        return {
+            "backend" : settings.CACHE_BACKEND,
+            "entries" : entries,
+            "bytes" : size,
+            "max_bytes" : self.backend.max_bytes,
+            "hits" : self.hits,
+            "misses" : self.misses,
+            "hit_ratio" : self.hits / requests if requests else 0.0
+            }
+
+    async def clear(self):
+        await self.call(self.backend.clear)
+
+# Returns the cache key of a request, made of its path, sorted query, Accept header and data version.
+def cache_key(request, version):
+    query = '&'.join(sorted(f"{name}={value}" for name, value in request.query_params.multi_items()))
+    return f"{request.url.path}?{query}|{request.headers.get('accept', '')}|{version}"
+
+# Helper function to check an If-None-Match header against an ETag, with the weak comparison it calls for.
+def etag_matches(if_none_match, etag):
+    if if_none_match is None:
+        return False
+    return if_none_match.strip() == '*' or etag in [ tag.strip().removeprefix('W/') for tag in if_none_match.split(',') ]
+
+# Creates the cache with the backend in the settings, None when disabled.
+def create_cache():
+    if not settings.CACHE_ENABLED:
+        return None
+    if settings.CACHE_BACKEND == 'memory':
+        backend = MemoryBackend(settings.CACHE_MAX_BYTES)
+    elif settings.CACHE_BACKEND == 'sqlite':
+        path = settings.CACHE_SQLITE_PATH or os.path.join(tempfile.gettempdir(), 'trips_response_cache.sqlite3')
+        backend = SQLiteBackend(path, settings.CACHE_MAX_BYTES)
+    else:
+        raise ValueError(f"Unknown cache backend: {settings.CACHE_BACKEND}. Expected memory or sqlite")
+    return ResponseCache(backend, settings.CACHE_TTL, settings.CACHE_MAX_AGE)
+
+response_cache = create_cache()
@@ -0,0 +1,230 @@
+import argparse
+import asyncio
+import os
+import time
+from datetime import datetime, timedelta
+from sqlalchemy import select, update, delete
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.sql import func, text
+from .database import SessionLocal, dispose
+from . import models, similarity, rollups, ingest, parallel, filters, queries, serializers, partitions, idempotency
+
+"""
+    This file defines the maintenance commands for the application.
+    Run them from the project root with: python -m app.cli <command>
+"""
+
+# Computes the similarity group of the stored trips and records their groups.
+"""
+    Trips are processed in ranges of IDs, committing after each one so the command can be stopped
+    and resumed. By default only trips without a group are updated; --all recomputes every trip,
+    which is needed after changing SIMILARITY_TOLERANCE.
+"""
+async def backfill_similarity(args):
+    async with SessionLocal() as db:
+        if args.all:
+            await db.execute(delete(models.SimilarityGroup))
+        first, last = (await db.execute(select(func.min(models.Trip.id), func.max(models.Trip.id)))).one()
+        if first is None:
+            print("No trips found")
+            return
+        key = similarity.similarity_key_sql()
+        for start in range(first, last + 1, args.batch_size):
+            in_batch = (models.Trip.id >= start, models.Trip.id < start + args.batch_size)
+            query = update(models.Trip).where(*in_batch).values(similarity_group=key)
+            if not args.all:
+                query = query.where(models.Trip.similarity_group.is_(None))
+            updated = (await db.execute(query.execution_options(synchronize_session=False))).rowcount
+            groups = select(models.Trip.similarity_group, models.Trip.region, func.date_trunc('minute', models.Trip.datetime)).where(*in_batch).distinct()
+            await db.execute(insert(models.SimilarityGroup).from_select(['similarity_group', 'region', 'datetime'], groups).on_conflict_do_nothing())
+            await db.commit()
+            print(f"Trips {start} to {start + args.batch_size - 1}: {updated} updated")
+
+# Checks the trip rollups against the stored trips and rebuilds them from scratch.
+"""
+    With --check the rollups are only compared and the amount of mismatching buckets is reported.
+    Rebuilding runs in a single transaction, so readers keep seeing the old rollups until it ends.
+"""
+async def rebuild_rollups(args):
+    async with SessionLocal() as db:
+        if args.check:
+            print(f"{await rollups.count_mismatches(db)} rollups differ from the stored trips")
+            return
+        await rollups.rebuild(db)
+        await db.commit()
+        print("Rollups rebuilt")
+
+# Ingests a local CSV file with the multi-core ingest.
+"""
+    Every range of the file is committed on its own, see app/parallel.py.
+"""
+async def ingest_file(args):
+    start = time.perf_counter()
+    try:
+        result = await parallel.copy_csv_file(args.path, args.processes, args.writers)
+    except ingest.IngestError as e:
+        print(e)
+        return
+    elapsed = time.perf_counter() - start
+    for error in result.errors:
+        print(f"Line {error['line']}: {error['error']}")
+    print(f"{result.ingested} trips ingested, {result.duplicates} already stored and {result.rejected} rejected in {elapsed:.2f}s ({result.ingested / elapsed:,.0f} rows/s)")
+
+# Checks that the trip filters and the bounding box queries are answered from their indexes.
+"""
+    Fails when any index of FILTER_INDEXES or GIST_INDEXES is missing from the trips table. Every
+    query is explained with sequential scans disabled, so small tables still show whether the
+    indexes can be used, and exits with an error when any of them does not use its indexes.
+"""
+async def check_indexes(args):
+    async with SessionLocal() as db:
+        missing, plans = await explain_indexes(db, filters.parse_bbox(args.bbox))
+    for index in missing:
+        print(f"MISSING INDEX: {index}")
+    for name, (used, expected) in plans.items():
+        if used:
+            print(f"{name}: {', '.join(used)}")
+        else:
+            print(f"{name}: NO INDEX USED, expected one of {', '.join(expected)}")
+    if missing or not all(used for used, expected in plans.values()):
+        raise SystemExit(1)
+
+# Returns the required indexes missing from the trips table, and the expected indexes each checked query uses.
+"""
+    The partitions of the trips have their own copy of every index, named by PostgreSQL, so the
+    indexes in the plans are reported by the name of the index of the trips table they belong to.
+"""
+async def explain_indexes(db, bbox):
+    bottom_left, top_right = f"POINT({bbox[0]!r} {bbox[1]!r})", f"POINT({bbox[2]!r} {bbox[3]!r})"
+    start, end = SIMILAR_DATETIME, SIMILAR_DATETIME + timedelta(days=1)
+    statements = {
+        'weekly average by bounding box' : (queries.QUERIES['similar_trips_by_bounding_box'].statement.bindparams(bottom_left=bottom_left, top_right=top_right), GIST_INDEXES),
+        'bbox listing' : (serializers.select_trips().where(*filters.trip_filters(origin_bbox=bbox, destination_bbox=bbox)), GIST_INDEXES),
+        'bbox count' : (filters.count_trips(origin_bbox=bbox, destination_bbox=bbox), GIST_INDEXES),
+        'similar trips' : (queries.QUERIES['similar_trips'].statement.bindparams(origin=bottom_left, destination=top_right, datetime=SIMILAR_DATETIME,
+                                                                                start=SIMILAR_DATETIME - timedelta(hours=1), end=SIMILAR_DATETIME + timedelta(hours=1),
+                                                                                max_distance=1.0, max_seconds=3600.0, exclude_id=0, candidates=100, k=10), GIST_INDEXES),
+        'region and datetime count' : (filters.count_trips(region=CHECKED_REGION, start=start, end=end), ('idx_trips_region_datetime',)),
+        'datasource count' : (filters.count_trips(datasource=CHECKED_DATASOURCE), ('idx_trips_datasource',)),
+        'datetime count' : (filters.count_trips(start=start, end=end), ('idx_trips_datetime',))
+        }
+    existing = set((await db.execute(text("SELECT indexname FROM pg_indexes WHERE tablename = 'trips'"))).scalars())
+    missing = [ index for index in FILTER_INDEXES + GIST_INDEXES if index not in existing ]
+    parents = dict((await db.execute(text(PARTITION_INDEXES))).all())
+    plans = {}
+    await db.execute(text("SET LOCAL enable_seqscan = off"))
+    for name, (statement, expected) in statements.items():
+        sql = statement.compile(dialect=postgresql.dialect(), compile_kwargs={'literal_binds': True})
+        plan = (await db.execute(text(f"EXPLAIN (FORMAT JSON) {sql}"))).scalar()
+        used = sorted(set(parents.get(index, index) for index in plan_indexes(plan)) & set(expected))
+        plans[name] = (used, expected)
+    await db.rollback()
+    return missing, plans
+
+# Creates the monthly partitions of the trips up to --ahead months past the current one, and lists them.
+async def create_partitions(args):
+    async with SessionLocal() as db:
+        created = await partitions.maintain(db, args.ahead)
+        await db.commit()
+        for name, bounds, rows in await partitions.list_partitions(db):
+            print(f"{name}{' (created)' if name in created else ''}: {bounds}, ~{rows:,} trips")
+
+# Drops the partitions of the trips older than the kept months, along their rollups and similarity groups, and the expired idempotency keys.
+"""
+    With --detach the partitions are only detached and stay as plain tables, to be archived before
+    dropping them by hand. With --dry-run the partitions are only listed.
+"""
+async def apply_retention(args):
+    if args.keep_months < 1:
+        print("At least the current month has to be kept")
+        return
+    async with SessionLocal() as db:
+        if args.dry_run:
+            cutoff = partitions.retention_cutoff(args.keep_months)
+            names = await partitions.expired_partitions(db, cutoff)
+            print(f"Trips before {partitions.partition_bounds(cutoff)[0]} would be removed, partitions: {', '.join(names) or 'none'}")
+            return
+        names = await partitions.drop_partitions(db, args.keep_months, args.detach)
+        purged = await idempotency.purge(db)
+        await db.commit()
+        print(f"{'Detached' if args.detach else 'Dropped'} partitions: {', '.join(names) or 'none'}")
+        print(f"{purged} expired idempotency keys deleted")
+
+#GiST indexes on the trip coordinates, created along the trips table.
+GIST_INDEXES = ('idx_trips_origin_coord', 'idx_trips_destination_coord', 'idx_trips_origin_coord_datetime', 'idx_trips_destination_coord_datetime')
+
+#B-tree indexes of the region, datasource and datetime filters, see the add trip filter indexes migration.
+FILTER_INDEXES = ('idx_trips_region_datetime', 'idx_trips_datasource', 'idx_trips_datetime')
+
+#Datetime the similar trips lookup and the datetime filters are explained around.
+SIMILAR_DATETIME = datetime(2018, 5, 28, 9)
+
+#Region and datasource the filters are explained with.
+CHECKED_REGION = 'Prague'
+CHECKED_DATASOURCE = 'cheap_mobile'
+
+#Index of the trips table each index of the partitions belongs to.
+PARTITION_INDEXES = """
+    SELECT child.relname, parent.relname FROM pg_inherits
+    JOIN pg_class child ON child.oid = pg_inherits.inhrelid
+    JOIN pg_class parent ON parent.oid = pg_inherits.inhparent
+    WHERE child.relkind = 'i'
+"""
+
+# Helper function to find the names of the indexes used anywhere in an EXPLAIN (FORMAT JSON) plan.
+def plan_indexes(plan):
+    if isinstance(plan, list):
+        for item in plan:
+            yield from plan_indexes(item)
+    elif isinstance(plan, dict):
+        if 'Index Name' in plan:
+            yield plan['Index Name']
+        for value in plan.values():
+            yield from plan_indexes(value)
+
+# Runs a command and disposes of the engines' connections before the loop is closed.
+async def run(args):
+    try:
+        await args.func(args)
+    finally:
+        await dispose()
+
+def main():
+    parser = argparse.ArgumentParser(prog='python -m app.cli')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    backfill = commands.add_parser('backfill-similarity', help='Compute the similarity groups of the stored trips')
+    backfill.add_argument('--all', action='store_true', help='Recompute every trip instead of only the ones without a group')
+    backfill.add_argument('--batch-size', type=int, default=50000, help='Trip IDs processed on each transaction')
+    backfill.set_defaults(func=backfill_similarity)
+
+    rebuild = commands.add_parser('rebuild-rollups', help='Rebuild the trip rollups from the stored trips')
+    rebuild.add_argument('--check', action='store_true', help='Only report how many rollups differ from the stored trips')
+    rebuild.set_defaults(func=rebuild_rollups)
+
+    ingest_parser = commands.add_parser('ingest', help='Ingest a local CSV file using several processes and DB connections')
+    ingest_parser.add_argument('path', help='Path of the CSV file')
+    ingest_parser.add_argument('--processes', type=int, default=os.cpu_count(), help='Processes parsing the file')
+    ingest_parser.add_argument('--writers', type=int, default=None, help='DB connections writing the trips, INGEST_WRITERS by default')
+    ingest_parser.set_defaults(func=ingest_file)
+
+    indexes = commands.add_parser('check-indexes', help='Check the trip filters, bounding box and similar trips queries use their indexes')
+    indexes.add_argument('--bbox', default='14,49,15,51', help='Box explained, as min_x,min_y,max_x,max_y')
+    indexes.set_defaults(func=check_indexes)
+
+    create = commands.add_parser('partitions', help='Create the coming monthly partitions of the trips and list them')
+    create.add_argument('--ahead', type=int, default=None, help='Months created past the current one, PARTITIONS_AHEAD by default')
+    create.set_defaults(func=create_partitions)
+
+    retention = commands.add_parser('retention', help='Drop the monthly partitions of the trips older than the kept months')
+    retention.add_argument('--keep-months', type=int, required=True, help='Months kept, the current one included')
+    retention.add_argument('--detach', action='store_true', help='Detach the partitions instead of dropping them')
+    retention.add_argument('--dry-run', action='store_true', help='Only list the partitions that would be removed')
+    retention.set_defaults(func=apply_retention)
+
+    args = parser.parse_args()
+    asyncio.run(run(args))
+
+if __name__ == '__main__':
+    main()
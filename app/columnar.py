@@ -0,0 +1,215 @@
+import numpy as np
+import pyarrow as pa
+import pyarrow.ipc
+import pyarrow.parquet as pq
+from sqlalchemy import select
+from sqlalchemy.sql import func
+from starlette.concurrency import run_in_threadpool, iterate_in_threadpool
+from .config import settings
+from .database import get_driver_connection
+from . import models, parsing, ingest
+
+"""
+    This file defines the columnar export and import of trips, as Parquet or Arrow IPC.
+    The points travel as plain longitude and latitude columns, the datetimes as timestamps and the
+    regions and datasources dictionary encoded, so neither side formats or parses any WKT or CSV.
+    Exports are written in record batches read from a server-side cursor, and imports are read in
+    record batches and copied to the DB as hex EWKB points.
+"""
+
+#Supported formats, with the media type and file extension of each.
+PARQUET = 'parquet'
+ARROW = 'arrow'
+MEDIA_TYPES = {PARQUET : 'application/vnd.apache.parquet', ARROW : 'application/vnd.apache.arrow.stream'}
+EXTENSIONS = {PARQUET : ('.parquet', '.pq'), ARROW : ('.arrow', '.arrows', '.ipc', '.feather')}
+
+SCHEMA = pa.schema([
+    ('id', pa.int64()),
+    ('region', pa.dictionary(pa.int32(), pa.string())),
+    ('origin_lon', pa.float64()),
+    ('origin_lat', pa.float64()),
+    ('destination_lon', pa.float64()),
+    ('destination_lat', pa.float64()),
+    ('datetime', pa.timestamp('us')),
+    ('datasource', pa.dictionary(pa.int32(), pa.string())),
+    ])
+
+#Columns required to import trips, the id is always assigned by the DB.
+IMPORT_COLUMNS = ('region', 'origin_lon', 'origin_lat', 'destination_lon', 'destination_lat', 'datetime', 'datasource')
+
+#Columns selected for the export, in the order of the schema.
+EXPORT_COLUMNS = (
+    models.Trip.id,
+    models.Trip.region,
+    func.ST_X(models.Trip.origin_coord).label("origin_lon"),
+    func.ST_Y(models.Trip.origin_coord).label("origin_lat"),
+    func.ST_X(models.Trip.destination_coord).label("destination_lon"),
+    func.ST_Y(models.Trip.destination_coord).label("destination_lat"),
+    models.Trip.datetime,
+    models.Trip.datasource,
+)
+
+# Returns a select of the export columns, to be filtered by the endpoint.
+def select_export():
+    return select(*EXPORT_COLUMNS).order_by(models.Trip.id)
+
+# Returns the format of a file from its name, None when the extension is unknown.
+def format_from_filename(filename):
+    filename = (filename or '').lower()
+    for format, extensions in EXTENSIONS.items():
+        if filename.endswith(extensions):
+            return format
+    return None
+
+#File-like object keeping what a writer writes until it is taken, to stream it as it is produced.
+class ChunkSink:
+    def __init__(self):
+        self.chunks = []
+        self.position = 0
+        self.closed = False
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        self.position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def take(self):
+        data = b"".join(self.chunks)
+        self.chunks = []
+        return data
+
+# Converts rows selected with EXPORT_COLUMNS to a record batch.
+def record_batch(rows):
+    columns = list(zip(*rows)) if rows else [ [] ] * len(SCHEMA)
+    arrays = [ pa.array(values, field.type.value_type).dictionary_encode() if pa.types.is_dictionary(field.type) else pa.array(values, field.type)
+               for values, field in zip(columns, SCHEMA) ]
+    return pa.RecordBatch.from_arrays(arrays, schema=SCHEMA)
+
+#Writes record batches in one of the formats, returning the bytes produced by each call.
+class BatchWriter:
+    def __init__(self, format):
+        self.format = format
+        self.sink = ChunkSink()
+        if format == PARQUET:
+            self.writer = pq.ParquetWriter(pa.PythonFile(self.sink, mode='w'), SCHEMA)
+        else:
+            self.writer = pa.ipc.new_stream(pa.PythonFile(self.sink, mode='w'), SCHEMA)
+
+    def write(self, rows):
+        batch = record_batch(rows)
+        if self.format == PARQUET:
+            self.writer.write_batch(batch, row_group_size=len(rows) or None)
+        else:
+            self.writer.write_batch(batch)
+        return self.sink.take()
+
+    def close(self):
+        self.writer.close()
+        return self.sink.take()
+
+# Streams the rows of a server-side cursor as a file of the given format.
+"""
+    Each partition of the cursor becomes one record batch, or one row group in Parquet, and is
+    converted in the threadpool. An empty result still produces a valid file with the schema.
+"""
+async def export_stream(first, partitions, format):
+    writer = BatchWriter(format)
+    if first:
+        yield await run_in_threadpool(writer.write, first)
+    async for partition in partitions:
+        yield await run_in_threadpool(writer.write, partition)
+    yield await run_in_threadpool(writer.close)
+
+# Reads a Parquet or Arrow IPC file in record batches of INGEST_CHUNK_SIZE rows.
+"""
+    Arrow files can be in the IPC file format or in the streaming format.
+"""
+def read_batches(path, format):
+    if format == PARQUET:
+        file = pq.ParquetFile(path)
+        missing = [ column for column in IMPORT_COLUMNS if column not in file.schema_arrow.names ]
+        if missing:
+            raise ingest.IngestError(f"Missing columns in the uploaded file: {', '.join(missing)}")
+        yield from file.iter_batches(batch_size=settings.INGEST_CHUNK_SIZE, columns=list(IMPORT_COLUMNS))
+        return
+    try:
+        reader = pa.ipc.open_file(path)
+        batches = (reader.get_batch(index) for index in range(reader.num_record_batches))
+    except pa.ArrowInvalid:
+        reader = pa.ipc.open_stream(path)
+        batches = reader
+    missing = [ column for column in IMPORT_COLUMNS if column not in reader.schema.names ]
+    if missing:
+        raise ingest.IngestError(f"Missing columns in the uploaded file: {', '.join(missing)}")
+    for batch in batches:
+        for start in range(0, batch.num_rows, settings.INGEST_CHUNK_SIZE):
+            yield batch.slice(start, settings.INGEST_CHUNK_SIZE)
+
+# Converts a record batch to parsed trips, rejecting the rows with missing values or invalid coordinates.
+"""
+    Datetimes are truncated to seconds like the ones in CSV files, and the ones with a time zone
+    are converted to UTC.
+"""
+def parse_batch(batch):
+    columns = { name : batch.column(batch.schema.get_field_index(name)) for name in IMPORT_COLUMNS }
+    errors = {}
+    for name in IMPORT_COLUMNS:
+        for index in np.flatnonzero(columns[name].is_null().to_numpy(zero_copy_only=False)).tolist():
+            errors.setdefault(index, f"Missing value for column '{name}'")
+    coords = { name : columns[name].cast(pa.float64()).fill_null(np.nan).to_numpy() for name in IMPORT_COLUMNS[1:5] }
+    origin = np.column_stack([ coords['origin_lon'], coords['origin_lat'] ])
+    destination = np.column_stack([ coords['destination_lon'], coords['destination_lat'] ])
+    for name, points in (('origin', origin), ('destination', destination)):
+        for index in np.flatnonzero(~np.isfinite(points).all(axis=1)).tolist():
+            errors.setdefault(index, f"Invalid coordinates for the {name}: {points[index].tolist()}")
+    datetimes = columns['datetime']
+    if not pa.types.is_timestamp(datetimes.type):
+        raise ingest.IngestError(f"The datetime column must be a timestamp, found {datetimes.type}")
+    if datetimes.type.tz is not None:
+        datetimes = datetimes.cast(pa.timestamp(datetimes.type.unit))
+    datetimes = datetimes.to_numpy(zero_copy_only=False).astype('datetime64[s]')
+    region = np.asarray(columns['region'].to_pylist(), dtype=object)
+    datasource = np.asarray(columns['datasource'].to_pylist(), dtype=object)
+    for name, values in (('region', region), ('datasource', datasource)):
+        for index in np.flatnonzero(np.equal(values, '')).tolist():
+            errors.setdefault(index, f"Missing value for column '{name}'")
+    return parsing.ParsedTrips(region, origin, destination, datetimes, datasource, errors)
+
+# Parses a record batch and prepares its valid trips to be copied.
+def prepare_batch(batch):
+    return ingest.prepare_parsed(parse_batch(batch))
+
+# Imports the trips of a Parquet or Arrow IPC file on disk, copying each batch like a CSV chunk.
+"""
+    Rejected rows are reported as lines, numbered by their row in the file starting at 1, and trips
+    already stored are skipped like in every other ingest path. The optional
+    progress coroutine is awaited with the result after every batch. The caller is responsible for committing.
+"""
+async def import_file(db, path, format, progress=None):
+    connection = await get_driver_connection(db)
+    result = ingest.IngestResult()
+    offset = 0
+    try:
+        #Reading, parsing and hashing the batches is CPU work, done in the threadpool to keep the event loop free.
+        async for batch in iterate_in_threadpool(read_batches(path, format)):
+            prepared = await run_in_threadpool(prepare_batch, batch)
+            parsed = prepared.parsed
+            result.reject_parsed(parsed, range(offset + 1, offset + len(parsed) + 1))
+            ingested = await ingest.write_chunk(db, connection, prepared, f"Rows {offset + 1} to {offset + len(parsed)}")
+            result.ingested += ingested
+            result.duplicates += int(parsed.valid.sum()) - ingested
+            offset += len(parsed)
+            if progress is not None:
+                await progress(result)
+    except (pa.ArrowException, OSError) as e:
+        raise ingest.IngestError(f"The uploaded file is not a valid {format} file: {e}")
+    return result
@@ -0,0 +1,267 @@
+import re
+import zlib
+import orjson
+import zstandard
+from fastapi import HTTPException, status
+from starlette.concurrency import run_in_threadpool
+from starlette.datastructures import Headers, MutableHeaders
+from .config import settings
+
+"""
+    This file defines the compression of the request and response bodies, as gzip or zstd.
+    Request bodies sent with a Content-Encoding are decompressed as they are received, so the form
+    and JSON parsers read the plain body one chunk at a time and a compressed upload is never held
+    whole in memory. Responses are compressed with the encoding preferred in Accept-Encoding once
+    they reach COMPRESSION_MIN_SIZE bytes, and streamed responses chunk by chunk as they are sent.
+"""
+
+GZIP = 'gzip'
+ZSTD = 'zstd'
+ENCODINGS = (ZSTD, GZIP)
+
+#Media types already compressed, sent as they are. SVG plots are text and get compressed.
+INCOMPRESSIBLE_TYPES = ('image/png', 'image/jpeg', 'image/gif', 'image/webp', 'application/vnd.apache.parquet', 'application/gzip', 'application/zstd')
+
+#Bodies from this many bytes on are compressed in the threadpool, both libraries release the GIL.
+THREADPOOL_MIN_SIZE = 262144
+
+#Bytes of decompressed request body handed to the app at a time.
+DECOMPRESSION_CHUNK_SIZE = 65536
+
+#Largest expansion of zstd input, a run-length block expanding 4 bytes into 128 KiB.
+ZSTD_MAX_EXPANSION = 32768
+
+#Suffix added to the ETag of the compressed representations, removed from If-None-Match before the endpoints see it.
+ETAG_SUFFIX = re.compile(r'-(?:gzip|zstd)"')
+
+# Returns a new decompressor of one gzip member or zstd frame.
+def new_decompressor(encoding):
+    if encoding == GZIP:
+        return zlib.decompressobj(16 + zlib.MAX_WBITS)
+    return zstandard.ZstdDecompressor().decompressobj()
+
+#Decompresses a body received in chunks, made of any amount of gzip members or zstd frames.
+"""
+    The body is handed out in pieces of about DECOMPRESSION_CHUNK_SIZE bytes, and refused with a 413
+    once it exceeds COMPRESSION_MAX_BODY_SIZE bytes. gzip output is bounded by zlib, while zstd is fed
+    at most DECOMPRESSION_CHUNK_SIZE bytes of input at a time, fewer when even run-length blocks would
+    expand past the size left, so a small bomb never takes more memory than the limit.
+"""
+class Decoder:
+    def __init__(self, encoding):
+        self.encoding = encoding
+        self.decompressor = new_decompressor(encoding)
+        #Whether the current member or frame was started and not finished yet.
+        self.pending = False
+        #Bytes decompressed so far.
+        self.size = 0
+
+    # Decompresses the start of some input, returning a piece of the body within the size left and the input left.
+    def step(self, data):
+        if self.encoding == GZIP:
+            piece = self.decompressor.decompress(data, DECOMPRESSION_CHUNK_SIZE)
+            #Once the member ends, the input left is in unused_data as well.
+            return piece, b'' if self.decompressor.eof else self.decompressor.unconsumed_tail
+        size = max(1, min(DECOMPRESSION_CHUNK_SIZE, (settings.COMPRESSION_MAX_BODY_SIZE - self.size) // ZSTD_MAX_EXPANSION))
+        return self.decompressor.decompress(data[:size]), data[size:]
+
+    # Yields the body decompressed from a received chunk, in pieces of at least DECOMPRESSION_CHUNK_SIZE bytes but the last.
+    def decompress(self, data):
+        data = memoryview(data)
+        output = []
+        length = 0
+        #A full gzip piece may leave output behind once the input is consumed.
+        full = False
+        try:
+            while data or full:
+                self.pending = True
+                piece, data = self.step(data)
+                full = self.encoding == GZIP and len(piece) >= DECOMPRESSION_CHUNK_SIZE
+                self.size += len(piece)
+                if self.size > settings.COMPRESSION_MAX_BODY_SIZE:
+                    raise HTTPException(status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+                                        detail=f"The decompressed request body exceeds {settings.COMPRESSION_MAX_BODY_SIZE} bytes")
+                output.append(piece)
+                length += len(piece)
+                if self.decompressor.eof:
+                    data = memoryview(self.decompressor.unused_data + data)
+                    self.decompressor = new_decompressor(self.encoding)
+                    self.pending = False
+                    full = False
+                if length >= DECOMPRESSION_CHUNK_SIZE:
+                    yield b''.join(output)
+                    output = []
+                    length = 0
+        except (zlib.error, zstandard.ZstdError) as e:
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST,
+                                detail=f"The request body is not valid {self.encoding}: {e}")
+        if length:
+            yield b''.join(output)
+
+    def finish(self):
+        if self.pending:
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST,
+                                detail=f"The {self.encoding} request body is truncated")
+
+#Compresses a response body sent in chunks, flushing every chunk so streamed responses can be decoded as they arrive.
+class Encoder:
+    def __init__(self, encoding):
+        if encoding == GZIP:
+            self.compressor = zlib.compressobj(settings.COMPRESSION_GZIP_LEVEL, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+            self.flush_mode = zlib.Z_SYNC_FLUSH
+        else:
+            self.compressor = zstandard.ZstdCompressor(level=settings.COMPRESSION_ZSTD_LEVEL).compressobj()
+            self.flush_mode = zstandard.COMPRESSOBJ_FLUSH_BLOCK
+
+    def compress(self, data, final=False):
+        data = self.compressor.compress(data)
+        return data + (self.compressor.flush() if final else self.compressor.flush(self.flush_mode))
+
+    async def compress_async(self, data, final=False):
+        if len(data) >= THREADPOOL_MIN_SIZE:
+            return await run_in_threadpool(self.compress, data, final)
+        return self.compress(data, final)
+
+# Returns the encoding to answer with given an Accept-Encoding header, None for no compression.
+"""
+    Follows the quality values, preferring zstd over gzip when they are equal. '*' stands for gzip,
+    which every client supporting compression understands.
+"""
+def choose_encoding(accept_encoding):
+    qualities = {}
+    for item in accept_encoding.split(','):
+        name, *params = [ part.strip() for part in item.split(';') ]
+        name = name.lower()
+        quality = 1.0
+        for param in params:
+            if param.startswith('q='):
+                try:
+                    quality = float(param[2:])
+                except ValueError:
+                    quality = 0.0
+        if name == '*':
+            qualities.setdefault(GZIP, quality)
+        elif name in ENCODINGS:
+            qualities[name] = quality
+    best = max(ENCODINGS, key=lambda encoding: qualities.get(encoding, 0.0))
+    return best if qualities.get(best, 0.0) > 0 else None
+
+# Helper function to tell whether a response can be compressed from its headers.
+def compressible(headers):
+    content_type = headers.get('content-type', '')
+    return 'content-encoding' not in headers and not content_type.startswith(INCOMPRESSIBLE_TYPES)
+
+# Helper function to add the encoding to an ETag, so caches don't mix up the representations.
+def encoded_etag(etag, encoding):
+    return f'{etag[:-1]}-{encoding}"' if etag.endswith('"') else etag
+
+#Decompresses the request bodies sent with a gzip or zstd Content-Encoding before the app reads them.
+"""
+    The Content-Encoding and Content-Length headers are removed from the request, since they no
+    longer describe the body the app receives. Other encodings get a 415.
+"""
+class DecompressionMiddleware:
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            return await self.app(scope, receive, send)
+        encoding = Headers(scope=scope).get('content-encoding', 'identity').strip().lower()
+        if encoding == 'identity':
+            return await self.app(scope, receive, send)
+        if encoding not in ENCODINGS:
+            return await send_error(send, status.HTTP_415_UNSUPPORTED_MEDIA_TYPE,
+                                    f"Unsupported Content-Encoding: {encoding}. Expected one of: {', '.join(ENCODINGS)}")
+        decoder = Decoder(encoding)
+        #Rewritten in place, so the middlewares around see the route the router adds to the scope.
+        scope['headers'] = [ (name, value) for name, value in scope['headers'] if name not in (b'content-encoding', b'content-length') ]
+
+        pieces = iter(())
+        received = False
+        finished = False
+
+        async def receive_decompressed():
+            nonlocal pieces, received, finished
+            while True:
+                body = next(pieces, None)
+                if body is not None:
+                    return {'type' : 'http.request', 'body' : body, 'more_body' : True}
+                if received:
+                    break
+                message = await receive()
+                if message['type'] != 'http.request':
+                    return message
+                pieces = decoder.decompress(message.get('body', b''))
+                received = not message.get('more_body', False)
+            if finished:
+                return await receive()
+            finished = True
+            decoder.finish()
+            return {'type' : 'http.request', 'body' : b'', 'more_body' : False}
+
+        await self.app(scope, receive_decompressed, send)
+
+# Helper function to answer with an error in the format of the API before reaching it.
+async def send_error(send, status_code, detail):
+    body = orjson.dumps({'detail' : detail})
+    await send({'type' : 'http.response.start', 'status' : status_code,
+                'headers' : [ (b'content-type', b'application/json'), (b'content-length', str(len(body)).encode()) ]})
+    await send({'type' : 'http.response.body', 'body' : body})
+
+#Compresses the responses for the clients accepting gzip or zstd.
+"""
+    Bodies sent in a single message are only compressed from COMPRESSION_MIN_SIZE bytes on, streamed
+    ones always are. The ETag of a compressed response gets the encoding appended, and the suffix is
+    removed from If-None-Match, so the response cache keeps validating a single ETag per body.
+"""
+class CompressionMiddleware:
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            return await self.app(scope, receive, send)
+        headers = Headers(scope=scope)
+        encoding = choose_encoding(headers.get('accept-encoding', ''))
+        if encoding is not None and 'if-none-match' in headers:
+            scope['headers'] = [ (name, ETAG_SUFFIX.sub('"', value.decode('latin-1')).encode('latin-1') if name == b'if-none-match' else value)
+                                 for name, value in scope['headers'] ]
+        start = None
+        encoder = None
+
+        async def send_compressed(message):
+            nonlocal start, encoder
+            if message['type'] == 'http.response.start':
+                #Held until the first chunk of the body tells whether it is worth compressing.
+                start = message
+                return
+            if message['type'] != 'http.response.body':
+                return await send(message)
+            if start is None:
+                if encoder is not None:
+                    message = dict(message, body=await encoder.compress_async(message.get('body', b''), not message.get('more_body', False)))
+                return await send(message)
+            response_headers = MutableHeaders(raw=start['headers'])
+            body = message.get('body', b'')
+            more_body = message.get('more_body', False)
+            if compressible(response_headers):
+                response_headers.add_vary_header('Accept-Encoding')
+                if encoding is not None and 'etag' in response_headers and start['status'] == 304:
+                    response_headers['ETag'] = encoded_etag(response_headers['etag'], encoding)
+                if encoding is not None and start['status'] != 304 and (more_body or len(body) >= settings.COMPRESSION_MIN_SIZE):
+                    encoder = Encoder(encoding)
+                    body = await encoder.compress_async(body, final=not more_body)
+                    response_headers['Content-Encoding'] = encoding
+                    if 'etag' in response_headers:
+                        response_headers['ETag'] = encoded_etag(response_headers['etag'], encoding)
+                    if more_body:
+                        del response_headers['Content-Length']
+                    else:
+                        response_headers['Content-Length'] = str(len(body))
+                    message = dict(message, body=body)
+            await send(start)
+            start = None
+            await send(message)
+
+        await self.app(scope, receive, send_compressed)
@@ -1,3 +1,4 @@
+from typing import Union
 from pydantic import BaseSettings
 
 #Type definitions for pydantic settings in .env file.
@@ -11,6 +12,100 @@ class Settings(BaseSettings):
 
     CLIENT_ORIGIN: str
 
+    #Connection pool and statement timeout (in milliseconds) for the DB engine.
+    DB_POOL_SIZE: int = 10
+    DB_MAX_OVERFLOW: int = 20
+    DB_POOL_TIMEOUT: float = 30
+    DB_STATEMENT_TIMEOUT: int = 60000
+    #Comma separated host:port of the read replicas, which share the credentials and DB of the primary. Reads use a separate pool on the primary when empty.
+    DB_READ_REPLICAS: str = ''
+    #Connection pool of each read engine.
+    DB_READ_POOL_SIZE: int = 10
+    DB_READ_MAX_OVERFLOW: int = 20
+    #Seconds a client reads from the primary after a write, so it sees its writes despite the replication lag. 0 turns it off.
+    DB_READ_YOUR_WRITES: float = 5
+
+    #Bytes read from the uploaded files at a time.
+    INGEST_READ_SIZE: int = 1048576
+    #Rows sent to the DB on each COPY while streaming CSV uploads.
+    INGEST_CHUNK_SIZE: int = 10000
+    #Maximum amount of rejected rows reported back on each upload.
+    INGEST_MAX_REPORTED_ERRORS: int = 1000
+    #Trips sent on each multi-row INSERT by the JSON endpoints.
+    INSERT_BATCH_SIZE: int = 1000
+    #Rows fetched from the server-side cursor on each flush while streaming listings.
+    STREAM_BATCH_SIZE: int = 1000
+    #Rows fetched from the server-side cursor for each record batch of the Parquet and Arrow exports.
+    EXPORT_BATCH_SIZE: int = 65536
+
+    #Processes parsing each CSV file and DB connections writing it. With a single process the file is parsed on the event loop.
+    INGEST_PROCESSES: int = 1
+    INGEST_WRITERS: int = 4
+    #Bytes of the file parsed by a process at a time.
+    INGEST_SPLIT_SIZE: int = 1048576
+    #Processes rendering the plots, spawned on the first plot requested.
+    PLOT_PROCESSES: int = 1
+    #Ingest jobs processed at the same time, and jobs allowed to wait in the queue.
+    JOB_WORKERS: int = 2
+    JOB_QUEUE_SIZE: int = 100
+    #Directory where uploaded files wait for their job, the system temporary directory by default.
+    JOB_SPOOL_DIR: Union[str, None] = None
+    #Timeout in seconds, attempts and initial backoff in seconds of the job completion webhooks.
+    WEBHOOK_TIMEOUT: float = 10
+    WEBHOOK_MAX_ATTEMPTS: int = 5
+    WEBHOOK_BACKOFF: float = 1
+
+    #Serve the analytics and trip filters from an in-memory store loaded at startup.
+    ANALYTICS_ENABLED: bool = False
+    #Days of trips kept in the store, every trip when unset. Only the filters from the window on use it then.
+    ANALYTICS_WINDOW_DAYS: Union[int, None] = None
+    #Size in degrees of the grid cells indexing the origins and destinations in the store.
+    ANALYTICS_GRID_SIZE: float = 0.5
+
+    #Cache the responses of the read endpoints, keyed by the data version ingest bumps.
+    CACHE_ENABLED: bool = True
+    #Where the entries are kept: memory, in each API process, or sqlite, in a file shared by the processes of the node.
+    CACHE_BACKEND: str = 'memory'
+    #Path of the SQLite cache file, in the system temporary directory by default.
+    CACHE_SQLITE_PATH: Union[str, None] = None
+    #Total bytes of the cached bodies, and seconds an entry is kept even while its data version is current.
+    CACHE_MAX_BYTES: int = 67108864
+    CACHE_TTL: float = 300
+    #max-age in seconds sent to the clients, which revalidate every request with the ETag when 0.
+    CACHE_MAX_AGE: int = 0
+
+    #Compress the responses for the clients accepting gzip or zstd, once their body reaches COMPRESSION_MIN_SIZE bytes.
+    COMPRESSION_ENABLED: bool = True
+    COMPRESSION_MIN_SIZE: int = 1024
+    #Compression levels, 1 to 9 for gzip and 1 to 22 for zstd.
+    COMPRESSION_GZIP_LEVEL: int = 6
+    COMPRESSION_ZSTD_LEVEL: int = 3
+    #Largest decompressed size of a gzip or zstd request body, larger ones get a 413.
+    COMPRESSION_MAX_BODY_SIZE: int = 1073741824
+
+    #Record the request, query and connection pool metrics served at /metrics.
+    METRICS_ENABLED: bool = True
+    #Log the statements slower than this many milliseconds along their plan, with EXPLAIN ANALYZE for the registry reads, off when unset.
+    SLOW_QUERY_MS: Union[float, None] = None
+
+    #Seconds the response of a request sent with an Idempotency-Key is given back to its retries.
+    IDEMPOTENCY_TTL: float = 86400
+
+    #Months of trip partitions kept created past the current one, and seconds between the checks of the API.
+    PARTITIONS_AHEAD: int = 3
+    PARTITION_CHECK_INTERVAL: float = 3600
+
+    #Keep the queries prepared on the server so their plans are reused.
+    PREPARED_STATEMENTS: bool = True
+
+    #Size in degrees of the grid cells used to group similar trips.
+    SIMILARITY_TOLERANCE: float = 1.5
+    #Default thresholds of the similar trips lookup: distance in degrees of both points and minutes between the trips.
+    SIMILAR_TRIPS_MAX_DISTANCE: float = 1.5
+    SIMILAR_TRIPS_MAX_MINUTES: float = 60
+    #Nearest trips taken by origin and by destination before ranking them, at least the amount asked for.
+    SIMILAR_TRIPS_CANDIDATES: int = 100
+
     class Config:
         env_file = './.env'
 
@@ -1,26 +1,126 @@
-from sqlalchemy import create_engine
+import itertools
+import math
+import time
+from fastapi import Request
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import AsyncAdaptedQueuePool
 from .config import settings
-from psycopg2.extensions import register_adapter, AsIs
+from . import metrics
+
+"""
+    This file defines the DB engines and the sessions of the endpoints.
+    Writes go to the primary through engine and SessionLocal. Reads go through a separate pool, on
+    the read replicas in DB_READ_REPLICAS taken in turns, or on the primary when there are none, so
+    heavy reads never take the connections of ingest. A client that just wrote is pinned to the
+    primary for DB_READ_YOUR_WRITES seconds by a cookie, so it reads its writes despite the lag of
+    the replicas.
+"""
+
+#Cookie holding the time until which a client reads from the primary.
+PRIMARY_COOKIE = 'db_primary_until'
+
+#Methods that don't write, which don't pin the client to the primary.
+SAFE_METHODS = ('GET', 'HEAD', 'OPTIONS')
+
+# Returns the DB URL of a host and port, with the credentials and DB from the .env settings.
+def database_url(host, port):
+    url = f"postgresql+asyncpg://{settings.POSTGRES_USER}:{settings.POSTGRES_PASSWORD}@{host}:{port}/{settings.POSTGRES_DB}"
+    if not settings.PREPARED_STATEMENTS:
+        url += "?prepared_statement_cache_size=0"
+    return url
+
+# Creates an async DB engine with a pool of the given size and the timeouts from the settings, timed when the metrics are enabled.
+def new_engine(url, name, pool_size, max_overflow):
+    engine = create_async_engine(
+        url,
+        pool_size=pool_size,
+        max_overflow=max_overflow,
+        pool_timeout=settings.DB_POOL_TIMEOUT,
+        pool_pre_ping=True,
+        pool_logging_name=name,
+        poolclass=metrics.TimedQueuePool if settings.METRICS_ENABLED else AsyncAdaptedQueuePool,
+        connect_args={'server_settings': {'statement_timeout': str(settings.DB_STATEMENT_TIMEOUT)}}
+    )
+    #Time every statement sent through the engine, tagged by named query.
+    if settings.METRICS_ENABLED:
+        metrics.instrument(engine, name)
+    return engine
+
+# Returns the (host, port) of the read replicas in the settings.
+def read_replicas():
+    replicas = []
+    for replica in settings.DB_READ_REPLICAS.split(','):
+        if replica.strip():
+            host, _, port = replica.strip().partition(':')
+            replicas.append((host, int(port) if port else 5432))
+    return replicas
 
 #Define DB URL based on .env settings.
-SQLALCHEMY_DATABASE_URL = f"postgresql://{settings.POSTGRES_USER}:{settings.POSTGRES_PASSWORD}@{settings.POSTGRES_HOSTNAME}:{settings.DATABASE_PORT}/{settings.POSTGRES_DB}"
+SQLALCHEMY_DATABASE_URL = database_url(settings.POSTGRES_HOSTNAME, settings.DATABASE_PORT)
+
+#Create the async DB engine of the primary, used for every write.
+engine = new_engine(SQLALCHEMY_DATABASE_URL, 'write', settings.DB_POOL_SIZE, settings.DB_MAX_OVERFLOW)
 
-#Create a DB engine from the DB URL
-engine = create_engine(
-    SQLALCHEMY_DATABASE_URL
-)
+#Create an engine for each read replica, or a separate one on the primary when there are none.
+read_engines = [ new_engine(database_url(host, port), f'read{index}', settings.DB_READ_POOL_SIZE, settings.DB_READ_MAX_OVERFLOW)
+                 for index, (host, port) in enumerate(read_replicas() or [ (settings.POSTGRES_HOSTNAME, settings.DATABASE_PORT) ]) ]
 
-#Create the local DB session from the DB engine.
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+#Create the local DB sessions from the DB engines, the read ones taken round-robin.
+SessionLocal = async_sessionmaker(engine, autoflush=False, expire_on_commit=False)
+ReadSessions = [ async_sessionmaker(read_engine, autoflush=False, expire_on_commit=False) for read_engine in read_engines ]
+next_read_session = itertools.cycle(ReadSessions).__next__
 Base = declarative_base()
 
 #Use this method to get the current DB Session when available.
-def get_db():
-    db = SessionLocal()
-    try:
+async def get_db():
+    async with SessionLocal() as db:
         yield db
-    finally:
-        db.close()
 
+#Use this method to get a DB Session for reads, on the next read replica unless the client is pinned to the primary.
+async def get_read_db(request: Request):
+    sessionmaker = SessionLocal if pinned_to_primary(request) else next_read_session()
+    async with sessionmaker() as db:
+        yield db
+
+# Helper function to tell whether a client wrote recently enough to read from the primary.
+def pinned_to_primary(request):
+    try:
+        return float(request.cookies.get(PRIMARY_COOKIE, 0)) > time.time()
+    except ValueError:
+        return False
+
+# Disposes of the connections of every engine.
+async def dispose():
+    for disposed in [ engine ] + read_engines:
+        await disposed.dispose()
+
+#Use this method to get the asyncpg connection behind a session, for COPY and other driver features.
+async def get_driver_connection(db):
+    connection = await db.connection()
+    #The asyncpg adapter only sends BEGIN along the first statement, so start the transaction before using the driver directly.
+    await connection.exec_driver_sql("SELECT 1")
+    raw = await connection.get_raw_connection()
+    return raw.driver_connection
+
+#Pins the clients to the primary for DB_READ_YOUR_WRITES seconds after every successful write.
+"""
+    The pin is a cookie holding the time it ends, so it holds whatever API process answers the
+    client's next reads. Clients that don't keep cookies only read from the replicas.
+"""
+class ReadYourWritesMiddleware:
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http' or scope['method'] in SAFE_METHODS:
+            return await self.app(scope, receive, send)
+
+        async def send_pinned(message):
+            if message['type'] == 'http.response.start' and message['status'] < 400:
+                window = settings.DB_READ_YOUR_WRITES
+                cookie = f"{PRIMARY_COOKIE}={time.time() + window:.3f}; Max-Age={math.ceil(window)}; Path=/; HttpOnly; SameSite=Lax"
+                message = dict(message, headers=list(message['headers']) + [ (b'set-cookie', cookie.encode('latin-1')) ])
+            await send(message)
+
+        await self.app(scope, receive, send_pinned)
@@ -0,0 +1,46 @@
+import hashlib
+import numpy as np
+from . import parsing
+
+"""
+    This file defines the content hash identifying every trip, used to store each trip only once.
+    The hash is the MD5 of the region, the hex EWKB of both points, the datetime and the datasource,
+    so a trip ingested again by a retried upload collides with the stored one on the unique index
+    of the trips and is skipped by ON CONFLICT DO NOTHING.
+    The migration adding the hashes computes the same value in SQL for the trips already stored:
+        decode(md5(concat_ws(E'\\x1f', region, upper(encode(ST_AsEWKB(origin_coord, 'NDR'), 'hex')),
+                   upper(encode(ST_AsEWKB(destination_coord, 'NDR'), 'hex')), to_char(datetime, 'YYYY-MM-DD HH24:MI:SS'),
+                   datasource)), 'hex')
+"""
+
+#Separates the fields hashed, a control character no region or datasource holds.
+SEPARATOR = '\x1f'
+
+# Computes the content hash of the given trips of a parsed batch, along their points as hex EWKB.
+"""
+    Returns a list with the hash of every trip, None for the ones not given, and the hex EWKB of the
+    origins and destinations of the given trips, in their order, so they can be copied to the DB too.
+"""
+def content_hashes(parsed, indexes):
+    origins = parsing.ewkb_points(parsed.origin[indexes])
+    destinations = parsing.ewkb_points(parsed.destination[indexes])
+    datetimes = np.char.replace(np.datetime_as_string(parsed.datetime[indexes], unit='s'), 'T', ' ').tolist()
+    hashes = [ None ] * len(parsed)
+    for index, region, origin, destination, dt, datasource in zip(indexes, parsed.region[indexes].tolist(), origins, destinations,
+                                                                  datetimes, parsed.datasource[indexes].tolist()):
+        hashes[index] = hashlib.md5(SEPARATOR.join((region, origin, destination, dt, datasource)).encode()).digest()
+    return hashes, origins, destinations
+
+# Returns the given indexes without the ones repeating the hash of an earlier one.
+def first_occurrences(hashes, indexes):
+    seen = set()
+    unique = []
+    for index in indexes:
+        if hashes[index] not in seen:
+            seen.add(hashes[index])
+            unique.append(index)
+    return unique
+
+# Formats a hash as the bytea input the DB reads from a CSV COPY.
+def bytea_text(value):
+    return '\\x' + value.hex()
@@ -0,0 +1,60 @@
+from shapely import wkt
+from shapely.errors import ShapelyError
+from sqlalchemy import select
+from sqlalchemy.sql import func
+from . import models
+
+"""
+    This file defines the filters shared by the trip search endpoints.
+    Every filter is written so it can be answered from an index: plain equality on the region and
+    datasource, half-open ranges on the datetime and && against an envelope for the coordinates.
+"""
+
+# Parses a bounding box given as "min_x,min_y,max_x,max_y".
+def parse_bbox(value):
+    try:
+        min_x, min_y, max_x, max_y = [ float(coord) for coord in value.split(',') ]
+    except ValueError:
+        raise ValueError(f"Invalid bounding box: {value}. Expected min_x,min_y,max_x,max_y")
+    if min_x > max_x or min_y > max_y:
+        raise ValueError(f"Invalid bounding box: {value}. The minimum coordinates must not exceed the maximum ones")
+    return min_x, min_y, max_x, max_y
+
+# Parses a point given as WKT, like "POINT(x y)", into its coordinates.
+def parse_point(value):
+    try:
+        point = wkt.loads(value)
+    except ShapelyError:
+        point = None
+    if point is None or point.geom_type != 'Point' or point.is_empty:
+        raise ValueError(f"Invalid WKT point: {value}")
+    return point.x, point.y
+
+# Returns the bounding box with the given points as opposite corners, in any order.
+def corners_bbox(first, second):
+    return min(first[0], second[0]), min(first[1], second[1]), max(first[0], second[0]), max(first[1], second[1])
+
+# Returns the envelope for a bounding box, to be compared with the && index operator.
+def envelope(bbox):
+    return func.ST_MakeEnvelope(*bbox, 4326)
+
+# Builds the where clauses for any combination of the trip filters.
+def trip_filters(region=None, datasource=None, start=None, end=None, origin_bbox=None, destination_bbox=None):
+    clauses = []
+    if region is not None:
+        clauses.append(models.Trip.region == region)
+    if datasource is not None:
+        clauses.append(models.Trip.datasource == datasource)
+    if start is not None:
+        clauses.append(models.Trip.datetime >= start)
+    if end is not None:
+        clauses.append(models.Trip.datetime < end)
+    if origin_bbox is not None:
+        clauses.append(models.Trip.origin_coord.intersects(envelope(origin_bbox)))
+    if destination_bbox is not None:
+        clauses.append(models.Trip.destination_coord.intersects(envelope(destination_bbox)))
+    return clauses
+
+# Returns a query counting the trips matching any combination of the trip filters.
+def count_trips(**criteria):
+    return select(func.count()).select_from(models.Trip).where(*trip_filters(**criteria))
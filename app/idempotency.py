@@ -0,0 +1,47 @@
+from datetime import datetime, timedelta
+from sqlalchemy import select, update, delete
+from sqlalchemy.dialects.postgresql import insert
+from .config import settings
+from . import models
+
+"""
+    This file defines the ledger of the requests sent with an Idempotency-Key header.
+    The first request with a key claims it in its own transaction and records its response before
+    committing, so a retry with the same key gets that response back without ingesting anything
+    again. A retry arriving while the first request runs waits on the claimed key until it commits,
+    and claims the key itself if the first request rolled back. Keys expire after IDEMPOTENCY_TTL.
+"""
+
+#Longest key accepted.
+MAX_KEY_LENGTH = 255
+
+# Returns the datetime before which the keys are expired.
+def expiry():
+    return datetime.utcnow() - timedelta(seconds=settings.IDEMPOTENCY_TTL)
+
+# Claims a key for a request to an endpoint, returning None when it was free or the stored key when it was already used.
+"""
+    Expired keys are claimed again. The claim is only visible to other requests once the caller commits.
+"""
+async def claim(db, key, endpoint):
+    query = insert(models.IdempotencyKey).values(key=key, endpoint=endpoint, created_at=datetime.utcnow())
+    query = query.on_conflict_do_update(
+        index_elements=[models.IdempotencyKey.key],
+        set_={"endpoint" : query.excluded.endpoint, "created_at" : query.excluded.created_at, "status_code" : None, "response" : None},
+        where=models.IdempotencyKey.created_at < expiry()
+        ).returning(models.IdempotencyKey.key)
+    if (await db.execute(query)).first() is not None:
+        return None
+    return (await db.execute(select(models.IdempotencyKey).where(models.IdempotencyKey.key == key))).scalar_one()
+
+# Records the response given to the request that claimed a key.
+async def record(db, key, status_code, response):
+    await db.execute(update(models.IdempotencyKey).where(models.IdempotencyKey.key == key).values(status_code=status_code, response=response))
+
+# Releases a claimed key, so a retry is processed again.
+async def forget(db, key):
+    await db.execute(delete(models.IdempotencyKey).where(models.IdempotencyKey.key == key))
+
+# Deletes the expired keys, returning their amount.
+async def purge(db):
+    return (await db.execute(delete(models.IdempotencyKey).where(models.IdempotencyKey.created_at < expiry()))).rowcount
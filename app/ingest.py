@@ -0,0 +1,298 @@
+import codecs
+import csv
+from types import SimpleNamespace
+import asyncpg
+import numpy as np
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.exc import DBAPIError
+from starlette.concurrency import run_in_threadpool
+from .config import settings
+from .database import get_driver_connection
+from . import models, serializers, parsing, similarity, rollups, versions, analytics, dedupe
+
+"""
+    This file defines the ingest paths used to load trips into the DB.
+"""
+
+#Columns expected in the uploaded CSV files, in the order they are copied to the DB.
+TRIP_COLUMNS = ('region', 'origin_coord', 'destination_coord', 'datetime', 'datasource')
+
+#Unique index every trip is checked against, see app/dedupe.py.
+CONFLICT_COLUMNS = ('content_hash', 'datetime')
+
+#Multi-row insert skipping the trips already stored, returning everything needed to answer with the stored trips.
+INSERT_TRIPS = (insert(models.Trip.__table__)
+                .on_conflict_do_nothing(index_elements=CONFLICT_COLUMNS)
+                .returning(*serializers.TRIP_RESPONSE_COLUMNS, models.Trip.content_hash))
+
+#Columns sent on each COPY, the points go as hex EWKB for the server to read without parsing any WKT.
+COPY_COLUMNS = ('region', 'origin_coord', 'destination_coord', 'datetime', 'datasource', 'similarity_group', 'content_hash')
+
+#Temporary table each COPY is staged in, dropped when the transaction ends.
+STAGING_TABLE = 'trips_staging'
+CREATE_STAGING = f"""
+    CREATE TEMPORARY TABLE IF NOT EXISTS {STAGING_TABLE} (
+        region varchar, origin_coord geometry(POINT, 4326), destination_coord geometry(POINT, 4326),
+        datetime timestamp, datasource varchar, similarity_group varchar, content_hash bytea
+    ) ON COMMIT DROP
+"""
+
+#Moves the staged trips to the trips table, skipping the ones already stored.
+INSERT_STAGED = f"""
+    INSERT INTO trips ({', '.join(COPY_COLUMNS)})
+    SELECT {', '.join(COPY_COLUMNS)} FROM {STAGING_TABLE}
+    ON CONFLICT ({', '.join(CONFLICT_COLUMNS)}) DO NOTHING
+    RETURNING id, content_hash
+"""
+
+class IngestError(Exception):
+    pass
+
+class IngestResult:
+    def __init__(self, position="line"):
+        self.position = position
+        self.ingested = 0
+        self.rejected = 0
+        #Valid trips skipped because they were already stored, or repeated earlier in the same batch.
+        self.duplicates = 0
+        self.errors = []
+        self.trips = []
+
+    def reject(self, position, error):
+        self.rejected += 1
+        #Only keep a bounded amount of errors so memory stays flat for broken files.
+        if len(self.errors) < settings.INGEST_MAX_REPORTED_ERRORS:
+            self.errors.append({self.position : position, "error" : error})
+
+    # Rejects the invalid rows of a parsed batch, mapping their indexes to the given positions.
+    def reject_parsed(self, parsed, positions):
+        for index in sorted(parsed.errors):
+            self.reject(positions[index], parsed.errors[index])
+
+# Reads the rows of an uploaded CSV file in blocks of INGEST_READ_SIZE bytes.
+"""
+    Yields the line number and values of each row. Every block is decoded and cut on its last
+    complete line, so quoted values spanning several lines are only supported within a block.
+"""
+async def read_csv_rows(file):
+    decoder = codecs.getincrementaldecoder('utf-8')()
+    pending = ''
+    line_num = 0
+    while True:
+        block = await file.read(settings.INGEST_READ_SIZE)
+        lines = (pending + decoder.decode(block, final=not block)).split('\n')
+        pending = lines.pop()
+        lines = [ line + '\n' for line in lines ]
+        if not block:
+            lines.append(pending)
+        reader = csv.reader(lines)
+        for values in reader:
+            yield line_num + reader.line_num, values
+        line_num += len(lines)
+        if not block:
+            return
+
+# Streams a CSV file into the trips table using COPY ... FROM STDIN.
+"""
+    The file is read in blocks and flushed to PostGIS every INGEST_CHUNK_SIZE rows, so neither
+    the whole file nor any ORM object is ever held in memory. Each chunk goes through the batch
+    parsing stage, and the points are sent as hex EWKB from parsing.ewkb_points, read by the server
+    without parsing any WKT.
+    The optional progress coroutine is awaited with the result after every chunk.
+    The caller is responsible for committing the session.
+"""
+async def copy_csv_trips(db, file, progress=None):
+    rows = read_csv_rows(file)
+    header = None
+    async for line, values in rows:
+        header = values
+        break
+    positions = header_positions(header)
+
+    connection = await get_driver_connection(db)
+    result = IngestResult()
+    lines = []
+    columns = [ [] for column in TRIP_COLUMNS ]
+    async for line, values in rows:
+        if not values:
+            continue
+        if len(values) != len(header):
+            result.reject(line, f"Expected {len(header)} fields, found {len(values)}")
+            continue
+        lines.append(line)
+        for column, position in zip(columns, positions):
+            column.append(values[position])
+        if len(lines) >= settings.INGEST_CHUNK_SIZE:
+            await copy_chunk(db, connection, lines, columns, result)
+            lines = []
+            columns = [ [] for column in TRIP_COLUMNS ]
+            if progress is not None:
+                await progress(result)
+    if lines:
+        await copy_chunk(db, connection, lines, columns, result)
+    return result
+
+# Returns the position in the header of each of the TRIP_COLUMNS, rejecting files missing any.
+def header_positions(header):
+    if not header:
+        raise IngestError("The uploaded file is empty")
+    missing = [ column for column in TRIP_COLUMNS if column not in header ]
+    if missing:
+        raise IngestError(f"Missing columns in the uploaded file: {', '.join(missing)}")
+    return [ header.index(column) for column in TRIP_COLUMNS ]
+
+# Parses a chunk of rows and sends the valid ones to the DB in a single COPY.
+"""
+    The parsing takes a few hundred milliseconds for 10k rows, so it runs in the threadpool to keep
+    the event loop serving the other requests.
+"""
+async def copy_chunk(db, connection, lines, columns, result):
+    prepared = await run_in_threadpool(prepare_chunk, columns)
+    result.reject_parsed(prepared.parsed, lines)
+    ingested = await write_chunk(db, connection, prepared, f"Rows between lines {lines[0]} and {lines[-1]}")
+    result.ingested += ingested
+    result.duplicates += int(prepared.parsed.valid.sum()) - ingested
+
+# Parses a chunk of rows given as columns and writes the valid ones as the CSV sent with COPY.
+"""
+    Only does CPU work, so it can run in another process.
+"""
+def prepare_chunk(columns):
+    return prepare_parsed(parsing.parse_trips(*columns))
+
+#Parsed trips ready to be copied: their similarity keys and content hashes, the indexes of the valid trips
+#not repeated earlier in the chunk, and the CSV lines of those trips.
+class PreparedChunk:
+    def __init__(self, parsed, keys, hashes, indexes, rows):
+        self.parsed = parsed
+        self.keys = keys
+        self.hashes = hashes
+        self.indexes = indexes
+        self.rows = rows
+
+# Computes the similarity keys and content hashes of already parsed trips and writes the valid ones as the CSV sent with COPY.
+def prepare_parsed(parsed):
+    keys = similarity.similarity_keys(parsed.origin, parsed.destination, parsed.datetime)
+    valid = np.flatnonzero(parsed.valid).tolist()
+    hashes, origins, destinations = dedupe.content_hashes(parsed, valid)
+    indexes = dedupe.first_occurrences(hashes, valid)
+    #The hashes come along their points, keep only the ones of the trips left.
+    kept = set(indexes)
+    rows = []
+    #The writer writes each row in a single call, so every line is kept on its own.
+    writer = csv.writer(SimpleNamespace(write=rows.append))
+    for index, region, origin, destination, dt, datasource in zip(valid, parsed.region[valid].tolist(), origins, destinations,
+                                                                  parsed.datetime[valid].tolist(), parsed.datasource[valid].tolist()):
+        if index in kept:
+            writer.writerow((region, origin, destination, dt, datasource, keys[index], dedupe.bytea_text(hashes[index])))
+    return PreparedChunk(parsed, keys, hashes, indexes, rows)
+
+# Copies a prepared chunk to the DB and updates everything derived from the trips that were new, returning their amount.
+"""
+    The chunk is copied to a temporary table and moved to the trips with INSERT ... ON CONFLICT DO
+    NOTHING, since COPY can't skip the trips already stored. Concurrent ingests of the same trips wait
+    for each other on the unique index, so each trip is only stored once.
+"""
+async def write_chunk(db, connection, prepared, description):
+    try:
+        await connection.execute(CREATE_STAGING)
+        await connection.copy_to_table(STAGING_TABLE, source=''.join(prepared.rows).encode(), columns=COPY_COLUMNS, format='csv')
+        stored = await connection.fetch(INSERT_STAGED)
+        await connection.execute(f"TRUNCATE {STAGING_TABLE}")
+    except asyncpg.PostgresError as e:
+        raise IngestError(f"{description} could not be copied: {e}")
+    positions = { prepared.hashes[index] : index for index in prepared.indexes }
+    #Sorted by index, the IDs follow the order the staged trips were inserted in.
+    inserted = sorted((positions[bytes(record['content_hash'])], record['id']) for record in stored)
+    indexes = [ index for index, id in inserted ]
+    await record_side_effects(db, prepared.parsed, prepared.keys, indexes)
+    analytics.stage(db, [ id for index, id in inserted ], prepared.parsed, prepared.keys, indexes)
+    return len(indexes)
+
+# Inserts a list of trips with one multi-row INSERT ... RETURNING per batch, skipping the ones already stored.
+"""
+    Every batch runs inside the caller's transaction, so the generated IDs are returned without
+    committing or refreshing each trip. By default any invalid trip rejects the whole list and
+    nothing is inserted; with partial set the valid trips are inserted and the failing ones are
+    reported by their index in the list. Trips already stored, or repeated in the list, are answered
+    with the stored trip and counted as duplicates. The caller is responsible for committing the session.
+"""
+async def insert_trips(db, trips, partial=False):
+    result = IngestResult(position="index")
+    parsed = parsing.parse_trips(*[ [ getattr(trip, column) for trip in trips ] for column in TRIP_COLUMNS ])
+    result.reject_parsed(parsed, range(len(parsed)))
+    if result.rejected and not partial:
+        return result
+    keys = similarity.similarity_keys(parsed.origin, parsed.destination, parsed.datetime)
+    valid = np.flatnonzero(parsed.valid).tolist()
+    hashes = dedupe.content_hashes(parsed, valid)[0]
+    unique = set(dedupe.first_occurrences(hashes, valid))
+    valid = [ (index, insert_params(*row, keys[index], hashes[index])) for index, *row in parsed.valid_rows() if index in unique ]
+
+    #Rows of the stored trips by content hash, the ones inserted here and the ones found already stored.
+    inserted = {}
+    found = {}
+    failed = set()
+    for start in range(0, len(valid), settings.INSERT_BATCH_SIZE):
+        batch = valid[start:start + settings.INSERT_BATCH_SIZE]
+        if partial:
+            rows = await insert_batch_partial(db, batch, result, failed)
+        else:
+            try:
+                rows = (await db.execute(INSERT_TRIPS, [ params for index, params in batch ])).all()
+            except DBAPIError as e:
+                raise IngestError(f"Trips could not be inserted: {e.orig}")
+        inserted.update((row.content_hash, row) for row in rows)
+        existing = [ params['content_hash'] for index, params in batch if params['content_hash'] not in inserted and index not in failed ]
+        if existing:
+            query = serializers.select_trips().add_columns(models.Trip.content_hash).where(models.Trip.content_hash.in_(existing))
+            found.update((row.content_hash, row) for row in await db.execute(query))
+    indexes = sorted(index for index, params in valid if params['content_hash'] in inserted)
+    await record_side_effects(db, parsed, keys, indexes)
+    analytics.stage(db, [ inserted[hashes[index]].id for index in indexes ], parsed, keys, indexes)
+    result.ingested = len(indexes)
+    result.duplicates = int(parsed.valid.sum()) - len(failed) - len(indexes)
+    #In the order of the list, each stored trip once.
+    rows = [ inserted.get(params['content_hash']) or found.get(params['content_hash']) for index, params in valid ]
+    result.trips = [ serializers.trip_row_to_dict(row) for row in rows if row is not None ]
+    return result
+
+# Inserts a batch inside a savepoint, retrying trip by trip to isolate the failing ones.
+"""
+    Returns the rows of the trips that were inserted, and adds the index of the failing ones to failed.
+"""
+async def insert_batch_partial(db, batch, result, failed):
+    try:
+        async with db.begin_nested():
+            return (await db.execute(INSERT_TRIPS, [ params for index, params in batch ])).all()
+    except DBAPIError:
+        pass
+    inserted = []
+    for index, params in batch:
+        try:
+            async with db.begin_nested():
+                inserted.extend((await db.execute(INSERT_TRIPS, [params])).all())
+        except DBAPIError as e:
+            failed.add(index)
+            result.reject(index, str(e.orig).strip())
+    return inserted
+
+# Updates everything derived from the trips with the given trips of a parsed batch.
+async def record_side_effects(db, parsed, keys, indexes):
+    if not len(indexes):
+        return
+    group_indexes = await similarity.record_groups(db, parsed, keys, indexes)
+    await rollups.record(db, parsed, indexes, group_indexes)
+    await versions.bump(db, versions.trip_scopes(parsed.region[indexes].tolist()))
+
+# Builds the insert parameters for a parsed trip.
+def insert_params(region, origin, destination, dt, datasource, similarity_group, content_hash):
+    return {
+        "region" : region,
+        "origin_coord" : parsing.ewkt_point(origin),
+        "destination_coord" : parsing.ewkt_point(destination),
+        "datetime" : dt,
+        "datasource" : datasource,
+        "similarity_group" : similarity_group,
+        "content_hash" : content_hash
+        }
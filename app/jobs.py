@@ -0,0 +1,304 @@
+import asyncio
+import logging
+import os
+import shutil
+import socket
+import tempfile
+import time
+from datetime import datetime
+import httpx
+import orjson
+from sqlalchemy import select, update
+from starlette.concurrency import run_in_threadpool
+from starlette.datastructures import UploadFile
+from .config import settings
+from .database import SessionLocal
+from . import models, ingest, parallel, idempotency
+
+"""
+    This file defines the background ingest jobs.
+    Uploaded files are spooled to disk and queued, and a bounded pool of workers running on the
+    event loop ingests them one job per worker. The status of each job is kept in the ingest_jobs
+    table, so it can be polled from any API process, and a webhook is sent on completion to the
+    callback URL registered for the job. Jobs still queued when the API stops are queued again when
+    it starts on the same node.
+"""
+
+logger = logging.getLogger(__name__)
+
+#Statuses of a job.
+QUEUED = 'queued'
+RUNNING = 'running'
+SUCCEEDED = 'succeeded'
+FAILED = 'failed'
+
+#Statuses of a job's webhook.
+PENDING = 'pending'
+DELIVERED = 'delivered'
+
+#Prefix of the spooled files, telling the ones left by a crash apart from other temporary files.
+SPOOL_PREFIX = 'ingest_job_'
+
+#Seconds a spooled file not referenced by any job is kept on startup, since it may belong to a job another worker is creating.
+ORPHAN_MIN_AGE = 3600
+
+class JobQueueFull(Exception):
+    pass
+
+class JobRunner:
+    def __init__(self, workers, size):
+        self.workers = workers
+        self.size = size
+        self.queue = None
+        self.tasks = []
+        self.webhooks = set()
+
+    # Starts the workers, must be called from the running event loop.
+    def start(self):
+        self.queue = asyncio.Queue(self.size)
+        self.tasks = [ asyncio.create_task(self.work()) for worker in range(self.workers) ]
+
+    # Cancels the workers and pending webhooks, running jobs are marked as failed.
+    async def stop(self):
+        tasks = self.tasks + list(self.webhooks)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self.tasks = []
+        parallel.shutdown_pool()
+
+    def full(self):
+        return self.queue is None or self.queue.full()
+
+    def submit(self, job_id, path):
+        if self.queue is None:
+            raise JobQueueFull("The ingest workers are not running")
+        try:
+            self.queue.put_nowait((job_id, path))
+        except asyncio.QueueFull:
+            raise JobQueueFull("Too many ingest jobs waiting, try again later")
+
+    # Sends the webhook of a job in its own task, so retries don't hold a worker.
+    def notify(self, job_id):
+        task = asyncio.create_task(deliver_webhook(job_id))
+        self.webhooks.add(task)
+        task.add_done_callback(self.webhooks.discard)
+
+    async def work(self):
+        while True:
+            job_id, path = await self.queue.get()
+            try:
+                #The webhook reads the job again, so it sees a callback URL registered while the job ran.
+                if await run_job(job_id, path) is not None:
+                    self.notify(job_id)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception("Ingest job %s could not be run", job_id)
+            finally:
+                self.queue.task_done()
+
+runner = JobRunner(settings.JOB_WORKERS, settings.JOB_QUEUE_SIZE)
+
+# Spools an uploaded file to disk so it outlives the request, returning its path.
+"""
+    The suffix of the spooled file tells the job its format.
+"""
+async def spool(file, suffix='.csv'):
+    fd, path = tempfile.mkstemp(suffix=suffix, prefix=SPOOL_PREFIX, dir=settings.JOB_SPOOL_DIR)
+    try:
+        with os.fdopen(fd, 'wb') as spooled:
+            await file.seek(0)
+            await run_in_threadpool(shutil.copyfileobj, file.file, spooled, settings.INGEST_READ_SIZE)
+    except BaseException:
+        os.remove(path)
+        raise
+    return path
+
+# Creates a job for an uploaded file and queues it.
+"""
+    The format is 'csv' or one of the columnar formats. Raises JobQueueFull when no more jobs can
+    wait, before spooling the file. When the request claimed an Idempotency-Key, the accepted job is
+    recorded as its response in the same transaction as the job, and released if the job can't be queued.
+"""
+async def create_job(db, file, callback_url=None, format='csv', idempotency_key=None):
+    if runner.full():
+        raise JobQueueFull("Too many ingest jobs waiting, try again later")
+    path = await spool(file, f".{format}")
+    job = models.IngestJob(status=QUEUED, filename=file.filename, rows_done=0, rejected=0, duplicates=0, errors=[],
+                           created_at=datetime.utcnow(), callback_url=callback_url, webhook_attempts=0,
+                           spool_host=socket.gethostname(), spool_path=path)
+    try:
+        db.add(job)
+        if idempotency_key is not None:
+            await db.flush()
+            await idempotency.record(db, idempotency_key, 202, accepted(job))
+        await db.commit()
+        runner.submit(job.id, path)
+    except JobQueueFull as e:
+        os.remove(path)
+        if idempotency_key is not None:
+            await idempotency.forget(db, idempotency_key)
+        await finish(db, job, FAILED, str(e))
+        raise
+    except BaseException:
+        os.remove(path)
+        raise
+    return job
+
+# Returns the response to the request that queued a job.
+def accepted(job):
+    return {'status': 'accepted', 'job_id': job.id, 'job_url': f"/api/jobs/{job.id}"}
+
+# Ingests the spooled file of a job, recording its progress after every chunk.
+"""
+    The job is claimed by moving it from queued to running, so a job queued by several workers runs
+    once, and None is returned when it was already claimed.
+    When INGEST_PROCESSES is 1 the trips are copied in one transaction, so a failed job stores no
+    trips. With more processes the file is ingested by app/parallel.py, committing every range on
+    its own. Parquet and Arrow files are always imported in one transaction by app/columnar.py.
+    The progress is committed on a separate session, visible while the job runs.
+"""
+async def run_job(job_id, path):
+    async with SessionLocal() as status_db:
+        claimed = await status_db.execute(update(models.IngestJob)
+                                          .where(models.IngestJob.id == job_id, models.IngestJob.status == QUEUED)
+                                          .values(status=RUNNING, started_at=datetime.utcnow()))
+        await status_db.commit()
+        if not claimed.rowcount:
+            return None
+        job = await status_db.get(models.IngestJob, job_id)
+
+        async def progress(result):
+            job.rows_done = result.ingested
+            job.rejected = result.rejected
+            job.duplicates = result.duplicates
+            await status_db.commit()
+
+        format = os.path.splitext(path)[1][1:]
+        try:
+            if format != 'csv':
+                #Imported by the first columnar job, so the API processes start without pyarrow.
+                from . import columnar
+                async with SessionLocal() as db:
+                    result = await columnar.import_file(db, path, format, progress)
+                    await db.commit()
+            elif settings.INGEST_PROCESSES > 1:
+                result = await parallel.copy_csv_file(path, progress=progress, executor=parallel.get_pool())
+            else:
+                async with SessionLocal() as db:
+                    with open(path, 'rb') as file:
+                        result = await ingest.copy_csv_trips(db, UploadFile(file, filename=job.filename), progress)
+                    await db.commit()
+            job.rows_done = result.ingested
+            job.rejected = result.rejected
+            job.duplicates = result.duplicates
+            job.errors = result.errors
+            await finish(status_db, job, SUCCEEDED)
+        except ingest.IngestError as e:
+            await finish(status_db, job, FAILED, str(e))
+        except asyncio.CancelledError:
+            await finish(status_db, job, FAILED, "The job was interrupted by a shutdown")
+            raise
+        except Exception as e:
+            logger.exception("Ingest job %s failed", job_id)
+            await finish(status_db, job, FAILED, f"Unexpected error: {e}")
+        finally:
+            os.remove(path)
+    return job
+
+# Queues again the jobs spooled on this node and still queued, and removes the spooled files left by a crash.
+"""
+    Called on startup. Queued jobs whose file is gone are marked as failed, and the ones not fitting
+    in the queue wait for the next start. Every worker of the node queues the same jobs, each runs once.
+"""
+async def recover():
+    async with SessionLocal() as db:
+        query = select(models.IngestJob.id, models.IngestJob.status, models.IngestJob.spool_path).where(
+            models.IngestJob.spool_host == socket.gethostname(), models.IngestJob.status.in_((QUEUED, RUNNING)))
+        spooled = (await db.execute(query)).all()
+        for job_id, job_status, path in spooled:
+            if job_status != QUEUED:
+                continue
+            if not os.path.exists(path):
+                #Only while still queued, a worker may have run it since.
+                await db.execute(update(models.IngestJob)
+                                 .where(models.IngestJob.id == job_id, models.IngestJob.status == QUEUED)
+                                 .values(status=FAILED, detail="The spooled file was lost in a restart", finished_at=datetime.utcnow()))
+                continue
+            try:
+                runner.submit(job_id, path)
+            except JobQueueFull:
+                logger.warning("Ingest job %s could not be queued again, the queue is full", job_id)
+        await db.commit()
+    referenced = { os.path.abspath(path) for job_id, job_status, path in spooled }
+    directory = settings.JOB_SPOOL_DIR or tempfile.gettempdir()
+    for name in os.listdir(directory):
+        path = os.path.abspath(os.path.join(directory, name))
+        if name.startswith(SPOOL_PREFIX) and path not in referenced:
+            try:
+                if os.path.getmtime(path) < time.time() - ORPHAN_MIN_AGE:
+                    os.remove(path)
+            except FileNotFoundError:
+                pass
+
+# Helper function to record the end of a job.
+async def finish(db, job, status, detail=None):
+    job.status = status
+    job.detail = detail
+    job.finished_at = datetime.utcnow()
+    await db.commit()
+
+# Converts a job to its API and webhook format.
+def job_dict(job):
+    end = job.finished_at or datetime.utcnow()
+    elapsed = (end - job.started_at).total_seconds() if job.started_at else 0
+    return {
+        "id" : job.id,
+        "status" : job.status,
+        "filename" : job.filename,
+        "rows_done" : job.rows_done,
+        "rejected" : job.rejected,
+        "duplicates" : job.duplicates,
+        "rows_per_second" : job.rows_done / elapsed if elapsed > 0 else 0.0,
+        "errors" : job.errors,
+        "detail" : job.detail,
+        "created_at" : job.created_at,
+        "started_at" : job.started_at,
+        "finished_at" : job.finished_at,
+        "callback_url" : job.callback_url,
+        "webhook_status" : job.webhook_status,
+        "webhook_attempts" : job.webhook_attempts
+        }
+
+# Posts the finished job to its callback URL, retrying with an exponential backoff.
+"""
+    Any response other than a 2xx counts as a failed attempt. The connection to the DB is only
+    held while recording each attempt, never while waiting for the callback or the backoff.
+"""
+async def deliver_webhook(job_id):
+    async with SessionLocal() as db:
+        job = await db.get(models.IngestJob, job_id)
+        if job is None or not job.callback_url:
+            return
+        job.webhook_status = PENDING
+        await db.commit()
+        payload = orjson.dumps(job_dict(job))
+        async with httpx.AsyncClient(timeout=settings.WEBHOOK_TIMEOUT) as client:
+            for attempt in range(settings.WEBHOOK_MAX_ATTEMPTS):
+                if attempt:
+                    await asyncio.sleep(settings.WEBHOOK_BACKOFF * 2 ** (attempt - 1))
+                job.webhook_attempts += 1
+                try:
+                    response = await client.post(job.callback_url, content=payload, headers={'Content-Type': 'application/json'})
+                    delivered = response.is_success
+                except httpx.HTTPError as e:
+                    logger.warning("Webhook of ingest job %s failed: %s", job_id, e)
+                    delivered = False
+                if delivered:
+                    job.webhook_status = DELIVERED
+                    await db.commit()
+                    return
+                await db.commit()
+        job.webhook_status = FAILED
+        await db.commit()
@@ -1,7 +1,10 @@
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
 from app.config import settings
-from app.routers import trip
+from app.routers import trip, job, webhook, cache
+from app.jobs import runner
+from app import analytics, metrics, partitions, compression, plots, database, jobs
+from fastapi.responses import PlainTextResponse
 from pydantic import BaseConfig
 
 #Create the FastAPI app
@@ -22,14 +25,71 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+#Accept gzip and zstd request bodies, and compress the responses when enabled.
+app.add_middleware(compression.DecompressionMiddleware)
+if settings.COMPRESSION_ENABLED:
+    app.add_middleware(compression.CompressionMiddleware)
+
+#Pin the clients that write to the primary for a while, when reads go to replicas.
+if database.read_replicas() and settings.DB_READ_YOUR_WRITES > 0:
+    app.add_middleware(database.ReadYourWritesMiddleware)
+
+#Record the latency of every request when the metrics are enabled.
+if settings.METRICS_ENABLED:
+    app.add_middleware(metrics.MetricsMiddleware)
+
 #Include the router for the trips endpoints.
 app.include_router(trip.router, tags=['Trips'], prefix='/api/trips')
 
+#Include the router for the background ingest jobs.
+app.include_router(job.router, tags=['Jobs'], prefix='/api/jobs')
+
 #Include the router for the webhooks for async notifications.
-#app.include_router(webhook.router, tags=['Webhooks'], prefix='/api/webhooks')
+app.include_router(webhook.router, tags=['Webhooks'], prefix='/api/webhooks')
+
+#Include the router for the response cache statistics.
+app.include_router(cache.router, tags=['Cache'], prefix='/api/cache')
+
+#Start and stop the workers of the background ingest jobs along the app.
+@app.on_event('startup')
+async def start_jobs():
+    runner.start()
+    await jobs.recover()
+
+#Load the in-memory analytics store when enabled.
+@app.on_event('startup')
+async def start_analytics():
+    if settings.ANALYTICS_ENABLED:
+        await analytics.start()
+
+#Create the coming monthly partitions of the trips in the background.
+@app.on_event('startup')
+async def start_partitions():
+    partitions.start()
+
+@app.on_event('shutdown')
+async def stop_jobs():
+    await runner.stop()
+
+@app.on_event('shutdown')
+async def stop_partitions():
+    await partitions.stop()
+
+#Stop the plot processes, spawned on the first plot requested.
+@app.on_event('shutdown')
+async def stop_plots():
+    plots.shutdown_pool()
+
+@app.on_event('shutdown')
+async def stop_engines():
+    await database.dispose()
 
 #Default healthcheck endpoint to test the app is running.
 @app.get('/api/healthchecker')
 def root():
     return {'message': 'Hello World'}
 
+#Metrics of this API process in the Prometheus text format.
+@app.get('/metrics', include_in_schema=False)
+def get_metrics():
+    return PlainTextResponse(metrics.render(), media_type='text/plain; version=0.0.4')
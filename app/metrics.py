@@ -0,0 +1,217 @@
+import asyncio
+import logging
+import re
+import threading
+import time
+from sqlalchemy import event
+from sqlalchemy.pool import AsyncAdaptedQueuePool
+from .config import settings
+
+"""
+    This file defines the instrumentation of the API, exposed at /metrics in the Prometheus text format.
+    A middleware times every request by route, the engine's cursor events time every statement by
+    named query, and the pool reports its connections and how long the sessions wait for one.
+    The metrics are kept in each API process, so every uvicorn worker has to be scraped on its own.
+    When SLOW_QUERY_MS is set, the plans of the statements slower than it are logged, with EXPLAIN
+    ANALYZE for the reads of the query registry and with a plain EXPLAIN for anything else.
+"""
+
+logger = logging.getLogger(__name__)
+
+#Upper bounds in seconds of the histogram buckets, the Prometheus client defaults.
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+#Seconds between two EXPLAIN ANALYZE of the same query, since each one runs the query again.
+SLOW_QUERY_EXPLAIN_INTERVAL = 60
+
+#Commands EXPLAIN accepts.
+EXPLAINABLE = ('SELECT', 'WITH', 'VALUES', 'INSERT', 'UPDATE', 'DELETE')
+
+#Words of the statements that write, lock or advance a sequence, which EXPLAIN ANALYZE would do once more.
+SIDE_EFFECTS = re.compile(r'\b(?:INSERT|UPDATE|DELETE|MERGE|SHARE|LOCK|NEXTVAL|SETVAL|PG_ADVISORY_\w+)\b', re.IGNORECASE)
+
+class Counter:
+    def __init__(self, name, help, labels):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def inc(self, labels, amount=1):
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+    def render(self):
+        lines = [ f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter" ]
+        with self.lock:
+            for labels, value in sorted(self.values.items()):
+                lines.append(f"{self.name}{format_labels(self.labels, labels)} {value}")
+        return lines
+
+class Histogram:
+    def __init__(self, name, help, labels, buckets=BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = buckets
+        #Per labels, the observations falling in each bucket, then their sum and count.
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def observe(self, labels, value):
+        with self.lock:
+            counts = self.values.get(labels)
+            if counts is None:
+                counts = self.values[labels] = [ 0 ] * len(self.buckets) + [ 0.0, 0 ]
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[index] += 1
+                    break
+            counts[-2] += value
+            counts[-1] += 1
+
+    def render(self):
+        lines = [ f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram" ]
+        with self.lock:
+            for labels, counts in sorted(self.values.items()):
+                cumulative = 0
+                for bound, count in zip(self.buckets, counts):
+                    cumulative += count
+                    lines.append(f"{self.name}_bucket{format_labels(self.labels + ('le',), labels + (repr(bound),))} {cumulative}")
+                lines.append(f"{self.name}_bucket{format_labels(self.labels + ('le',), labels + ('+Inf',))} {counts[-1]}")
+                lines.append(f"{self.name}_sum{format_labels(self.labels, labels)} {counts[-2]}")
+                lines.append(f"{self.name}_count{format_labels(self.labels, labels)} {counts[-1]}")
+        return lines
+
+# Helper function to format the labels of a sample, escaping their values.
+def format_labels(names, values):
+    if not names:
+        return ''
+    escaped = [ str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for value in values ]
+    return '{' + ','.join(f'{name}="{value}"' for name, value in zip(names, escaped)) + '}'
+
+REQUESTS = Counter('http_requests_total', 'Requests answered, by method, route and status code.', ('method', 'route', 'status'))
+REQUEST_DURATION = Histogram('http_request_duration_seconds', 'Time until the whole response was sent, by method and route.', ('method', 'route'))
+QUERY_DURATION = Histogram('db_query_duration_seconds', 'Execution time of the statements sent to the DB, by named query or statement type.', ('query',))
+SLOW_QUERIES = Counter('db_slow_queries_total', 'Statements slower than SLOW_QUERY_MS, by named query or statement type.', ('query',))
+POOL_WAIT = Histogram('db_pool_wait_seconds', 'Time spent getting a connection from the pool, connecting included, by engine.', ('engine',))
+
+#Engines whose pools are reported, by name, set by instrument.
+instrumented_engines = {}
+
+#Last time each query was explained, to rate limit the slow query log.
+explained = {}
+
+#Records the requests by the path template of their route, so the path parameters don't blow up the labels.
+"""
+    A plain ASGI middleware instead of an HTTP one, so streamed responses are timed until their
+    last chunk is sent rather than until their headers are.
+"""
+class MetricsMiddleware:
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            return await self.app(scope, receive, send)
+        start = time.perf_counter()
+        status = 500
+
+        async def send_timed(message):
+            nonlocal status
+            if message['type'] == 'http.response.start':
+                status = message['status']
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_timed)
+        finally:
+            route = scope.get('route')
+            labels = (scope['method'], route.path if route is not None else 'unmatched')
+            REQUEST_DURATION.observe(labels, time.perf_counter() - start)
+            REQUESTS.inc(labels + (str(status),))
+
+#Queue pool of the async engines timing how long every checkout waits for a connection, labelled by the pool's logging name.
+class TimedQueuePool(AsyncAdaptedQueuePool):
+    def connect(self):
+        start = time.perf_counter()
+        try:
+            return super().connect()
+        finally:
+            POOL_WAIT.observe((self.logging_name or 'default',), time.perf_counter() - start)
+
+# Registers the cursor events timing every statement of an async engine, and reports its pool under the given name.
+def instrument(engine, name):
+    instrumented_engines[name] = engine
+    event.listen(engine.sync_engine, 'before_cursor_execute', before_cursor_execute)
+    event.listen(engine.sync_engine, 'after_cursor_execute', after_cursor_execute)
+
+def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    context.metrics_start = time.perf_counter()
+
+def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    elapsed = time.perf_counter() - context.metrics_start
+    name = query_name(statement, context)
+    QUERY_DURATION.observe((name,), elapsed)
+    if settings.SLOW_QUERY_MS is not None and elapsed * 1000 >= settings.SLOW_QUERY_MS and not context.execution_options.get('explain'):
+        SLOW_QUERIES.inc((name,))
+        logger.warning("Slow query %s took %.1f ms", name, elapsed * 1000)
+        if not executemany and statement.lstrip().upper().startswith(EXPLAINABLE) and time.monotonic() - explained.get(name, -SLOW_QUERY_EXPLAIN_INTERVAL) >= SLOW_QUERY_EXPLAIN_INTERVAL:
+            explained[name] = time.monotonic()
+            try:
+                analyze = context.execution_options.get('query_name') is not None and is_read(statement)
+                asyncio.get_running_loop().create_task(explain(conn.engine, name, statement, parameters, analyze))
+            except RuntimeError:
+                pass
+
+# Returns the label of a statement: the name given in its execution options, or its SQL command otherwise.
+def query_name(statement, context):
+    name = context.execution_options.get('query_name')
+    if name is None:
+        words = statement.split(None, 1)
+        name = words[0].lower() if words else 'unknown'
+    return name
+
+# Helper function to tell the statements EXPLAIN ANALYZE can run again without writing, locking or using a sequence.
+def is_read(statement):
+    return statement.lstrip().upper().startswith(('SELECT', 'WITH')) and SIDE_EFFECTS.search(statement) is None
+
+# Logs the plan of a slow query on a connection of its own to the same DB.
+"""
+    EXPLAIN ANALYZE runs the query again, so it is only used for the reads tagged with the name of a
+    registry query. Any other statement is planned with a plain EXPLAIN, which doesn't run it.
+"""
+async def explain(sync_engine, name, statement, parameters, analyze=False):
+    try:
+        engine = next(engine for engine in instrumented_engines.values() if engine.sync_engine is sync_engine)
+        async with engine.connect() as connection:
+            connection = await connection.execution_options(explain=True)
+            plan = (await connection.exec_driver_sql(f"EXPLAIN {'(ANALYZE, BUFFERS) ' if analyze else ''}{statement}", parameters)).scalars().all()
+        logger.warning("Plan of the slow query %s:\n%s", name, '\n'.join(plan))
+    except Exception as e:
+        logger.warning("Slow query %s could not be explained: %s", name, e)
+
+# Returns the gauges of the connection pools of the instrumented engines, labelled by engine.
+def pool_lines():
+    gauges = (
+        ('db_pool_size', 'Connections the pool keeps open.', lambda pool: pool.size()),
+        ('db_pool_checked_out', 'Connections currently in use by a session.', lambda pool: pool.checkedout()),
+        ('db_pool_checked_in', 'Open connections waiting in the pool.', lambda pool: pool.checkedin()),
+        ('db_pool_overflow', 'Connections open beyond the pool size, negative while the pool is not full.', lambda pool: pool.overflow())
+        )
+    lines = []
+    if not instrumented_engines:
+        return lines
+    for name, help, value in gauges:
+        lines += [ f"# HELP {name} {help}", f"# TYPE {name} gauge" ]
+        lines += [ f"{name}{format_labels(('engine',), (engine_name,))} {value(engine.sync_engine.pool)}" for engine_name, engine in instrumented_engines.items() ]
+    return lines
+
+# Returns every metric in the Prometheus text format.
+def render():
+    lines = []
+    for metric in (REQUESTS, REQUEST_DURATION, QUERY_DURATION, SLOW_QUERIES, POOL_WAIT):
+        lines += metric.render()
+    lines += pool_lines()
+    return '\n'.join(lines) + '\n'
@@ -1,14 +1,91 @@
 from .database import Base
-from sqlalchemy import Column, Integer, String, DateTime
+from sqlalchemy import Column, Integer, BigInteger, String, DateTime, Index, LargeBinary
+from sqlalchemy.dialects.postgresql import JSONB
 from geoalchemy2 import Geometry
 
 #Defines the Trip class in the ORM.
 class Trip(Base):
     __tablename__ = 'trips'
-    id = Column(Integer, primary_key=True)
+    __table_args__ = (
+        Index('idx_trips_region_datetime', 'region', 'datetime'),
+        Index('idx_trips_datasource', 'datasource'),
+        Index('idx_trips_datetime', 'datetime'),
+        #Nearest trips of a time window, see Queries/similar_trips.sql. Needs the btree_gist extension.
+        Index('idx_trips_origin_coord_datetime', 'origin_coord', 'datetime', postgresql_using='gist'),
+        Index('idx_trips_destination_coord_datetime', 'destination_coord', 'datetime', postgresql_using='gist'),
+        #Stores each trip once, the partition key has to be part of any unique index.
+        Index('uq_trips_content_hash', 'content_hash', 'datetime', unique=True),
+        #Partitioned by month, see app/partitions.py.
+        {'postgresql_partition_by' : 'RANGE (datetime)'},
+    )
+    id = Column(Integer, primary_key=True, autoincrement=True)
     region = Column(String, nullable=False)
     origin_coord = Column(Geometry('POINT', srid=4326), nullable=False)
     destination_coord = Column(Geometry('POINT', srid=4326), nullable=False)
-    datetime = Column(DateTime, nullable=False)
+    #Part of the primary key, as the partition key has to be.
+    datetime = Column(DateTime, primary_key=True)
     datasource = Column(String, nullable=False)
+    similarity_group = Column(String, nullable=True)
+    #MD5 of the trip's fields, see app/dedupe.py.
+    content_hash = Column(LargeBinary, nullable=False)
+
+#Defines the SimilarityGroup class in the ORM, one row per group of similar trips in each region.
+class SimilarityGroup(Base):
+    __tablename__ = 'similarity_groups'
+    __table_args__ = (
+        Index('idx_similarity_groups_region_datetime', 'region', 'datetime'),
+    )
+    similarity_group = Column(String, primary_key=True)
+    region = Column(String, primary_key=True)
+    datetime = Column(DateTime, nullable=False)
+
+
+#Defines the TripRollup class in the ORM, the trip counts for each region, datasource and hour.
+class TripRollup(Base):
+    __tablename__ = 'trip_rollups'
+    region = Column(String, primary_key=True)
+    datasource = Column(String, primary_key=True)
+    hour = Column(DateTime, primary_key=True)
+    trip_count = Column(BigInteger, nullable=False)
+    similar_trips = Column(BigInteger, nullable=False)
+    latest_datetime = Column(DateTime, nullable=False)
+
+#Defines the DataVersion class in the ORM, a counter bumped on every write to invalidate caches.
+class DataVersion(Base):
+    __tablename__ = 'data_versions'
+    scope = Column(String, primary_key=True)
+    version = Column(BigInteger, nullable=False)
+
+#Defines the IngestJob class in the ORM, the status of each CSV file ingested in the background.
+class IngestJob(Base):
+    __tablename__ = 'ingest_jobs'
+    id = Column(Integer, primary_key=True)
+    status = Column(String, nullable=False)
+    filename = Column(String, nullable=True)
+    rows_done = Column(BigInteger, nullable=False, default=0)
+    rejected = Column(BigInteger, nullable=False, default=0)
+    duplicates = Column(BigInteger, nullable=False, default=0)
+    errors = Column(JSONB, nullable=False, default=list)
+    detail = Column(String, nullable=True)
+    created_at = Column(DateTime, nullable=False)
+    started_at = Column(DateTime, nullable=True)
+    finished_at = Column(DateTime, nullable=True)
+    callback_url = Column(String, nullable=True)
+    webhook_status = Column(String, nullable=True)
+    webhook_attempts = Column(Integer, nullable=False, default=0)
+    #Node and path of the spooled file, to queue the job again when the API restarts before running it.
+    spool_host = Column(String, nullable=True)
+    spool_path = Column(String, nullable=True)
 
+#Defines the IdempotencyKey class in the ORM, the response given to each request sent with an Idempotency-Key.
+class IdempotencyKey(Base):
+    __tablename__ = 'idempotency_keys'
+    __table_args__ = (
+        Index('idx_idempotency_keys_created_at', 'created_at'),
+    )
+    key = Column(String, primary_key=True)
+    endpoint = Column(String, nullable=False)
+    #Unset while the request that claimed the key has not committed.
+    status_code = Column(Integer, nullable=True)
+    response = Column(JSONB, nullable=True)
+    created_at = Column(DateTime, nullable=False)
@@ -0,0 +1,155 @@
+import asyncio
+import csv
+import io
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+from .config import settings
+from .database import SessionLocal, get_driver_connection
+from . import ingest
+
+"""
+    This file defines the multi-core ingest of CSV files stored on disk.
+    The file is split on line boundaries in ranges of INGEST_SPLIT_SIZE bytes, each range is read,
+    parsed and turned into COPY data by a pool of processes, and the results are written by several
+    DB connections at once. Unlike the single process ingest, every range is committed on its own,
+    so a failed ingest keeps the ranges written before the failure.
+"""
+
+#Process pool shared by the ingest jobs of the API, created on first use.
+pool = None
+
+class ParsedRange:
+    def __init__(self, lines, rejected, errors, prepared):
+        #Amount of lines in the range, to number the lines of the following ones.
+        self.lines = lines
+        self.rejected = rejected
+        #Rejected rows as (line in the range, error), bounded like IngestResult.
+        self.errors = errors
+        self.prepared = prepared
+
+# Returns the process pool shared by the ingest jobs.
+"""
+    Processes are spawned instead of forked, since the API process runs an event loop and threads.
+"""
+def get_pool():
+    global pool
+    if pool is None:
+        pool = ProcessPoolExecutor(settings.INGEST_PROCESSES, mp_context=multiprocessing.get_context('spawn'))
+    return pool
+
+def shutdown_pool():
+    global pool
+    if pool is not None:
+        pool.shutdown(cancel_futures=True)
+        pool = None
+
+# Reads the header of a CSV file, returning it along the offset of the first row.
+def read_header(path):
+    with open(path, 'rb') as file:
+        line = file.readline()
+        return next(csv.reader([ line.decode('utf-8') ]), []), file.tell()
+
+# Splits a file in ranges of about size bytes, each ending on a line boundary.
+def split_ranges(path, start, size):
+    ranges = []
+    with open(path, 'rb') as file:
+        length = os.fstat(file.fileno()).st_size
+        while start < length:
+            file.seek(start + size)
+            file.readline()
+            end = min(file.tell(), length)
+            ranges.append((start, end))
+            start = end
+    return ranges
+
+# Reads and parses a range of a file, run by the processes of the pool.
+def parse_range(path, start, end, fields, positions):
+    with open(path, 'rb') as file:
+        file.seek(start)
+        text = file.read(end - start).decode('utf-8')
+    lines = []
+    errors = []
+    rejected = 0
+    columns = [ [] for column in ingest.TRIP_COLUMNS ]
+    reader = csv.reader(io.StringIO(text, newline=''))
+    for values in reader:
+        if not values:
+            continue
+        if len(values) != fields:
+            rejected += 1
+            errors.append((reader.line_num, f"Expected {fields} fields, found {len(values)}"))
+            continue
+        lines.append(reader.line_num)
+        for column, position in zip(columns, positions):
+            column.append(values[position])
+    prepared = ingest.prepare_chunk(columns)
+    rejected += len(prepared.parsed.errors)
+    errors.extend((lines[index], error) for index, error in prepared.parsed.errors.items())
+    errors.sort()
+    return ParsedRange(text.count('\n'), rejected, errors[:settings.INGEST_MAX_REPORTED_ERRORS], prepared)
+
+# Ingests a CSV file on disk using a pool of processes and several DB connections.
+"""
+    At most processes + writers ranges are parsed ahead of the writers, so memory stays bounded
+    when the DB is slower than the parsing. The optional progress coroutine is awaited with the
+    result after every range. The rejected lines are numbered once every range is written.
+"""
+async def copy_csv_file(path, processes=None, writers=None, progress=None, executor=None):
+    processes = processes or settings.INGEST_PROCESSES
+    writers = writers or settings.INGEST_WRITERS
+    header, offset = read_header(path)
+    positions = ingest.header_positions(header)
+    ranges = split_ranges(path, offset, settings.INGEST_SPLIT_SIZE)
+    result = ingest.IngestResult()
+    numbering = [ None ] * len(ranges)
+    queue = asyncio.Queue(processes + writers)
+    loop = asyncio.get_running_loop()
+    #The writers share the progress coroutine, which may use a session of its own.
+    progress_lock = asyncio.Lock()
+
+    async def produce():
+        for index, (start, end) in enumerate(ranges):
+            await queue.put((index, start, end, loop.run_in_executor(executor, parse_range, path, start, end, len(header), positions)))
+        for writer in range(writers):
+            await queue.put(None)
+
+    async def write():
+        async with SessionLocal() as db:
+            while (item := await queue.get()) is not None:
+                index, start, end, future = item
+                parsed = await future
+                connection = await get_driver_connection(db)
+                ingested = await ingest.write_chunk(db, connection, parsed.prepared, f"Rows between bytes {start} and {end}")
+                await db.commit()
+                numbering[index] = (parsed.lines, parsed.errors)
+                result.ingested += ingested
+                result.duplicates += int(parsed.prepared.parsed.valid.sum()) - ingested
+                result.rejected += parsed.rejected
+                if progress is not None:
+                    async with progress_lock:
+                        await progress(result)
+
+    own_executor = executor is None
+    if own_executor:
+        executor = ProcessPoolExecutor(processes, mp_context=multiprocessing.get_context('spawn'))
+    tasks = [ asyncio.create_task(produce()) ] + [ asyncio.create_task(write()) for writer in range(writers) ]
+    try:
+        await asyncio.gather(*tasks)
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        raise
+    finally:
+        if own_executor:
+            executor.shutdown(cancel_futures=True)
+
+    #The header is line 1, the lines of each range follow the ones of the previous ranges.
+    line = 1
+    for lines, errors in numbering:
+        for relative, error in errors:
+            if len(result.errors) < settings.INGEST_MAX_REPORTED_ERRORS:
+                result.errors.append({"line" : line + relative, "error" : error})
+        line += lines
+    return result
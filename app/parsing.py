@@ -0,0 +1,104 @@
+import numpy as np
+import shapely
+
+"""
+    This file defines the batch parsing stage shared by all the ingest endpoints.
+    Whole columns are parsed at once with shapely's and numpy's vectorized functions,
+    and invalid values are reported by their index instead of raising on the first one.
+"""
+
+#Length of a datetime in the '%Y-%m-%d %H:%M:%S' format.
+DATETIME_LENGTH = 19
+
+class ParsedTrips:
+    def __init__(self, region, origin, destination, datetime, datasource, errors):
+        self.region = region
+        self.origin = origin
+        self.destination = destination
+        self.datetime = datetime
+        self.datasource = datasource
+        #Rejection reason for each invalid row, keyed by its index in the batch.
+        self.errors = errors
+        self.valid = np.ones(len(region), dtype=bool)
+        self.valid[list(errors)] = False
+
+    def __len__(self):
+        return len(self.region)
+
+    # Returns the (index, region, origin, destination, datetime, datasource) of the valid rows as python objects.
+    def valid_rows(self):
+        indexes = np.flatnonzero(self.valid)
+        return zip(
+            indexes.tolist(),
+            self.region[indexes].tolist(),
+            self.origin[indexes].tolist(),
+            self.destination[indexes].tolist(),
+            self.datetime[indexes].tolist(),
+            self.datasource[indexes].tolist()
+            )
+
+# Parses a column of WKT points into an (n, 2) array of coordinates.
+"""
+    Invalid points are left as NaN and their index is returned along the reason they were rejected.
+"""
+def parse_points(values):
+    geometries = shapely.from_wkt(np.asarray(values, dtype=object), on_invalid='ignore')
+    valid = (shapely.get_type_id(geometries) == 0) & ~shapely.is_empty(geometries)
+    coords = np.full((len(geometries), 2), np.nan)
+    coords[valid, 0] = shapely.get_x(geometries[valid])
+    coords[valid, 1] = shapely.get_y(geometries[valid])
+    valid &= np.isfinite(coords).all(axis=1)
+    return coords, np.flatnonzero(~valid)
+
+# Parses a column of '%Y-%m-%d %H:%M:%S' strings into a datetime64 array in a single call.
+"""
+    Invalid datetimes are left as NaT and their index is returned. When numpy rejects the column
+    as a whole we fall back to parsing value by value, only to find out which ones are wrong.
+"""
+def parse_datetimes(values):
+    strings = np.asarray(values, dtype=str)
+    valid = (np.char.str_len(strings) == DATETIME_LENGTH) & (np.char.find(strings, ' ') == 10)
+    strings = np.where(valid, strings, 'NaT')
+    try:
+        datetimes = strings.astype('datetime64[s]')
+    except ValueError:
+        datetimes = np.empty(len(strings), dtype='datetime64[s]')
+        for index, value in enumerate(strings):
+            try:
+                datetimes[index] = np.datetime64(value, 's')
+            except ValueError:
+                datetimes[index] = np.datetime64('NaT')
+                valid[index] = False
+    return datetimes, np.flatnonzero(~valid)
+
+# Parses a batch of trips given as columns of strings.
+def parse_trips(region, origin_coord, destination_coord, datetime, datasource):
+    #Only the first reason found for each row is kept.
+    errors = {}
+    region = np.asarray(region, dtype=object)
+    datasource = np.asarray(datasource, dtype=object)
+    for index in np.flatnonzero(np.equal(region, '') | np.equal(region, None)).tolist():
+        errors.setdefault(index, "Missing value for column 'region'")
+    origin, invalid = parse_points(origin_coord)
+    for index in invalid.tolist():
+        errors.setdefault(index, f"Invalid WKT point for column 'origin_coord': {origin_coord[index]}")
+    destination, invalid = parse_points(destination_coord)
+    for index in invalid.tolist():
+        errors.setdefault(index, f"Invalid WKT point for column 'destination_coord': {destination_coord[index]}")
+    datetimes, invalid = parse_datetimes(datetime)
+    for index in invalid.tolist():
+        errors.setdefault(index, f"Invalid datetime: {datetime[index]}")
+    for index in np.flatnonzero(np.equal(datasource, '') | np.equal(datasource, None)).tolist():
+        errors.setdefault(index, "Missing value for column 'datasource'")
+    return ParsedTrips(region, origin, destination, datetimes, datasource, errors)
+
+# Formats a pair of coordinates as an EWKT point the DB can convert to a geometry, for the multi-row INSERTs of insert_trips.
+def ewkt_point(coords):
+    return 'SRID=4326;POINT(%r %r)' % (coords[0], coords[1])
+
+# Encodes an (n, 2) array of coordinates as hex EWKB points in a single call, which the DB reads without parsing any WKT.
+"""
+    Always little endian, the same bytes PostGIS returns from ST_AsEWKB(point, 'NDR').
+"""
+def ewkb_points(coords):
+    return shapely.to_wkb(shapely.set_srid(shapely.points(coords), 4326), hex=True, include_srid=True, byte_order=1).tolist()
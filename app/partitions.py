@@ -0,0 +1,174 @@
+import asyncio
+import logging
+import re
+from datetime import datetime, timedelta
+from sqlalchemy import select, delete
+from sqlalchemy.sql import text
+from .config import settings
+from .database import SessionLocal
+from . import models, versions
+
+"""
+    This file defines the maintenance of the monthly partitions of the trips table.
+    Every partition holds whole weeks: the one of a month goes from the Monday of the week of its 1st
+    to the Monday of the week of the next 1st, so any date_trunc('week') bucket, and any query over a
+    single week, falls in one partition. Trips without a partition land in the default one.
+    The API creates the partitions of the coming months in the background, ingest never does, so the
+    DDL never runs in the middle of an ingest transaction. Old months are dropped or detached with
+    python -m app.cli retention.
+"""
+
+logger = logging.getLogger(__name__)
+
+#Partition receiving the trips outside every monthly partition.
+DEFAULT_PARTITION = 'trips_default'
+
+#Columns of the trips table, to move trips out of the default partition.
+COLUMNS = "id, region, origin_coord, destination_coord, datetime, datasource, similarity_group, content_hash"
+
+#Key of the advisory lock taken while partitions are created or dropped, so API processes don't race.
+LOCK_KEY = 0x7472697073
+
+#Matches the names of the monthly partitions.
+PARTITION_NAME = re.compile(r'^trips_p(\d{4})_(\d{2})$')
+
+#Background task creating the partitions, set by start.
+task = None
+
+# Returns the Monday starting the week of a datetime, like date_trunc('week', datetime).
+def week_start(value):
+    day = datetime(value.year, value.month, value.day)
+    return day - timedelta(days=day.weekday())
+
+# Returns the first day of the month some months after, or before, a month.
+def add_months(month, months):
+    index = month.year * 12 + month.month - 1 + months
+    return datetime(index // 12, index % 12 + 1, 1)
+
+# Returns the month of the partition holding a datetime, the one its week ends in.
+def partition_month(value):
+    sunday = week_start(value) + timedelta(days=6)
+    return datetime(sunday.year, sunday.month, 1)
+
+# Returns the half-open datetime range of the partition of a month.
+def partition_bounds(month):
+    return week_start(month), week_start(add_months(month, 1))
+
+def partition_name(month):
+    return f"trips_p{month:%Y_%m}"
+
+# Returns the month of a partition from its name, None for the default partition or foreign tables.
+def name_month(name):
+    match = PARTITION_NAME.match(name)
+    return datetime(int(match[1]), int(match[2]), 1) if match else None
+
+# Returns the name, bounds and estimated rows of every partition of the trips table, oldest first.
+async def list_partitions(db):
+    result = await db.execute(text("""
+        SELECT child.relname, pg_get_expr(child.relpartbound, child.oid), child.reltuples
+        FROM pg_inherits
+        JOIN pg_class parent ON parent.oid = pg_inherits.inhparent
+        JOIN pg_class child ON child.oid = pg_inherits.inhrelid
+        WHERE parent.relname = 'trips'
+        ORDER BY child.relname
+        """))
+    return [ (name, bounds, max(int(rows), 0)) for name, bounds, rows in result ]
+
+# Creates the partition of a month, returning False when it already exists.
+"""
+    The table is created detached, the trips of its range are moved into it from the default
+    partition and it is then attached. Attaching only takes a SHARE UPDATE EXCLUSIVE lock on the
+    trips table, so reads and ingests of the other partitions go on meanwhile; the default partition
+    is locked against inserts for the time it takes to move its trips.
+"""
+async def create_partition(db, month):
+    name = partition_name(month)
+    if (await db.execute(text("SELECT to_regclass(:name)"), {"name" : name})).scalar() is not None:
+        return False
+    start, end = partition_bounds(month)
+    await db.execute(text(f"CREATE TABLE {name} (LIKE trips INCLUDING DEFAULTS)"))
+    await db.execute(text(f"LOCK TABLE {DEFAULT_PARTITION} IN SHARE ROW EXCLUSIVE MODE"))
+    await db.execute(text(f"""
+        WITH moved AS (DELETE FROM {DEFAULT_PARTITION} WHERE datetime >= :start AND datetime < :end RETURNING {COLUMNS})
+        INSERT INTO {name} ({COLUMNS}) SELECT {COLUMNS} FROM moved
+        """), {"start" : start, "end" : end})
+    #DDL takes no bound parameters, the bounds are formatted from datetimes.
+    await db.execute(text(f"ALTER TABLE trips ATTACH PARTITION {name} FOR VALUES FROM ('{start.isoformat(' ')}') TO ('{end.isoformat(' ')}')"))
+    return True
+
+# Creates the partitions from the current month to the given amount of months ahead, and the ones of the trips in the default partition.
+"""
+    Returns the names of the partitions created. The caller is responsible for committing.
+"""
+async def maintain(db, ahead=None):
+    ahead = settings.PARTITIONS_AHEAD if ahead is None else ahead
+    await db.execute(text("SELECT pg_advisory_xact_lock(:key)"), {"key" : LOCK_KEY})
+    current = partition_month(datetime.utcnow())
+    months = { add_months(current, offset) for offset in range(ahead + 1) }
+    stray = await db.execute(text(f"SELECT DISTINCT date_trunc('month', date_trunc('week', datetime) + interval '6 days') FROM {DEFAULT_PARTITION}"))
+    months.update(stray.scalars())
+    created = []
+    for month in sorted(months):
+        if await create_partition(db, month):
+            created.append(partition_name(month))
+    return created
+
+# Returns the first month kept when keeping the given amount of months, the current one included.
+def retention_cutoff(keep_months):
+    return add_months(partition_month(datetime.utcnow()), 1 - keep_months)
+
+# Returns the names of the partitions holding only months before the cutoff month.
+async def expired_partitions(db, cutoff):
+    return [ name for name, bounds, rows in await list_partitions(db) if name_month(name) is not None and name_month(name) < cutoff ]
+
+# Drops, or detaches, the partitions of the months before the kept ones, returning their names.
+"""
+    The rollups and similarity groups of the dropped range are deleted along, and the data versions
+    of the affected regions are bumped, in the same transaction. Detached partitions stay as plain
+    tables to be archived and dropped by hand. Both take an ACCESS EXCLUSIVE lock on the trips table
+    for an instant. The caller is responsible for committing.
+"""
+async def drop_partitions(db, keep_months, detach=False):
+    await db.execute(text("SELECT pg_advisory_xact_lock(:key)"), {"key" : LOCK_KEY})
+    cutoff = retention_cutoff(keep_months)
+    start = partition_bounds(cutoff)[0]
+    names = await expired_partitions(db, cutoff)
+    regions = (await db.execute(select(models.TripRollup.region).where(models.TripRollup.hour < start).distinct())).scalars().all()
+    for name in names:
+        if detach:
+            await db.execute(text(f"ALTER TABLE trips DETACH PARTITION {name}"))
+        else:
+            await db.execute(text(f"DROP TABLE {name}"))
+    await db.execute(text(f"DELETE FROM {DEFAULT_PARTITION} WHERE datetime < :start"), {"start" : start})
+    await db.execute(delete(models.TripRollup).where(models.TripRollup.hour < start))
+    await db.execute(delete(models.SimilarityGroup).where(models.SimilarityGroup.datetime < start))
+    if names or regions:
+        await versions.bump(db, versions.trip_scopes(regions))
+    return names
+
+# Creates the coming partitions every PARTITION_CHECK_INTERVAL seconds, logging the failures.
+async def maintain_periodically():
+    while True:
+        try:
+            async with SessionLocal() as db:
+                created = await maintain(db)
+                await db.commit()
+            if created:
+                logger.info("Created the trip partitions %s", ', '.join(created))
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            logger.exception("The trip partitions could not be created")
+        await asyncio.sleep(settings.PARTITION_CHECK_INTERVAL)
+
+# Starts the partition maintenance, must be called from the running event loop.
+def start():
+    global task
+    task = asyncio.create_task(maintain_periodically())
+
+async def stop():
+    global task
+    if task is not None:
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+        task = None
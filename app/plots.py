@@ -0,0 +1,70 @@
+import asyncio
+import io
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from .config import settings
+
+"""
+    This file defines the rendering of the plots, done by a small pool of processes.
+    matplotlib is only imported by the rendering processes, spawned on the first plot requested, so
+    the API processes start and reload without it. Every plot is drawn on its own Figure with the
+    object-oriented API, without pyplot's global state, so plots requested at once never share it,
+    and the event loop only awaits the rendered bytes.
+"""
+
+PNG = 'png'
+SVG = 'svg'
+MEDIA_TYPES = {PNG : 'image/png', SVG : 'image/svg+xml'}
+
+#Dots per inch of the rendered plots, their size being given in pixels.
+DPI = 100
+
+#Bounds of the width and height of the plots, in pixels.
+MIN_SIZE = 100
+MAX_SIZE = 4000
+
+#Process pool rendering the plots, created on first use.
+pool = None
+
+# Returns the process pool rendering the plots.
+"""
+    Processes are spawned instead of forked, since the API process runs an event loop and threads.
+"""
+def get_pool():
+    global pool
+    if pool is None:
+        pool = ProcessPoolExecutor(settings.PLOT_PROCESSES, mp_context=multiprocessing.get_context('spawn'))
+    return pool
+
+def shutdown_pool():
+    global pool
+    if pool is not None:
+        pool.shutdown(cancel_futures=True)
+        pool = None
+
+# Renders a bar chart, returning the image in the given format.
+"""
+    Runs in the rendering processes, where matplotlib is imported by the first plot.
+"""
+def render_bar(labels, values, format, width, height):
+    from matplotlib.figure import Figure
+    figure = Figure(figsize=(width / DPI, height / DPI), dpi=DPI)
+    axes = figure.subplots()
+    axes.bar(labels, values)
+    buffer = io.BytesIO()
+    figure.savefig(buffer, format=format)
+    return buffer.getvalue()
+
+# Renders a bar chart in the pool, returning the image in the given format.
+"""
+    A pool broken by a crashed process is replaced on the next plot.
+"""
+async def bar(labels, values, format=PNG, width=640, height=480):
+    executor = get_pool()
+    try:
+        return await asyncio.get_running_loop().run_in_executor(executor, render_bar, labels, values, format, width, height)
+    except BrokenProcessPool:
+        if pool is executor:
+            shutdown_pool()
+        raise
@@ -0,0 +1,30 @@
+from pathlib import Path
+from sqlalchemy.sql import text
+
+"""
+    This file defines the registry of the analytical queries in the Queries folder.
+    Every file is read and compiled once when the application starts, with the user input sent
+    as bound parameters instead of being spliced into the SQL. asyncpg prepares every statement
+    on the server and keeps it cached per connection, so repeated calls reuse its plan.
+"""
+
+QUERIES_PATH = Path(__file__).resolve().parent.parent / 'Queries'
+
+class NamedQuery:
+    def __init__(self, name, sql):
+        self.name = name
+        #The name tags the statement in the query metrics.
+        self.statement = text(sql).execution_options(query_name=name)
+
+# Loads and compiles every query in the Queries folder, named after its file.
+def load_queries(path=QUERIES_PATH):
+    queries = {}
+    for file in sorted(path.glob('*.sql')):
+        queries[file.stem] = NamedQuery(file.stem, file.read_text())
+    return queries
+
+QUERIES = load_queries()
+
+# Runs a named query with the given parameters.
+async def execute(db, name, **params):
+    return await db.execute(QUERIES[name].statement, params)
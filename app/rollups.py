@@ -0,0 +1,86 @@
+from sqlalchemy import delete
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.sql import func, text
+from . import models
+
+"""
+    This file defines the trip rollups, the pre-aggregated counts the analytical endpoints read from.
+    There is one row per region, datasource and hour with the amount of trips, the amount of
+    similarity groups first seen in it and the latest trip datetime. The rollups are updated by
+    every ingest path in the same transaction as the trips, and can be rebuilt from scratch.
+"""
+
+#Aggregates the stored trips into rollups. Each similarity group is counted on its first trip.
+ROLLUPS_FROM_TRIPS_SQL = """
+    SELECT
+        trips.region,
+        trips.datasource,
+        date_trunc('hour', trips.datetime) AS "hour",
+        count(*) AS "trip_count",
+        count(first_trips.id) AS "similar_trips",
+        max(trips.datetime) AS "latest_datetime"
+    FROM trips
+    LEFT JOIN (
+        SELECT DISTINCT ON (similarity_group, region) id
+        FROM trips
+        WHERE similarity_group IS NOT NULL
+        ORDER BY similarity_group, region, id
+        ) first_trips ON first_trips.id = trips.id
+    GROUP BY trips.region, trips.datasource, date_trunc('hour', trips.datetime)
+"""
+
+# Adds the given trips of a parsed batch to the rollups.
+"""
+    The indexes are the trips that were stored and group_indexes the first trip of every similarity
+    group that was new. The rows are upserted in key order so concurrent ingests lock them in the
+    same order.
+"""
+async def record(db, parsed, indexes, group_indexes):
+    hours = parsed.datetime.astype('datetime64[h]')
+    rollups = {}
+    for index in indexes:
+        key = (parsed.region[index], parsed.datasource[index], hours[index].item())
+        rollup = rollups.setdefault(key, [0, 0, parsed.datetime[index]])
+        rollup[0] += 1
+        rollup[2] = max(rollup[2], parsed.datetime[index])
+    for index in group_indexes:
+        rollups[(parsed.region[index], parsed.datasource[index], hours[index].item())][1] += 1
+    if not rollups:
+        return
+    rows = [
+        {
+            "region" : region,
+            "datasource" : datasource,
+            "hour" : hour,
+            "trip_count" : trip_count,
+            "similar_trips" : similar_trips,
+            "latest_datetime" : latest_datetime.item()
+            }
+        for (region, datasource, hour), (trip_count, similar_trips, latest_datetime) in sorted(rollups.items())
+        ]
+    query = insert(models.TripRollup)
+    query = query.on_conflict_do_update(
+        index_elements=[models.TripRollup.region, models.TripRollup.datasource, models.TripRollup.hour],
+        set_={
+            "trip_count" : models.TripRollup.trip_count + query.excluded.trip_count,
+            "similar_trips" : models.TripRollup.similar_trips + query.excluded.similar_trips,
+            "latest_datetime" : func.greatest(models.TripRollup.latest_datetime, query.excluded.latest_datetime)
+            }
+        )
+    await db.execute(query, rows)
+
+# Replaces the rollups with the ones computed from the stored trips.
+async def rebuild(db):
+    await db.execute(delete(models.TripRollup))
+    await db.execute(text(f"INSERT INTO trip_rollups (region, datasource, hour, trip_count, similar_trips, latest_datetime) {ROLLUPS_FROM_TRIPS_SQL}"))
+
+# Returns how many rollups differ from the ones computed from the stored trips.
+async def count_mismatches(db):
+    result = await db.execute(text(f"""
+        SELECT count(*)
+        FROM ({ROLLUPS_FROM_TRIPS_SQL}) expected
+        FULL JOIN trip_rollups stored USING (region, datasource, hour)
+        WHERE (expected.trip_count, expected.similar_trips, expected.latest_datetime)
+            IS DISTINCT FROM (stored.trip_count, stored.similar_trips, stored.latest_datetime)
+    """))
+    return result.scalar()
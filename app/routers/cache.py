@@ -0,0 +1,27 @@
+from fastapi import status, APIRouter, Response
+from .. import schemas, cache
+
+"""
+    This file defines the API endpoints to inspect and empty the response cache.
+"""
+
+#Creates the API Router
+router = APIRouter()
+
+# Returns the size of the response cache and the hit ratio of this API process.
+"""
+    With the sqlite backend the entries and bytes are the ones shared by every process of the node,
+    while the hits and misses are always counted per process.
+"""
+@router.get('/', response_model=schemas.CacheStatsResponse)
+async def get_cache_stats():
+    if cache.response_cache is None:
+        return {'status': 'success', 'enabled': False, 'backend': None}
+    return {'status': 'success', 'enabled': True, **await cache.response_cache.stats()}
+
+# Drops every cached response.
+@router.delete('/', status_code=status.HTTP_204_NO_CONTENT)
+async def clear_cache():
+    if cache.response_cache is not None:
+        await cache.response_cache.clear()
+    return Response(status_code=status.HTTP_204_NO_CONTENT)
@@ -0,0 +1,23 @@
+from fastapi import Depends, HTTPException, status, APIRouter
+from sqlalchemy.ext.asyncio import AsyncSession
+from .. import schemas, models, jobs
+from ..database import get_db
+
+"""
+    This file defines the API endpoints for the background ingest jobs.
+"""
+
+#Creates the API Router
+router = APIRouter()
+
+# Returns the status and progress of an ingest job.
+"""
+    rows_per_second is measured from the start of the job until it finishes, or until now while it runs.
+"""
+@router.get('/{id}', response_model=schemas.JobResponse)
+async def get_job(id: int, db: AsyncSession = Depends(get_db)):
+    job = await db.get(models.IngestJob, id)
+    if not job:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
+                            detail=f"No job with this id: {id} found")
+    return jobs.job_dict(job)
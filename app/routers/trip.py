@@ -1,21 +1,14 @@
-from datetime import datetime
-from .. import schemas, models
-from sqlalchemy.orm import Session
-from fastapi import Depends, HTTPException, status, APIRouter, Response
-from ..database import get_db
-from sqlalchemy.sql import func, text
+from datetime import datetime, timedelta
+from .. import schemas, models, ingest, serializers, filters, versions, queries, jobs, analytics, cache, idempotency, plots, parsing
+from sqlalchemy.ext.asyncio import AsyncSession
+from fastapi import Depends, HTTPException, status, APIRouter, Request, Response, Query, Header
+from ..database import get_db, get_read_db
+from ..config import settings
 from fastapi import FastAPI, File, UploadFile, BackgroundTasks
-from shapely.geometry import Point
-from shapely import wkt, wkb
-from typing import List
-import geoalchemy2
-import csv
-import codecs
-import io
-import matplotlib
-matplotlib.use('AGG')
-import matplotlib.pyplot as plt
-import numpy as np
+from fastapi.responses import StreamingResponse, ORJSONResponse
+from fastapi.encoders import jsonable_encoder
+from typing import List, Union, Literal
+from pydantic import HttpUrl
 
 """
     This file defines the API endpoints for the application.
@@ -24,102 +17,163 @@ import numpy as np
 #Creates the API Router
 router = APIRouter()
 
+#Last rendered plots, keyed by the data version they were rendered from, their format and size.
+plot_cache = {}
+
+#Formats and sizes of the latest version kept in the plot cache.
+MAX_CACHED_PLOTS = 16
+
+#Common parameters for the trip listing endpoints.
+"""
+    Results can be paginated with a limit, following the opaque next cursor returned with each page,
+    or streamed as newline delimited JSON by asking for application/x-ndjson in the Accept header.
+"""
+class ListParams:
+    def __init__(self, limit: Union[int, None] = Query(default=None, gt=0), cursor: Union[str, None] = None, accept: Union[str, None] = Header(default=None)):
+        self.limit = limit
+        self.cursor = cursor
+        self.ndjson = accept is not None and serializers.NDJSON_MEDIA_TYPE in accept
+
 """
     POST endpoints to ingest data into the API.
 """
 
 # Adds a single trip to the DB.
-"""    
-    Due to issues converting and handling Shapely/GeoAlchemy Points, it became necessary
-    to process the data both before ingesting and returning it to convert it to the proper
-    formats.
-    The first post endpoint has a commented line with how it should have worked directly
-    if it mapped and converted the datatypes properly.
+"""
+    Due to issues converting and handling Shapely/GeoAlchemy Points, the trips are inserted with
+    Core statements instead of ORM objects. The points are sent as EWKT and the stored trip is
+    returned by the same INSERT, with the coordinates selected as plain floats. A trip already
+    stored is not inserted again, and the stored one is returned.
 """
 @router.post('/add', status_code=status.HTTP_201_CREATED, response_model=schemas.TripResponse)
-def add_trip(trip: schemas.AddTripSchema, db: Session = Depends(get_db)):
-    trip_dict = {
-        "region" : trip.region,
-        "origin_coord" : wkt.loads(trip.origin_coord),
-        "destination_coord" : wkt.loads(trip.destination_coord),
-        "datetime" : datetime.strptime(trip.datetime, '%Y-%m-%d %H:%M:%S'),
-        "datasource" : trip.datasource
-        }
-    new_trip = models.Trip(**trip_dict)
-    #new_trip = models.Trip(**trip.dict())
-    db.add(new_trip)
-    db.commit()
-    db.refresh(new_trip)
-    new_trip_dict = {
-        "id" : new_trip.id,
-        "region" : new_trip.region,
-        "origin_coord" : wkt.dumps(geoalchemy2.shape.to_shape(new_trip.origin_coord)),
-        "destination_coord" : wkt.dumps(geoalchemy2.shape.to_shape(new_trip.destination_coord)),
-        "datetime" : new_trip.datetime.strftime('%Y-%m-%d %H:%M:%S'),
-        "datasource" : new_trip.datasource
-        }
-    return new_trip_dict
+async def add_trip(trip: schemas.AddTripSchema, idempotency_key: Union[str, None] = Header(default=None), db: AsyncSession = Depends(get_db)):
+    replayed = await replay(db, idempotency_key, 'add')
+    if replayed is not None:
+        return replayed
+    result = await insert_or_fail(db, [trip])
+    return await respond_once(db, idempotency_key, status.HTTP_201_CREATED, result.trips[0])
 
 # Adds a list of trips to the DB.
 """
-    The non existance of a resfresh_all method forces us to make a choice. We could bulk save all the data at once
-    with the bulk_save_objects method, however the SQLAlchemy documentation explains that setting the return_defaults
-    flag to obtain the generated IDs ends up having worse performance than using add_all, which is equivalent to
-    running all the single adds. This last option allows for refreshing the IDs though performance may be sacrificed.
-"""
-@router.post('/addlist', status_code=status.HTTP_201_CREATED, response_model=schemas.ListTripResponse)
-def add_trips(tripList: schemas.AddListTripSchema, db: Session = Depends(get_db)):
-    new_trips = []
-    for trip in tripList.trips:
-        trip_dict = {
-            "region" : trip.region,
-            "origin_coord" : wkt.loads(trip.origin_coord),
-            "destination_coord" : wkt.loads(trip.destination_coord),
-            "datetime" : datetime.strptime(trip.datetime, '%Y-%m-%d %H:%M:%S'),
-            "datasource" : trip.datasource
-            }
-        new_trip = models.Trip(**trip_dict)
-        db.add(new_trip)
-        db.commit()
-        db.refresh(new_trip)
-        new_trip_dict = {
-            "id" : new_trip.id,
-            "region" : new_trip.region,
-            "origin_coord" : wkt.dumps(geoalchemy2.shape.to_shape(new_trip.origin_coord)),
-            "destination_coord" : wkt.dumps(geoalchemy2.shape.to_shape(new_trip.destination_coord)),
-            "datetime" : new_trip.datetime.strftime('%Y-%m-%d %H:%M:%S'),
-            "datasource" : new_trip.datasource
-            }
-        new_trips.append(new_trip_dict)
-    return {'status': 'success', 'results': len(new_trips), 'trips': new_trips}
+    All the trips are inserted in a single transaction with one multi-row INSERT ... RETURNING
+    per batch, which gives us the generated IDs without committing and refreshing every trip.
+    By default the list is stored all or nothing. Setting partial stores the valid trips and
+    reports the rejected ones by their index in the list. Trips already stored are returned
+    without inserting them again and counted as duplicates.
+"""
+@router.post('/addlist', status_code=status.HTTP_201_CREATED, response_model=schemas.AddListTripResponse)
+async def add_trips(tripList: schemas.AddListTripSchema, partial: bool = False, idempotency_key: Union[str, None] = Header(default=None), db: AsyncSession = Depends(get_db)):
+    replayed = await replay(db, idempotency_key, 'addlist')
+    if replayed is not None:
+        return replayed
+    result = await insert_or_fail(db, tripList.trips, partial)
+    return await respond_once(db, idempotency_key, status.HTTP_201_CREATED,
+                              {'status': 'success', 'results': len(result.trips), 'trips': result.trips, 'duplicates': result.duplicates,
+                               'rejected': result.rejected, 'errors': result.errors})
 
-# Uploads a CSV with a list of trips which are then added to the DB.
+# Helper function to insert trips, rolling back when the list is rejected.
+async def insert_or_fail(db, trips, partial=False):
+    try:
+        result = await ingest.insert_trips(db, trips, partial)
+    except ingest.IngestError as e:
+        await db.rollback()
+        raise HTTPException(status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+                            detail=str(e))
+    if result.rejected and not partial:
+        await db.rollback()
+        raise HTTPException(status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+                            detail=result.errors)
+    return result
+
+# Helper function to claim the Idempotency-Key of a request, returning the response stored for it when it was already used.
+"""
+    The key stays claimed by this request until its transaction ends. Replayed responses carry an
+    Idempotent-Replayed header, and the ones of queued jobs their Location.
+"""
+async def replay(db, key, endpoint):
+    if key is None:
+        return None
+    if not key or len(key) > idempotency.MAX_KEY_LENGTH:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST,
+                            detail=f"The Idempotency-Key must have between 1 and {idempotency.MAX_KEY_LENGTH} characters")
+    stored = await idempotency.claim(db, key, endpoint)
+    if stored is None:
+        return None
+    if stored.endpoint != endpoint:
+        raise HTTPException(status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+                            detail=f"The Idempotency-Key was already used for /{stored.endpoint}")
+    if stored.response is None:
+        raise HTTPException(status_code=status.HTTP_409_CONFLICT,
+                            detail="A request with this Idempotency-Key is still being processed")
+    headers = {'Idempotent-Replayed': 'true'}
+    if stored.status_code == status.HTTP_202_ACCEPTED:
+        headers['Location'] = stored.response['job_url']
+    return ORJSONResponse(stored.response, status_code=stored.status_code, headers=headers)
+
+# Helper function to record the response of a request under its Idempotency-Key, if any, and commit.
+async def respond_once(db, key, status_code, response):
+    if key is not None:
+        await idempotency.record(db, key, status_code, jsonable_encoder(response))
+    await db.commit()
+    return response
+
+# Uploads a CSV with a list of trips which are then added to the DB in the background.
 """
     Unlike the previous method, when batch uploading data we decide not to sacrifice performance
-    and use the bulk_save_objects method, since it might not make sense to return a huge list with
-    all the added trips for large CSV files. This will be the fastest and most scalable way to ingest
-    data.
-"""
-@router.post('/upload', status_code=status.HTTP_201_CREATED, response_model=schemas.CSVTripResponse) #schemas.ListTripResponse
-def upload_trips(background_tasks: BackgroundTasks, file: UploadFile = File(...), db: Session = Depends(get_db)):
-    csvReader = csv.DictReader(codecs.iterdecode(file.file, 'utf-8'))
-    background_tasks.add_task(file.file.close)
-    trips = list(csvReader)
-    new_trips = []
-    for trip in trips:
-        trip_dict = {
-            "region" : trip["region"],
-            "origin_coord" : wkt.loads(trip["origin_coord"]),
-            "destination_coord" : wkt.loads(trip["destination_coord"]),
-            "datetime" : datetime.strptime(trip["datetime"], '%Y-%m-%d %H:%M:%S'),
-            "datasource" : trip["datasource"]
-            }
-        new_trip = models.Trip(**trip_dict)
-        new_trips.append(new_trip)
-        
-    db.bulk_save_objects(new_trips)
-    db.commit()
-    return {'status': 'success', 'results': len(new_trips)}
+    and avoid the ORM altogether, since it might not make sense to return a huge list with
+    all the added trips for large CSV files. The file is spooled to disk and queued as an ingest
+    job, answering with a 202 and the job ID right away, so large files don't keep the connection
+    open. The job streams the file to PostGIS in fixed-size chunks with COPY, and its progress can
+    be polled at /api/jobs/{id}. When a callback_url is given it receives the job on completion.
+    Trips already stored are skipped, and a retry sent with the same Idempotency-Key is answered
+    with the job of the first request without spooling the file.
+"""
+@router.post('/upload', status_code=status.HTTP_202_ACCEPTED, response_model=schemas.JobAcceptedResponse)
+async def upload_trips(response: Response, background_tasks: BackgroundTasks, file: UploadFile = File(...), callback_url: Union[HttpUrl, None] = None,
+                       idempotency_key: Union[str, None] = Header(default=None), db: AsyncSession = Depends(get_db)):
+    background_tasks.add_task(file.close)
+    replayed = await replay(db, idempotency_key, 'upload')
+    if replayed is not None:
+        return replayed
+    try:
+        job = await jobs.create_job(db, file, str(callback_url) if callback_url else None, idempotency_key=idempotency_key)
+    except jobs.JobQueueFull as e:
+        raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                            detail=str(e))
+    return accepted_job(response, job)
+
+# Imports a Parquet or Arrow IPC file with a list of trips in the background.
+"""
+    Takes the columns written by /export, without the id: the points as origin_lon, origin_lat,
+    destination_lon and destination_lat floats and the datetime as a timestamp, so no CSV or WKT is
+    parsed. The format is taken from the format parameter or the extension of the file, and the file
+    is queued as an ingest job like the CSV uploads, imported in a single transaction.
+"""
+@router.post('/import', status_code=status.HTTP_202_ACCEPTED, response_model=schemas.JobAcceptedResponse)
+async def import_trips(response: Response, background_tasks: BackgroundTasks, file: UploadFile = File(...), format: Union[str, None] = None,
+                       callback_url: Union[HttpUrl, None] = None, idempotency_key: Union[str, None] = Header(default=None), db: AsyncSession = Depends(get_db)):
+    background_tasks.add_task(file.close)
+    #Imported here, so the API processes start without pyarrow.
+    from .. import columnar
+    format = format or columnar.format_from_filename(file.filename)
+    if format not in columnar.MEDIA_TYPES:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST,
+                            detail=f"Unknown format: {format}. Expected one of: {', '.join(columnar.MEDIA_TYPES)}")
+    replayed = await replay(db, idempotency_key, 'import')
+    if replayed is not None:
+        return replayed
+    try:
+        job = await jobs.create_job(db, file, str(callback_url) if callback_url else None, format, idempotency_key)
+    except jobs.JobQueueFull as e:
+        raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                            detail=str(e))
+    return accepted_job(response, job)
+
+# Helper function to answer with the URL where a queued job can be polled.
+def accepted_job(response, job):
+    body = jobs.accepted(job)
+    response.headers['Location'] = body['job_url']
+    return body
 
 """
     GET endpoints to acquire data from the API.
@@ -127,211 +181,407 @@ def upload_trips(background_tasks: BackgroundTasks, file: UploadFile = File(...)
 
 # Returns all existing trips in the DB.
 """
-    Because of the Point type mapping issues, we must process the results to return them in a valid format.
+    Because of the Point type mapping issues, the listing endpoints skip the ORM entirely and select
+    the coordinates and datetimes already formatted by the DB, writing the response with orjson.
 """
-@router.get('/', response_model=schemas.ListTripResponse)
-def get_trips(db: Session = Depends(get_db)):
-    trips = db.query(models.Trip).all()
-    if not trips:
-        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
-                            detail=f"No trips found")
-    new_trips = []  #We could use a comprehension list but this feels more readable.
-    for trip in trips:
-        new_trip_dict = {
-            "id" : trip.id,
-            "region" : trip.region,
-            "origin_coord" : wkt.dumps(geoalchemy2.shape.to_shape(trip.origin_coord)),
-            "destination_coord" : wkt.dumps(geoalchemy2.shape.to_shape(trip.destination_coord)),
-            "datetime" : trip.datetime.strftime('%Y-%m-%d %H:%M:%S'),
-            "datasource" : trip.datasource
+@router.get('/', response_model=schemas.PageTripResponse)
+async def get_trips(request: Request, params: ListParams = Depends(), db: AsyncSession = Depends(get_read_db)):
+    return await cached(request, db, lambda: list_trips(db, serializers.select_trips(), params, f"No trips found", {}))
+
+# Returns the trips matching any combination of filters.
+"""
+    The datetime range is half-open, including start and excluding end. The bounding boxes are given
+    as "min_x,min_y,max_x,max_y" and matched against the origin and destination points respectively.
+"""
+@router.get('/search', response_model=schemas.PageTripResponse)
+async def search_trips(request: Request, region: Union[str, None] = None, datasource: Union[str, None] = None, start: Union[datetime, None] = None, end: Union[datetime, None] = None,
+                 origin_bbox: Union[str, None] = None, destination_bbox: Union[str, None] = None, params: ListParams = Depends(), db: AsyncSession = Depends(get_read_db)):
+    criteria = search_criteria(region, datasource, start, end, origin_bbox, destination_bbox)
+    clauses = filters.trip_filters(**criteria)
+    return await cached(request, db, lambda: list_trips(db, serializers.select_trips().where(*clauses), params, f"No trips found for this search", criteria),
+                        criteria['region'])
+
+# Exports the trips matching the /search filters as a Parquet or Arrow IPC stream.
+"""
+    The format is taken from the format parameter, or from the Accept header, Parquet by default.
+    The trips are read from a server-side cursor and written in record batches of EXPORT_BATCH_SIZE
+    trips as they arrive, with the coordinates as lon/lat floats and the regions and datasources
+    dictionary encoded.
+"""
+@router.get('/export', response_model=None)
+async def export_trips(region: Union[str, None] = None, datasource: Union[str, None] = None, start: Union[datetime, None] = None, end: Union[datetime, None] = None,
+                       origin_bbox: Union[str, None] = None, destination_bbox: Union[str, None] = None, format: Union[str, None] = None,
+                       accept: Union[str, None] = Header(default=None), db: AsyncSession = Depends(get_read_db)):
+    #Imported here, so the API processes start without pyarrow.
+    from .. import columnar
+    if format is None:
+        format = columnar.ARROW if accept is not None and columnar.MEDIA_TYPES[columnar.ARROW] in accept else columnar.PARQUET
+    if format not in columnar.MEDIA_TYPES:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST,
+                            detail=f"Unknown format: {format}. Expected one of: {', '.join(columnar.MEDIA_TYPES)}")
+    criteria = search_criteria(region, datasource, start, end, origin_bbox, destination_bbox)
+    query = columnar.select_export().where(*filters.trip_filters(**criteria))
+    result = await db.stream(query.execution_options(yield_per=settings.EXPORT_BATCH_SIZE))
+    partitions = result.partitions()
+    try:
+        first = await partitions.__anext__()
+    except StopAsyncIteration:
+        first = []
+    headers = {'Content-Disposition': f'attachment; filename="trips{columnar.EXTENSIONS[format][0]}"'}
+    return StreamingResponse(columnar.export_stream(first, partitions, format), media_type=columnar.MEDIA_TYPES[format], headers=headers)
+
+# Helper function to parse the filters of /search and /export.
+def search_criteria(region, datasource, start, end, origin_bbox, destination_bbox):
+    try:
+        origin_bbox = filters.parse_bbox(origin_bbox) if origin_bbox is not None else None
+        destination_bbox = filters.parse_bbox(destination_bbox) if destination_bbox is not None else None
+    except ValueError as e:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST,
+                            detail=str(e))
+    return {'region': region, 'datasource': datasource, 'start': start, 'end': end, 'origin_bbox': origin_bbox, 'destination_bbox': destination_bbox}
+
+# Returns the trips starting and/or ending inside the given boxes.
+"""
+    The boxes are given as "min_x,min_y,max_x,max_y" and at least one is required. The points are
+    compared with && against an envelope, which the GiST indexes on the coordinates answer.
+"""
+@router.get('/bbox', response_model=schemas.PageTripResponse)
+async def get_trips_by_bbox(request: Request, origin_bbox: Union[str, None] = None, destination_bbox: Union[str, None] = None, params: ListParams = Depends(), db: AsyncSession = Depends(get_read_db)):
+    criteria = bbox_criteria(origin_bbox, destination_bbox)
+    clauses = filters.trip_filters(**criteria)
+    return await cached(request, db, lambda: list_trips(db, serializers.select_trips().where(*clauses), params, f"No trips found for these bounding boxes", criteria))
+
+# Returns the amount of trips starting and/or ending inside the given boxes.
+@router.get('/bbox/count', response_model=schemas.CountTripResponse)
+async def count_trips_by_bbox(request: Request, origin_bbox: Union[str, None] = None, destination_bbox: Union[str, None] = None, db: AsyncSession = Depends(get_read_db)):
+    criteria = bbox_criteria(origin_bbox, destination_bbox)
+
+    async def build():
+        if analytics.store is not None and analytics.store.covers():
+            count = len(analytics.store.search(**criteria))
+        else:
+            count = (await db.execute(filters.count_trips(**criteria))).scalar()
+        return {'status': 'success', 'count': count}
+
+    return await cached(request, db, build, model=schemas.CountTripResponse)
+
+# Helper function to parse the boxes of the bbox endpoints.
+def bbox_criteria(origin_bbox, destination_bbox):
+    if origin_bbox is None and destination_bbox is None:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST,
+                            detail=f"At least one of origin_bbox and destination_bbox is required")
+    try:
+        return {
+            'origin_bbox': filters.parse_bbox(origin_bbox) if origin_bbox is not None else None,
+            'destination_bbox': filters.parse_bbox(destination_bbox) if destination_bbox is not None else None
             }
-        new_trips.append(new_trip_dict)
-    return {'status': 'success', 'results': len(new_trips), 'trips': new_trips}
+    except ValueError as e:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST,
+                            detail=str(e))
+
+#Most similar trips returned by a lookup.
+MAX_SIMILAR_TRIPS = 100
+
+#Common parameters for the similar trips lookups.
+"""
+    k is the amount of trips returned. The thresholds bound the distance in degrees between both the
+    origins and the destinations, and the minutes between the trips.
+"""
+class SimilarParams:
+    def __init__(self, k: int = Query(default=10, gt=0, le=MAX_SIMILAR_TRIPS), max_distance: float = Query(default=settings.SIMILAR_TRIPS_MAX_DISTANCE, gt=0),
+                 max_minutes: float = Query(default=settings.SIMILAR_TRIPS_MAX_MINUTES, gt=0)):
+        self.k = k
+        self.max_distance = max_distance
+        self.max_minutes = max_minutes
+
+# Returns the trips most similar to an origin, destination and datetime.
+"""
+    The points are given as WKT, like "POINT(x y)", and the datetime as "YYYY-mm-dd HH:MM:SS".
+    Invalid points get a 422, like the other invalid parameters.
+"""
+@router.get('/similar', response_model=schemas.SimilarTripsResponse)
+async def get_similar_trips(origin: str, destination: str, datetime: datetime, request: Request, params: SimilarParams = Depends(), db: AsyncSession = Depends(get_read_db)):
+    try:
+        filters.parse_point(origin)
+        filters.parse_point(destination)
+    except ValueError as e:
+        raise HTTPException(status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+                            detail=str(e))
+    return await cached(request, db, lambda: similar_trips(db, origin, destination, datetime, params), model=schemas.SimilarTripsResponse)
+
+# Returns the trips most similar to a stored trip, the trip itself excluded.
+@router.get('/{id}/similar', response_model=schemas.SimilarTripsResponse)
+async def get_similar_trips_by_id(id: int, request: Request, params: SimilarParams = Depends(), db: AsyncSession = Depends(get_read_db)):
+
+    async def build():
+        trip = (await db.execute(serializers.select_trips().where(models.Trip.id == id))).first()
+        if not trip:
+            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
+                                detail=f"No trip with this id: {id} found")
+        return await similar_trips(db, serializers.format_point(trip.origin_x, trip.origin_y), serializers.format_point(trip.destination_x, trip.destination_y),
+                                   datetime.strptime(trip.datetime, '%Y-%m-%d %H:%M:%S'), params, exclude_id=id)
+
+    return await cached(request, db, build, model=schemas.SimilarTripsResponse)
+
+# Helper function to look up the trips most similar to an origin, destination and datetime.
+"""
+    The trips within the thresholds are ranked by the sum of their origin distance, destination
+    distance and time difference, each divided by its threshold. The query takes the nearest trips
+    by origin and by destination of the time window from the GiST indexes on (coordinate, datetime)
+    and ranks only those, so its cost depends on SIMILAR_TRIPS_CANDIDATES rather than on the
+    amount of trips, at the price of missing trips that are far from the nearest ones by both points.
+"""
+async def similar_trips(db, origin, destination, when, params, exclude_id=0):
+    window = timedelta(minutes=params.max_minutes)
+    similar_db = (await queries.execute(db, 'similar_trips', origin=origin, destination=destination, datetime=when, start=when - window, end=when + window,
+                                        max_distance=params.max_distance, max_seconds=window.total_seconds(), exclude_id=exclude_id,
+                                        candidates=max(params.k, settings.SIMILAR_TRIPS_CANDIDATES), k=params.k)).all()
+    if not similar_db:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
+                            detail=f"No similar trips found")
+    trips = [ dict(serializers.trip_row_to_dict(row), origin_distance=row.origin_distance, destination_distance=row.destination_distance,
+                   time_difference=row.time_difference, score=row.score) for row in similar_db ]
+    return {'status': 'success', 'results': len(trips), 'trips': trips}
 
 # Returns a single trip by ID.
 @router.get('/{id}', response_model=schemas.TripResponse)
-def get_trip(id: int, db: Session = Depends(get_db)):
-    trip = db.query(models.Trip).filter(models.Trip.id == id).first()
+async def get_trip(id: int, db: AsyncSession = Depends(get_read_db)):
+    trip = (await db.execute(serializers.select_trips().where(models.Trip.id == id))).first()
     if not trip:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
                             detail=f"No trip with this id: {id} found")
-    new_trip_dict = {
-            "id" : trip.id,
-            "region" : trip.region,
-            "origin_coord" : wkt.dumps(geoalchemy2.shape.to_shape(trip.origin_coord)),
-            "destination_coord" : wkt.dumps(geoalchemy2.shape.to_shape(trip.destination_coord)),
-            "datetime" : trip.datetime.strftime('%Y-%m-%d %H:%M:%S'),
-            "datasource" : trip.datasource
-            }
-    return new_trip_dict
+    return serializers.trip_row_to_dict(trip)
 
 # Returns all trips for a given region.
-@router.get('/region/{region}', response_model=schemas.ListTripResponse)
-def get_trips_by_region(region: str, db: Session = Depends(get_db)):
-    trips = db.query(models.Trip).filter(models.Trip.region == region).all()
-    if not trips:
-        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
-                            detail=f"No trips for this region: {region} found")
-    new_trips = []  #We could use a comprehension list but this feels more readable.
-    for trip in trips:
-        new_trip_dict = {
-            "id" : trip.id,
-            "region" : trip.region,
-            "origin_coord" : wkt.dumps(geoalchemy2.shape.to_shape(trip.origin_coord)),
-            "destination_coord" : wkt.dumps(geoalchemy2.shape.to_shape(trip.destination_coord)),
-            "datetime" : trip.datetime.strftime('%Y-%m-%d %H:%M:%S'),
-            "datasource" : trip.datasource
-            }
-        new_trips.append(new_trip_dict)
-    return {'status': 'success', 'results': len(new_trips), 'trips': new_trips}
+@router.get('/region/{region}', response_model=schemas.PageTripResponse)
+async def get_trips_by_region(region: str, request: Request, params: ListParams = Depends(), db: AsyncSession = Depends(get_read_db)):
+    return await cached(request, db, lambda: list_trips(db, serializers.select_trips().where(models.Trip.region == region), params, f"No trips for this region: {region} found", {'region': region}),
+                        region)
 
 # Returns all trips for a given datasource.
-@router.get('/datasource/{datasource}', response_model=schemas.ListTripResponse)
-def get_trips_by_datasource(datasource: str, db: Session = Depends(get_db)):
-    trips = db.query(models.Trip).filter(models.Trip.datasource == datasource).all()
-    if not trips:
-        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
-                            detail=f"No trips for this datasource: {datasource} found")
-    new_trips = []  #We could use a comprehension list but this feels more readable.
-    for trip in trips:
-        new_trip_dict = {
-            "id" : trip.id,
-            "region" : trip.region,
-            "origin_coord" : wkt.dumps(geoalchemy2.shape.to_shape(trip.origin_coord)),
-            "destination_coord" : wkt.dumps(geoalchemy2.shape.to_shape(trip.destination_coord)),
-            "datetime" : trip.datetime.strftime('%Y-%m-%d %H:%M:%S'),
-            "datasource" : trip.datasource
-            }
-        new_trips.append(new_trip_dict)
-    return {'status': 'success', 'results': len(new_trips), 'trips': new_trips}
+@router.get('/datasource/{datasource}', response_model=schemas.PageTripResponse)
+async def get_trips_by_datasource(datasource: str, request: Request, params: ListParams = Depends(), db: AsyncSession = Depends(get_read_db)):
+    return await cached(request, db, lambda: list_trips(db, serializers.select_trips().where(models.Trip.datasource == datasource), params, f"No trips for this datasource: {datasource} found", {'datasource': datasource}))
 
 # Returns all trips for a given date (at a day level in format "YYYY-mm-dd").
-@router.get('/date/{date}', response_model=schemas.ListTripResponse)
-def get_trips_by_date(date: str, db: Session = Depends(get_db)):
-    dt = datetime.strptime(date, '%Y-%m-%d')
-    trips = db.query(models.Trip).filter(func.date_trunc('day', models.Trip.datetime) == func.date_trunc('day', dt)).all()
-    if not trips:
-        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
-                            detail=f"No trips for this day: {func.date_trunc('day', date)} found")
-    new_trips = []  #We could use a comprehension list but this feels more readable.
-    for trip in trips:
-        new_trip_dict = {
-            "id" : trip.id,
-            "region" : trip.region,
-            "origin_coord" : wkt.dumps(geoalchemy2.shape.to_shape(trip.origin_coord)),
-            "destination_coord" : wkt.dumps(geoalchemy2.shape.to_shape(trip.destination_coord)),
-            "datetime" : trip.datetime.strftime('%Y-%m-%d %H:%M:%S'),
-            "datasource" : trip.datasource
-            }
-        new_trips.append(new_trip_dict)
-    return {'status': 'success', 'results': len(new_trips), 'trips': new_trips}
+@router.get('/date/{date}', response_model=schemas.PageTripResponse)
+async def get_trips_by_date(date: str, request: Request, params: ListParams = Depends(), db: AsyncSession = Depends(get_read_db)):
+    try:
+        start = datetime.strptime(date, '%Y-%m-%d')
+    except ValueError:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST,
+                            detail=f"Invalid date: {date}. Expected YYYY-mm-dd")
+    #Filter on a half-open range instead of truncating the column, so the datetime index can be used.
+    criteria = {'start': start, 'end': start + timedelta(days=1)}
+    clauses = filters.trip_filters(**criteria)
+    return await cached(request, db, lambda: list_trips(db, serializers.select_trips().where(*clauses), params, f"No trips for this day: {date} found", criteria))
 
 # Returns all trips for a given datetime (at a datetime level in format "YYYY-mm-dd HH:MM:SS").
-@router.get('/datetime/{datetime}', response_model=schemas.ListTripResponse)
-def get_trips_by_datetime(datetime: datetime, db: Session = Depends(get_db)):
-    trips = db.query(models.Trip).filter(models.Trip.datetime == datetime).all()
-    if not trips:
+@router.get('/datetime/{datetime}', response_model=schemas.PageTripResponse)
+async def get_trips_by_datetime(datetime: datetime, request: Request, params: ListParams = Depends(), db: AsyncSession = Depends(get_read_db)):
+    return await cached(request, db, lambda: list_trips(db, serializers.select_trips().where(models.Trip.datetime == datetime), params, f"No trips for this datetime: {datetime} found"))
+
+# Helper function to run a trip listing query, paginating or streaming it as requested.
+"""
+    Pagination is keyset based on the trip ID, so every page costs the same regardless of how deep it is.
+    Unpaginated requests keep returning every matching trip in a single JSON document.
+    When the analytics store is enabled and holds every trip matching the criteria, the filters
+    given as criteria are answered from it instead of the query.
+"""
+async def list_trips(db, query, params, detail, criteria=None):
+    after = None
+    if params.cursor is not None:
+        try:
+            after = serializers.decode_cursor(params.cursor)
+        except ValueError as e:
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST,
+                                detail=str(e))
+    if criteria is not None and analytics.store is not None and analytics.store.covers(criteria.get('start')):
+        return list_stored_trips(analytics.store, criteria, after, params, detail)
+    if params.limit is not None or params.cursor is not None:
+        query = query.order_by(models.Trip.id)
+    if after is not None:
+        query = query.where(models.Trip.id > after)
+    if params.ndjson:
+        if params.limit is not None:
+            query = query.limit(params.limit)
+        result = await db.stream(query.execution_options(yield_per=settings.STREAM_BATCH_SIZE))
+        partitions = result.partitions()
+        try:
+            first = await partitions.__anext__()
+        except StopAsyncIteration:
+            first = []
+        if not first:
+            await result.close()
+            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
+                                detail=detail)
+        return serializers.trips_ndjson_response(first, partitions)
+    if params.limit is not None:
+        query = query.limit(params.limit + 1)
+    trips = (await db.execute(query)).all()
+    if not trips and params.cursor is None:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
-                            detail=f"No trips for this datetime: {datetime} found")
-    new_trips = []  #We could use a comprehension list but this feels more readable.
-    for trip in trips:
-        new_trip_dict = {
-            "id" : trip.id,
-            "region" : trip.region,
-            "origin_coord" : wkt.dumps(geoalchemy2.shape.to_shape(trip.origin_coord)),
-            "destination_coord" : wkt.dumps(geoalchemy2.shape.to_shape(trip.destination_coord)),
-            "datetime" : trip.datetime.strftime('%Y-%m-%d %H:%M:%S'),
-            "datasource" : trip.datasource
-            }
-        new_trips.append(new_trip_dict)
-    return {'status': 'success', 'results': len(new_trips), 'trips': new_trips}
+                            detail=detail)
+    if params.limit is None:
+        return serializers.trips_response(trips, paginated=params.cursor is not None)
+    next_cursor = None
+    if len(trips) > params.limit:
+        trips = trips[:params.limit]
+        next_cursor = serializers.encode_cursor(trips[-1].id)
+    return serializers.trips_response(trips, next_cursor, paginated=True)
+
+# Helper function to list the trips matching the criteria from the analytics store, like list_trips.
+def list_stored_trips(store, criteria, after, params, detail):
+    rows = store.search(**criteria, after=after)
+    if params.ndjson:
+        if params.limit is not None:
+            rows = rows[:params.limit]
+        if not len(rows):
+            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
+                                detail=detail)
+        first = list(store.trip_rows(rows[:settings.STREAM_BATCH_SIZE]))
+        return serializers.trips_ndjson_response(first, stored_partitions(store, rows[settings.STREAM_BATCH_SIZE:]))
+    if not len(rows) and params.cursor is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
+                            detail=detail)
+    if params.limit is None:
+        return serializers.trips_response(list(store.trip_rows(rows)), paginated=params.cursor is not None)
+    next_cursor = None
+    if len(rows) > params.limit:
+        rows = rows[:params.limit]
+        next_cursor = serializers.encode_cursor(int(store.column('id')[rows[-1]]))
+    return serializers.trips_response(list(store.trip_rows(rows)), next_cursor, paginated=True)
+
+# Helper function to stream stored trips in partitions of STREAM_BATCH_SIZE.
+async def stored_partitions(store, rows):
+    for start in range(0, len(rows), settings.STREAM_BATCH_SIZE):
+        yield list(store.trip_rows(rows[start:start + settings.STREAM_BATCH_SIZE]))
+
+# Helper function to answer a read endpoint through the response cache, when it is enabled.
+"""
+    build is awaited to get the response on a miss. The entries are keyed by the data version of the
+    region when given, or of every trip otherwise. The version is read before running the query, so a
+    write committed in between can only store newer data under the older version, never the opposite.
+"""
+async def cached(request, db, build, region=None, model=None):
+    if cache.response_cache is None:
+        return await build()
+    version = await versions.current(db, versions.region_scope(region) if region is not None else versions.TRIPS)
+    return await cache.response_cache.respond(request, version, build, model)
 
 """
     GET endpoints to acquire results and visualizations from the API.
+    The analytical queries come from the registry in app/queries.py, loaded once at startup.
+    The weekly averages by region and the datasource summaries read from the trip rollups,
+    so they cost as much as the amount of hourly buckets instead of the amount of trips.
 """
 
 # Get Weekly Average Number of Trips for an Area By Region
 @router.get('/weekly/{region}', response_model=schemas.WeeklyAverageTripsByRegionResponse)
-def get_weekly_average_trips_by_region(region: str, db: Session = Depends(get_db)):
-    f = open('Queries/similar_trips_by_region.sql', "r")
-    query = f.read().replace("{region}", region)
-    f.close()
-    weekly_trips = db.execute(text(query)).first()
-    if not weekly_trips:
-        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
-                            detail=f"No trips for this region: {region} found")
-    return {'status': 'success', 'region': weekly_trips.region, 'weekly_average_trips': weekly_trips.weekly_average}
+async def get_weekly_average_trips_by_region(region: str, request: Request, db: AsyncSession = Depends(get_read_db)):
+
+    async def build():
+        if analytics.store is not None and analytics.store.covers():
+            weekly_average = analytics.store.weekly_average_by_region(region)
+        else:
+            weekly_trips = (await queries.execute(db, 'similar_trips_by_region', region=region)).first()
+            weekly_average = weekly_trips.weekly_average if weekly_trips else None
+        if weekly_average is None:
+            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
+                                detail=f"No trips for this region: {region} found")
+        return {'status': 'success', 'region': region, 'weekly_average_trips': weekly_average}
+
+    return await cached(request, db, build, region, schemas.WeeklyAverageTripsByRegionResponse)
 
 # Get Weekly Average Number of Trips for an Area By Bounding Box
 """
-    Expects the bottom left and top right points of the desired bounding box.
+    Expects the bottom left and top right points of the desired bounding box, as WKT. They are
+    validated before choosing between the in-memory store and the query, so both answer a 422.
 """
 @router.get('/weekly/{bottom_left}/{top_right}', response_model=schemas.WeeklyAverageTripsByBoundingBoxResponse)
-def get_weekly_average_trips_by_bbox(bottom_left: str, top_right: str, db: Session = Depends(get_db)):
-    f = open('Queries/similar_trips_by_bounding_box.sql', "r")
-    query = f.read().replace("{bottom_left}", bottom_left).replace("{top_right}", top_right)
-    f.close()
-    weekly_trips = db.execute(text(query)).first()
-    if not weekly_trips:
-        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
-                            detail=f"No trips for this bounding box: ({bottom_left}, {top_right}) found")
-    return {'status': 'success', 'bottom_left': weekly_trips.bottom_left, 'top_right': weekly_trips.top_right, 'weekly_average_trips': weekly_trips.weekly_average}
+async def get_weekly_average_trips_by_bbox(bottom_left: str, top_right: str, request: Request, db: AsyncSession = Depends(get_read_db)):
+    corners, invalid = parsing.parse_points([ bottom_left, top_right ])
+    if len(invalid):
+        raise HTTPException(status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+                            detail=f"Invalid WKT point: {(bottom_left, top_right)[invalid[0]]}")
+    bbox = filters.corners_bbox(*corners.tolist())
+
+    async def build():
+        if analytics.store is not None and analytics.store.covers():
+            weekly_average = analytics.store.weekly_average_by_bbox(bbox)
+        else:
+            weekly_trips = (await queries.execute(db, 'similar_trips_by_bounding_box', bottom_left=bottom_left, top_right=top_right)).first()
+            weekly_average = weekly_trips.weekly_average if weekly_trips else None
+        if weekly_average is None:
+            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
+                                detail=f"No trips for this bounding box: ({bottom_left}, {top_right}) found")
+        return {'status': 'success', 'bottom_left': bottom_left, 'top_right': top_right, 'weekly_average_trips': weekly_average}
+
+    return await cached(request, db, build, model=schemas.WeeklyAverageTripsByBoundingBoxResponse)
 
 # Get the regions where the 'cheap_mobile' datasource has appeared in.
 @router.get('/cheap_mobile/', response_model=None)
-def get_cheap_mobile_regions(db: Session = Depends(get_db)):
-    f = open('Queries/cheap_mobile.sql', "r")
-    query = f.read()
-    f.close()
-    regions_db = db.execute(text(query)).all()
+async def get_cheap_mobile_regions(request: Request, db: AsyncSession = Depends(get_read_db)):
+    return await cached(request, db, lambda: datasource_regions(db, 'cheap_mobile'))
+
+# Get the regions where a given datasource has appeared in.
+@router.get('/datasource_regions/{datasource}', response_model=None)
+async def get_datasource_regions(datasource: str, request: Request, db: AsyncSession = Depends(get_read_db)):
+    return await cached(request, db, lambda: datasource_regions(db, datasource))
+
+# Helper function to list the regions of a datasource.
+async def datasource_regions(db, datasource):
+    regions_db = (await queries.execute(db, 'datasource_regions', datasource=datasource)).all()
     if not regions_db:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
-                            detail=f"No trips for the 'cheap_mobile' found")
+                            detail=f"No trips for the '{datasource}' found")
     regions = [ region.region for region in regions_db ]
     return {'status': 'success', 'regions': regions}
 
 # Get the latest datasource for the two most commonly appearing regions.
 @router.get('/latest_datasources/', response_model=None)
-def latest_datasources(db: Session = Depends(get_db)):
-    f = open('Queries/latest_datasources.sql', "r")
-    query = f.read()
-    f.close()
-    latest_datasources_db = db.execute(text(query)).all()
-    if not latest_datasources_db:
-        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
-                            detail=f"No trips for the 'cheap_mobile' found")
-    latest_datasources = [ { "region" : source.region, "latest_datasource" : source.datasource } for source in latest_datasources_db ]
-    return {'status': 'success', 'latest_datasources': latest_datasources}
+async def latest_datasources(request: Request, db: AsyncSession = Depends(get_read_db)):
+
+    async def build():
+        latest_datasources_db = (await queries.execute(db, 'latest_datasources')).all()
+        if not latest_datasources_db:
+            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
+                                detail=f"No trips found")
+        latest_datasources = [ { "region" : source.region, "latest_datasource" : source.datasource } for source in latest_datasources_db ]
+        return {'status': 'success', 'latest_datasources': latest_datasources}
+
+    return await cached(request, db, build)
 
 # Get a Plot showing the weekly average trips by region.
+"""
+    The weekly averages of every region are computed in a single aggregation over the rollups, and
+    the plot is rendered as PNG or SVG, of width x height pixels, by the plot processes.
+    The rendered plots are cached along the data version they were rendered from, which ingest bumps,
+    and their ETag lets clients revalidate with If-None-Match and get a 304 while nothing changed.
+"""
 @router.get('/plot/', response_model=None)
-def get_plot(background_tasks: BackgroundTasks, db: Session = Depends(get_db)):
-    #Get the existing regions
-    regions_db = db.execute(text("SELECT region FROM trips GROUP BY region ORDER BY region ASC;")).all()
-    if not regions_db:
-        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
-                            detail=f"No regions found")
-    regions = []
-    avgs = []
-    for region in regions_db:
-        #Get the weekly average for each region
-        avg = get_weekly_average_trips_by_region(region.region, db)['weekly_average_trips']
-        regions.append(region.region)
-        avgs.append(avg)
-    #Create the bar plot and return it.
-    img_buf = create_bar(regions, avgs)
-    background_tasks.add_task(img_buf.close)
-    headers = {'Content-Disposition': 'inline; filename="weekly_average_trips_by_region.png"'}
-    return Response(img_buf.getvalue(), headers=headers, media_type='image/png')
-
-# Helper function to create the bar chart.
-def create_bar(regs, avgs):
-    x = np.array(regs)
-    y = np.array(avgs)
-    fig = plt.figure()
-    plt.bar(x,y)
-    img_buf = io.BytesIO()
-    plt.savefig(img_buf, format='png')
-    plt.close(fig)
-    return img_buf
-
+async def get_plot(format: Literal['png', 'svg'] = plots.PNG, width: int = Query(default=640, ge=plots.MIN_SIZE, le=plots.MAX_SIZE),
+                   height: int = Query(default=480, ge=plots.MIN_SIZE, le=plots.MAX_SIZE),
+                   if_none_match: Union[str, None] = Header(default=None), db: AsyncSession = Depends(get_read_db)):
+    version = await versions.current(db)
+    etag = f'"plot-{version}-{width}x{height}-{format}"'
+    if cache.etag_matches(if_none_match, etag):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers={'ETag': etag})
+    key = (version, format, width, height)
+    image = plot_cache.get(key)
+    if image is None:
+        averages_db = (await queries.execute(db, 'weekly_averages_by_region')).all()
+        if not averages_db:
+            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
+                                detail=f"No regions found")
+        regions = [ average.region for average in averages_db ]
+        avgs = [ float(average.weekly_average) for average in averages_db ]
+        image = await plots.bar(regions, avgs, format, width, height)
+        #Keep only the plots of the latest version, dropping the oldest beyond MAX_CACHED_PLOTS.
+        if any(cached[0] != version for cached in plot_cache):
+            plot_cache.clear()
+        while len(plot_cache) >= MAX_CACHED_PLOTS:
+            del plot_cache[next(iter(plot_cache))]
+        plot_cache[key] = image
+    headers = {'Content-Disposition': f'inline; filename="weekly_average_trips_by_region.{format}"', 'ETag': etag}
+    return Response(image, headers=headers, media_type=plots.MEDIA_TYPES[format])
@@ -1,35 +1,53 @@
-from fastapi import FastAPI, Header, HTTPException, Request, Response
-import http
+from fastapi import Depends, HTTPException, status, APIRouter
+from sqlalchemy.ext.asyncio import AsyncSession
+from .. import schemas, models, jobs
+from ..database import get_db
 
 """
     This file defines the API webhooks for the application.
+    Each ingest job can have a callback URL which receives the job once it finishes.
 """
 
 #Creates the API Router
 router = APIRouter()
 
-@router.post('/', status_code=http.HTTPStatus.ACCEPTED)
-async def webhook_post(request: Request):
-    payload = await request.body()
-    return {}
-
-@router.get('/', status_code=http.HTTPStatus.ACCEPTED)
-async def webhook_get_all(request: Request):
-    payload = await request.body()
-    return {}
-
-@router.get('/{id}', status_code=http.HTTPStatus.ACCEPTED)
-async def webhook_get_by_id(id: int, request: Request):
-    payload = await request.body()
-    return {}
-
-@router.put('/{id}', status_code=http.HTTPStatus.ACCEPTED)
-async def webhook_put_by_id(id: int, request: Request):
-    payload = await request.body()
-    return {}
-
-@router.delete('/{id}', status_code=http.HTTPStatus.ACCEPTED)
-async def webhook(id: int, request: Request):
-    payload = await request.body()
-    return {}
+# Returns the webhook of a job and its delivery status.
+@router.get('/{id}', response_model=schemas.WebhookResponse)
+async def get_webhook(id: int, db: AsyncSession = Depends(get_db)):
+    job = await get_job_or_404(db, id)
+    return webhook_dict(job)
 
+# Registers or replaces the callback URL of a job.
+"""
+    When the job has already finished the webhook is sent right away.
+"""
+@router.put('/{id}', status_code=status.HTTP_202_ACCEPTED, response_model=schemas.WebhookResponse)
+async def put_webhook(id: int, webhook: schemas.WebhookSchema, db: AsyncSession = Depends(get_db)):
+    job = await get_job_or_404(db, id)
+    job.callback_url = str(webhook.url)
+    job.webhook_status = None
+    job.webhook_attempts = 0
+    await db.commit()
+    if job.status in (jobs.SUCCEEDED, jobs.FAILED):
+        jobs.runner.notify(job.id)
+    return webhook_dict(job)
+
+# Removes the callback URL of a job.
+@router.delete('/{id}', response_model=schemas.WebhookResponse)
+async def delete_webhook(id: int, db: AsyncSession = Depends(get_db)):
+    job = await get_job_or_404(db, id)
+    job.callback_url = None
+    await db.commit()
+    return webhook_dict(job)
+
+# Helper function to get a job or answer with a 404.
+async def get_job_or_404(db, id):
+    job = await db.get(models.IngestJob, id)
+    if not job:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
+                            detail=f"No job with this id: {id} found")
+    return job
+
+# Helper function to convert the webhook of a job to the response format.
+def webhook_dict(job):
+    return {'status': 'success', 'job_id': job.id, 'callback_url': job.callback_url, 'webhook_status': job.webhook_status, 'webhook_attempts': job.webhook_attempts}
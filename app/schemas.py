@@ -1,7 +1,7 @@
 from datetime import datetime
 from typing import List, Union
 import uuid
-from pydantic import BaseModel, BaseConfig
+from pydantic import BaseModel, BaseConfig, HttpUrl
 from shapely.geometry import Point
 from shapely import wkt
 from psycopg2.extensions import register_adapter, AsIs
@@ -42,9 +42,69 @@ class ListTripResponse(BaseModel):
     results: int
     trips: List[TripResponse]
 
-class CSVTripResponse(BaseModel):
+class PageTripResponse(ListTripResponse):
+    next: Union[str, None] = None
+
+class CountTripResponse(BaseModel):
+    status: str
+    count: int
+
+class RejectedRowResponse(BaseModel):
+    line: int
+    error: str
+
+class RejectedTripResponse(BaseModel):
+    index: int
+    error: str
+
+class AddListTripResponse(ListTripResponse):
+    duplicates: int = 0
+    rejected: int = 0
+    errors: List[RejectedTripResponse] = []
+
+class JobAcceptedResponse(BaseModel):
+    status: str
+    job_id: int
+    job_url: str
+
+class JobResponse(BaseModel):
+    id: int
+    status: str
+    filename: Union[str, None]
+    rows_done: int
+    rejected: int
+    duplicates: int
+    rows_per_second: float
+    errors: List[RejectedRowResponse] = []
+    detail: Union[str, None]
+    created_at: datetime
+    started_at: Union[datetime, None]
+    finished_at: Union[datetime, None]
+    callback_url: Union[str, None]
+    webhook_status: Union[str, None]
+    webhook_attempts: int
+
+class WebhookSchema(BaseModel):
+    url: HttpUrl
+
+class WebhookResponse(BaseModel):
+    status: str
+    job_id: int
+    callback_url: Union[str, None]
+    webhook_status: Union[str, None]
+    webhook_attempts: int
+
+class SimilarTripResponse(TripResponse):
+    #Distances in degrees, time difference in seconds and their sum, each relative to its threshold.
+    origin_distance: float
+    destination_distance: float
+    time_difference: float
+    score: float
+
+class SimilarTripsResponse(BaseModel):
     status: str
     results: int
+    trips: List[SimilarTripResponse]
 
 class WeeklyAverageTripsResponse(BaseModel):
     status: str
@@ -57,3 +117,14 @@ class WeeklyAverageTripsByBoundingBoxResponse(WeeklyAverageTripsResponse):
     bottom_left: str
     top_right: str
 
+
+class CacheStatsResponse(BaseModel):
+    status: str
+    enabled: bool
+    backend: Union[str, None]
+    entries: int = 0
+    bytes: int = 0
+    max_bytes: int = 0
+    hits: int = 0
+    misses: int = 0
+    hit_ratio: float = 0.0
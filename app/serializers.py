@@ -0,0 +1,99 @@
+import base64
+import orjson
+from fastapi.responses import ORJSONResponse, StreamingResponse
+from sqlalchemy import select
+from sqlalchemy.sql import func
+from . import models
+
+"""
+    This file defines how trips read straight from the DB are converted to the API format.
+    The coordinates and datetimes are selected already split and formatted by the DB, so the
+    listing endpoints never build ORM objects or shapely geometries for the returned trips.
+"""
+
+#Columns needed to build a trip response without loading the ORM objects or the geometries.
+TRIP_RESPONSE_COLUMNS = (
+    models.Trip.id,
+    models.Trip.region,
+    func.ST_X(models.Trip.origin_coord).label("origin_x"),
+    func.ST_Y(models.Trip.origin_coord).label("origin_y"),
+    func.ST_X(models.Trip.destination_coord).label("destination_x"),
+    func.ST_Y(models.Trip.destination_coord).label("destination_y"),
+    func.to_char(models.Trip.datetime, 'YYYY-MM-DD HH24:MI:SS').label("datetime"),
+    models.Trip.datasource,
+)
+
+NDJSON_MEDIA_TYPE = 'application/x-ndjson'
+
+# Formats a point the same way shapely's wkt.dumps does.
+def format_point(x, y):
+    return 'POINT (%.16f %.16f)' % (x, y)
+
+# Converts a row selected with TRIP_RESPONSE_COLUMNS to the trip response format.
+def trip_row_to_dict(row):
+    return {
+        "id" : row.id,
+        "region" : row.region,
+        "origin_coord" : format_point(row.origin_x, row.origin_y),
+        "destination_coord" : format_point(row.destination_x, row.destination_y),
+        "datetime" : row.datetime,
+        "datasource" : row.datasource
+        }
+
+# Returns a select of the trip response columns, to be filtered by each endpoint.
+def select_trips():
+    return select(*TRIP_RESPONSE_COLUMNS)
+
+# Converts plain rows selected with TRIP_RESPONSE_COLUMNS to trip dicts.
+"""
+    The keys follow the order of schemas.TripResponse so the output is byte for byte the same
+    as the one validated by the response model.
+"""
+def trip_dicts(rows):
+    return [
+        {
+            "region" : region,
+            "origin_coord" : 'POINT (%.16f %.16f)' % (origin_x, origin_y),
+            "destination_coord" : 'POINT (%.16f %.16f)' % (destination_x, destination_y),
+            "datetime" : datetime,
+            "datasource" : datasource,
+            "id" : id
+            }
+        for id, region, origin_x, origin_y, destination_x, destination_y, datetime, datasource in rows
+        ]
+
+# Builds the trips list response straight from plain rows.
+"""
+    The JSON is written with orjson and returned as a Response, so FastAPI skips validating it
+    again against the response model. The next cursor is only included when paginating.
+"""
+def trips_response(rows, next=None, paginated=False):
+    trips = trip_dicts(rows)
+    content = {'status': 'success', 'results': len(trips), 'trips': trips}
+    if paginated:
+        content['next'] = next
+    return ORJSONResponse(content)
+
+# Streams the trips as newline delimited JSON, one trip per line.
+"""
+    The rows are read from a server-side cursor in partitions of STREAM_BATCH_SIZE and each
+    partition is flushed as soon as it arrives. The first partition is passed in by the caller,
+    which fetches it beforehand to answer with a 404 when there are no trips.
+"""
+def trips_ndjson_response(first, partitions):
+    async def stream():
+        yield b"".join([ orjson.dumps(trip) + b"\n" for trip in trip_dicts(first) ])
+        async for partition in partitions:
+            yield b"".join([ orjson.dumps(trip) + b"\n" for trip in trip_dicts(partition) ])
+    return StreamingResponse(stream(), media_type=NDJSON_MEDIA_TYPE)
+
+# Encodes the ID of the last returned trip as an opaque pagination cursor.
+def encode_cursor(id):
+    return base64.urlsafe_b64encode(str(id).encode()).decode()
+
+# Decodes a pagination cursor back to the ID of the last returned trip.
+def decode_cursor(cursor):
+    try:
+        return int(base64.urlsafe_b64decode(cursor.encode()).decode())
+    except ValueError:
+        raise ValueError(f"Invalid cursor: {cursor}")
@@ -0,0 +1,55 @@
+import numpy as np
+from sqlalchemy import BigInteger, bindparam, cast, extract
+from sqlalchemy.dialects.postgresql import DOUBLE_PRECISION, insert
+from sqlalchemy.sql import func
+from .config import settings
+from . import models
+
+"""
+    This file defines how trips are grouped by similarity.
+    Two trips are similar when their origins and destinations fall in the same cells of a grid of
+    SIMILARITY_TOLERANCE degrees and they happened in the same minute. The group key is computed
+    once at ingest time, so the weekly averages only need to count the groups.
+"""
+
+# Computes the similarity group keys for columns of coordinates and datetimes.
+"""
+    Returns one "origin_x:origin_y:destination_x:destination_y:minute" key per trip, where the
+    coordinates are grid cell numbers and the minute is counted from the epoch.
+"""
+def similarity_keys(origin, destination, datetimes, tolerance=None):
+    tolerance = tolerance or settings.SIMILARITY_TOLERANCE
+    #Rejected rows hold NaN coordinates, their keys are computed but never used.
+    with np.errstate(invalid='ignore'):
+        cells = np.floor(np.hstack([origin, destination]) / tolerance).astype(np.int64)
+    minutes = datetimes.astype('datetime64[m]').astype(np.int64)
+    return [ f"{ox}:{oy}:{dx}:{dy}:{minute}" for (ox, oy, dx, dy), minute in zip(cells.tolist(), minutes.tolist()) ]
+
+# Returns the SQL expression computing the same key as similarity_keys for the stored trips.
+def similarity_key_sql(tolerance=None):
+    tolerance = bindparam('tolerance', tolerance or settings.SIMILARITY_TOLERANCE, type_=DOUBLE_PRECISION)
+    cell = lambda coord: cast(func.floor(coord / tolerance), BigInteger)
+    return func.concat_ws(':',
+        cell(func.ST_X(models.Trip.origin_coord)),
+        cell(func.ST_Y(models.Trip.origin_coord)),
+        cell(func.ST_X(models.Trip.destination_coord)),
+        cell(func.ST_Y(models.Trip.destination_coord)),
+        cast(func.floor(extract('epoch', models.Trip.datetime) / 60), BigInteger)
+        )
+
+# Records the similarity groups of the given trips of a parsed batch.
+"""
+    Each group is stored once per region along the minute it belongs to. Groups that already exist
+    are left untouched. Returns the index of the first trip of every group that was new.
+"""
+async def record_groups(db, parsed, keys, indexes):
+    groups = {}
+    for index in indexes:
+        groups.setdefault((keys[index], parsed.region[index]), index)
+    if not groups:
+        return []
+    minutes = parsed.datetime.astype('datetime64[m]')
+    #Sorted so concurrent ingests lock the groups in the same order.
+    rows = [ {"similarity_group" : key, "region" : region, "datetime" : minutes[index].item()} for (key, region), index in sorted(groups.items()) ]
+    query = insert(models.SimilarityGroup).on_conflict_do_nothing().returning(models.SimilarityGroup.similarity_group, models.SimilarityGroup.region)
+    return [ groups[(row.similarity_group, row.region)] for row in await db.execute(query, rows) ]
@@ -0,0 +1,35 @@
+from sqlalchemy import select
+from sqlalchemy.dialects.postgresql import insert
+from . import models
+
+"""
+    This file defines the data version counters used to invalidate cached results.
+    Ingest bumps them in the same transaction as the trips, so a version is only visible
+    once the data it stands for has been committed.
+"""
+
+#Scope of the counter bumped on every write to the trips.
+TRIPS = 'trips'
+
+# Returns the scope of the counter bumped on every write to the trips of a region.
+def region_scope(region):
+    return f"region:{region}"
+
+# Returns the scopes bumped by a write of trips in the given regions.
+def trip_scopes(regions):
+    return (TRIPS,) + tuple(region_scope(region) for region in set(regions))
+
+# Bumps the version of the given scopes.
+async def bump(db, scopes=(TRIPS,)):
+    #Sorted so concurrent ingests lock the counters in the same order.
+    rows = [ {"scope" : scope, "version" : 1} for scope in sorted(set(scopes)) ]
+    query = insert(models.DataVersion)
+    query = query.on_conflict_do_update(
+        index_elements=[models.DataVersion.scope],
+        set_={"version" : models.DataVersion.version + 1}
+        )
+    await db.execute(query, rows)
+
+# Returns the current version of a scope, 0 when it was never bumped.
+async def current(db, scope=TRIPS):
+    return (await db.execute(select(models.DataVersion.version).where(models.DataVersion.scope == scope))).scalar() or 0
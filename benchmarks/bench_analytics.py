@@ -0,0 +1,92 @@
+import argparse
+import asyncio
+import csv
+import time
+import numpy as np
+from sqlalchemy import select
+from sqlalchemy.sql import func
+from app import parsing, similarity, analytics, queries, filters, models
+from app.ingest import TRIP_COLUMNS
+
+"""
+    Latency of the analytics endpoints answered from the in-memory store against the SQL path.
+    Run from the project root with: python -m benchmarks.bench_analytics [--db] [--repeat N] [Data/long.csv]
+    The store is built from the CSV file the same way ingest fills it. With --db the same questions
+    are asked to the database in the .env settings, which must hold the same file, and the results
+    of both paths are compared.
+"""
+
+#Bounding boxes around the regions of the sample data, as the weekly endpoint and /search take them.
+BBOXES = ((7.0, 44.0, 8.5, 46.0), (14.0, 49.5, 15.0, 50.5), (9.5, 53.0, 10.5, 54.0))
+
+# Builds a store from a CSV file, numbering the trips in file order.
+def build_store(path):
+    with open(path, newline='') as f:
+        rows = list(csv.DictReader(f))
+    parsed = parsing.parse_trips(*[ [ row[column] for row in rows ] for column in TRIP_COLUMNS ])
+    keys = similarity.similarity_keys(parsed.origin, parsed.destination, parsed.datetime)
+    indexes = np.flatnonzero(parsed.valid)
+    store = analytics.TripStore()
+    store.append(indexes + 1, parsed.origin[indexes], parsed.destination[indexes], parsed.datetime[indexes], parsed.region[indexes], parsed.datasource[indexes], [ keys[index] for index in indexes.tolist() ])
+    store.refresh_indexes()
+    return store
+
+def point(x, y):
+    return f"POINT({x!r} {y!r})"
+
+# Returns the (name, in-memory call, SQL call) of every measured question.
+def questions(store):
+    cases = []
+    for region in store.regions.values:
+        cases.append((f"weekly {region}",
+                      lambda region=region: store.weekly_average_by_region(region),
+                      lambda db, region=region: queries.execute(db, 'similar_trips_by_region', region=region)))
+    for bbox in BBOXES:
+        cases.append((f"weekly bbox {bbox}",
+                      lambda bbox=bbox: store.weekly_average_by_bbox(bbox),
+                      lambda db, bbox=bbox: queries.execute(db, 'similar_trips_by_bounding_box', bottom_left=point(*bbox[:2]), top_right=point(*bbox[2:]))))
+        cases.append((f"search bbox {bbox}",
+                      lambda bbox=bbox: len(store.search(origin_bbox=bbox)),
+                      lambda db, bbox=bbox: db.execute(select(func.count()).select_from(models.Trip).where(*filters.trip_filters(origin_bbox=bbox)))))
+    return cases
+
+def time_call(function, repeat):
+    start = time.perf_counter()
+    for i in range(repeat):
+        result = function()
+    return (time.perf_counter() - start) / repeat, result
+
+async def time_sql(cases, repeat):
+    from app.database import SessionLocal, engine
+    timings = []
+    async with SessionLocal() as db:
+        for name, memory, sql in cases:
+            start = time.perf_counter()
+            for i in range(repeat):
+                result = (await sql(db)).first()
+            timings.append(((time.perf_counter() - start) / repeat, result[-1] if result else None))
+    await engine.dispose()
+    return timings
+
+def main():
+    parser = argparse.ArgumentParser(prog='python -m benchmarks.bench_analytics')
+    parser.add_argument('path', nargs='?', default='Data/long.csv')
+    parser.add_argument('--repeat', type=int, default=100)
+    parser.add_argument('--db', action='store_true')
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    store = build_store(args.path)
+    print(f"{len(store):,} trips loaded in {(time.perf_counter() - start) * 1000:.1f} ms")
+    cases = questions(store)
+    sql = asyncio.run(time_sql(cases, args.repeat)) if args.db else [ (None, None) ] * len(cases)
+    for (name, memory, query), (sql_time, sql_result) in zip(cases, sql):
+        memory_time, memory_result = time_call(memory, args.repeat)
+        line = f"{name:<42} memory {memory_time * 1000:8.3f} ms"
+        if sql_time is not None:
+            match = sql_result is not None and memory_result is not None and abs(float(sql_result) - float(memory_result)) < 1e-9
+            line += f"  sql {sql_time * 1000:8.3f} ms  {'match' if match or sql_result == memory_result else f'MISMATCH {sql_result} != {memory_result}'}"
+        print(line)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,154 @@
+import argparse
+import asyncio
+import csv
+import json
+import os
+import tempfile
+import time
+import uuid
+import zlib
+from datetime import datetime, timedelta
+import httpx
+import zstandard
+
+"""
+    Bandwidth and end-to-end time of the compressed uploads and listings of a running API.
+    Run from the project root, with the API up, with:
+        python -m benchmarks.bench_compression trips_1M.csv [--url http://localhost:8000] [--encodings identity,gzip,zstd]
+                                                            [--gzip-level 6] [--zstd-level 3] [--limit 10000] [--output result.json]
+    For every encoding the CSV file, usually one from benchmarks.generate, is wrapped in a multipart
+    body, compressed on disk and uploaded with that Content-Encoding, and the job is polled until
+    it finishes. Each upload gets its datetimes shifted by one more day, so its trips are new rather
+    than skipped as duplicates of the previous upload. Then a page of --limit trips is listed with
+    every Accept-Encoding. The bytes sent or received, the compression time and the end-to-end time
+    are printed, and stored as JSON in --output.
+"""
+
+#Bytes read from the file for each chunk compressed.
+CHUNK_SIZE = 1 << 20
+
+#Seconds between polls of the ingest job.
+POLL_INTERVAL = 0.5
+
+# Writes a copy of a CSV file with every datetime shifted by the given amount of days, returning its path.
+def shifted_copy(path, days):
+    fd, output = tempfile.mkstemp(suffix='.csv')
+    with open(path, newline='') as source, os.fdopen(fd, 'w', newline='') as target:
+        reader = csv.reader(source)
+        writer = csv.writer(target, lineterminator='\n')
+        header = next(reader)
+        position = header.index('datetime')
+        writer.writerow(header)
+        for values in reader:
+            if values:
+                values[position] = (datetime.strptime(values[position], '%Y-%m-%d %H:%M:%S') + timedelta(days=days)).strftime('%Y-%m-%d %H:%M:%S')
+                writer.writerow(values)
+    return output
+
+# Returns a new compressor with a gzip-like interface for an encoding, None for identity.
+def new_compressor(encoding, gzip_level, zstd_level):
+    if encoding == 'gzip':
+        return zlib.compressobj(gzip_level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    if encoding == 'zstd':
+        return zstandard.ZstdCompressor(level=zstd_level).compressobj()
+    return None
+
+# Writes the multipart body uploading a file, compressed with an encoding, returning its path, content type and the seconds spent compressing.
+def write_body(path, encoding, gzip_level, zstd_level):
+    boundary = uuid.uuid4().hex
+    compressor = new_compressor(encoding, gzip_level, zstd_level)
+    elapsed = 0.0
+    fd, output = tempfile.mkstemp(suffix='.body')
+    with open(path, 'rb') as source, os.fdopen(fd, 'wb') as target:
+        def write(data):
+            nonlocal elapsed
+            start = time.perf_counter()
+            data = compressor.compress(data) if compressor is not None else data
+            elapsed += time.perf_counter() - start
+            target.write(data)
+        write(f'--{boundary}\r\nContent-Disposition: form-data; name="file"; filename="{os.path.basename(path)}"\r\n'
+              f'Content-Type: text/csv\r\n\r\n'.encode())
+        while chunk := source.read(CHUNK_SIZE):
+            write(chunk)
+        write(f'\r\n--{boundary}--\r\n'.encode())
+        if compressor is not None:
+            start = time.perf_counter()
+            target.write(compressor.flush())
+            elapsed += time.perf_counter() - start
+    return output, f'multipart/form-data; boundary={boundary}', elapsed
+
+# Helper function to stream a file as the body of a request.
+async def read_file(path):
+    with open(path, 'rb') as file:
+        while chunk := file.read(CHUNK_SIZE):
+            yield chunk
+
+# Uploads a file with an encoding and waits for its job, returning the measures of the upload.
+async def upload(client, path, encoding, args):
+    body, content_type, compress_seconds = write_body(path, encoding, args.gzip_level, args.zstd_level)
+    try:
+        headers = {'Content-Type' : content_type}
+        if encoding != 'identity':
+            headers['Content-Encoding'] = encoding
+        sent = os.path.getsize(body)
+        start = time.perf_counter()
+        response = await client.post('/api/trips/upload', content=read_file(body), headers=headers)
+        response.raise_for_status()
+        uploaded = time.perf_counter() - start
+        job_url = response.json()['job_url']
+        while (job := (await client.get(job_url)).json())['status'] not in ('succeeded', 'failed'):
+            await asyncio.sleep(POLL_INTERVAL)
+        elapsed = time.perf_counter() - start
+    finally:
+        os.remove(body)
+    if job['status'] == 'failed':
+        raise RuntimeError(f"The ingest job failed: {job['detail']}")
+    return {"bytes_sent" : sent, "ratio" : os.path.getsize(path) / sent, "compress_seconds" : compress_seconds, "upload_seconds" : uploaded,
+            "total_seconds" : compress_seconds + elapsed, "ingested" : job['rows_done'], "rows_per_second" : job['rows_done'] / (compress_seconds + elapsed)}
+
+# Lists a page of trips with an Accept-Encoding, returning the bytes received and the seconds until the whole body was read.
+async def listing(client, encoding, limit):
+    start = time.perf_counter()
+    async with client.stream('GET', f'/api/trips/?limit={limit}', headers={'Accept-Encoding' : encoding, 'Cache-Control' : 'no-cache'}) as response:
+        response.raise_for_status()
+        size = sum([ len(chunk) async for chunk in response.aiter_bytes() ])
+        received = response.num_bytes_downloaded
+    return {"bytes_received" : received, "ratio" : size / received if received else 0.0, "seconds" : time.perf_counter() - start}
+
+async def run(args):
+    result = {"file" : args.data, "bytes" : os.path.getsize(args.data), "uploads" : {}, "listings" : {}}
+    async with httpx.AsyncClient(base_url=args.url, timeout=args.timeout) as client:
+        for days, encoding in enumerate(args.encodings):
+            path = shifted_copy(args.data, days) if days else args.data
+            try:
+                result['uploads'][encoding] = measures = await upload(client, path, encoding, args)
+            finally:
+                if path != args.data:
+                    os.remove(path)
+            print(f"upload {encoding:>8}: {measures['bytes_sent'] / 1e6:10.1f} MB sent ({measures['ratio']:5.1f}x), "
+                  f"compressed in {measures['compress_seconds']:6.1f} s, uploaded in {measures['upload_seconds']:6.1f} s, "
+                  f"{measures['total_seconds']:6.1f} s end to end ({measures['rows_per_second']:,.0f} rows/s)")
+        for encoding in args.encodings:
+            result['listings'][encoding] = measures = await listing(client, encoding, args.limit)
+            print(f"list {args.limit} {encoding:>8}: {measures['bytes_received'] / 1e6:10.2f} MB received ({measures['ratio']:5.1f}x) in {measures['seconds'] * 1000:8.1f} ms")
+    return result
+
+def main():
+    parser = argparse.ArgumentParser(prog='python -m benchmarks.bench_compression')
+    parser.add_argument('data')
+    parser.add_argument('--url', default='http://localhost:8000')
+    parser.add_argument('--encodings', type=lambda value: value.split(','), default=['identity', 'gzip', 'zstd'])
+    parser.add_argument('--gzip-level', type=int, default=6)
+    parser.add_argument('--zstd-level', type=int, default=3)
+    parser.add_argument('--limit', type=int, default=10000, help='Trips in the listed page')
+    parser.add_argument('--timeout', type=float, default=600)
+    parser.add_argument('--output', default=None, help='File where the result is stored as JSON')
+    args = parser.parse_args()
+
+    result = asyncio.run(run(args))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(result, f, indent=2)
+
+if __name__ == '__main__':
+    main()
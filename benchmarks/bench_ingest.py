@@ -0,0 +1,96 @@
+import argparse
+import asyncio
+import csv
+import multiprocessing
+import os
+import tempfile
+import time
+from datetime import datetime, timedelta
+from concurrent.futures import ProcessPoolExecutor
+from app import parallel, ingest
+from app.config import settings
+
+"""
+    Throughput of the multi-core CSV ingest against the amount of worker processes.
+    Run from the project root with: python -m benchmarks.bench_ingest [--rows N] [--db] [Data/long.csv]
+    The sample file is replicated up to the given amount of rows. Without --db only the parsing
+    stage is measured, which is the part spread over the processes. With --db the whole ingest is
+    run against the database in the .env settings, with as many writers as processes, so the
+    point where the database becomes the bottleneck shows up, and the last file is then posted
+    again to measure the ingest of trips that are all already stored. Note this stores the trips.
+"""
+
+# Writes a file with the header of the sample and its rows repeated up to the given amount.
+"""
+    Every copy of the sample is shifted by one more second, plus shift seconds, so the rows are not
+    skipped as duplicates of each other or of the rows of another file with a different shift.
+"""
+def replicate(path, rows, shift=0):
+    with open(path, newline='') as sample:
+        reader = csv.reader(sample)
+        header = next(reader)
+        lines = [ values for values in reader if values ]
+    position = header.index('datetime')
+    datetimes = [ datetime.strptime(values[position], '%Y-%m-%d %H:%M:%S') for values in lines ]
+    fd, output = tempfile.mkstemp(suffix='.csv')
+    with os.fdopen(fd, 'w', newline='') as file:
+        writer = csv.writer(file, lineterminator='\n')
+        writer.writerow(header)
+        for index in range(rows):
+            values = list(lines[index % len(lines)])
+            values[position] = (datetimes[index % len(lines)] + timedelta(seconds=shift + index // len(lines))).strftime('%Y-%m-%d %H:%M:%S')
+            writer.writerow(values)
+    return output
+
+# Parses every range of the file with a pool of the given size, returning the elapsed seconds.
+def parse_file(path, processes):
+    header, offset = parallel.read_header(path)
+    positions = ingest.header_positions(header)
+    ranges = parallel.split_ranges(path, offset, settings.INGEST_SPLIT_SIZE)
+    with ProcessPoolExecutor(processes, mp_context=multiprocessing.get_context('spawn')) as executor:
+        #Warm up the processes so their start up is not measured.
+        list(executor.map(abs, range(processes)))
+        start = time.perf_counter()
+        futures = [ executor.submit(parallel.parse_range, path, begin, end, len(header), positions) for begin, end in ranges ]
+        for future in futures:
+            future.result()
+        return time.perf_counter() - start
+
+# Ingests the whole file, returning the elapsed seconds.
+async def ingest_file(path, processes):
+    from app.database import engine
+    start = time.perf_counter()
+    await parallel.copy_csv_file(path, processes, processes)
+    elapsed = time.perf_counter() - start
+    await engine.dispose()
+    return elapsed
+
+def main():
+    parser = argparse.ArgumentParser(prog='python -m benchmarks.bench_ingest')
+    parser.add_argument('sample', nargs='?', default='Data/long.csv')
+    parser.add_argument('--rows', type=int, default=500000)
+    parser.add_argument('--db', action='store_true')
+    args = parser.parse_args()
+
+    counts = sorted({ 2 ** power for power in range(os.cpu_count().bit_length()) } | { os.cpu_count() })
+    path = replicate(args.sample, args.rows)
+    try:
+        print(f"{args.rows:,} rows, {os.cpu_count()} cores, {'full ingest' if args.db else 'parsing only'}")
+        baseline = None
+        for run, processes in enumerate(counts):
+            if args.db and run:
+                #A new file for every run, so each one stores new trips.
+                os.remove(path)
+                path = replicate(args.sample, args.rows, run * args.rows)
+            elapsed = asyncio.run(ingest_file(path, processes)) if args.db else parse_file(path, processes)
+            baseline = baseline or elapsed
+            print(f"{processes:>4} processes: {args.rows / elapsed:12,.0f} rows/s  speedup {baseline / elapsed:5.2f}x")
+        if args.db:
+            first = elapsed
+            elapsed = asyncio.run(ingest_file(path, counts[-1]))
+            print(f"{counts[-1]:>4} processes, posted again: {args.rows / elapsed:12,.0f} rows/s  {elapsed / first:5.2f}x the time of the first ingest")
+    finally:
+        os.remove(path)
+
+if __name__ == '__main__':
+    main()
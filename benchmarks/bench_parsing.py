@@ -0,0 +1,40 @@
+import csv
+import sys
+import timeit
+from datetime import datetime
+from shapely import wkt
+from app import parsing
+
+"""
+    Micro-benchmark of the batch parsing stage against the per-row parsing loop it replaced.
+    Run from the project root with: python -m benchmarks.bench_parsing [Data/long.csv]
+"""
+
+# Parses the rows one by one, the way the ingest endpoints used to.
+def parse_per_row(columns):
+    region, origin_coord, destination_coord, dt, datasource = columns
+    parsed = []
+    for i in range(len(region)):
+        parsed.append((
+            region[i],
+            wkt.loads(origin_coord[i]),
+            wkt.loads(destination_coord[i]),
+            datetime.strptime(dt[i], '%Y-%m-%d %H:%M:%S'),
+            datasource[i]
+            ))
+    return parsed
+
+# Parses the whole batch at once with the vectorized stage.
+def parse_batch(columns):
+    return parsing.parse_trips(*columns)
+
+def main(path='Data/long.csv', repeat=5):
+    with open(path, newline='') as f:
+        rows = list(csv.DictReader(f))
+    columns = [ [ row[column] for row in rows ] for column in ('region', 'origin_coord', 'destination_coord', 'datetime', 'datasource') ]
+    for name, function in (('per-row', parse_per_row), ('batch', parse_batch)):
+        best = min(timeit.repeat(lambda: function(columns), number=1, repeat=repeat))
+        print(f"{name:>8}: {best * 1000:8.1f} ms  {len(rows) / best:12,.0f} rows/s")
+
+if __name__ == '__main__':
+    main(*sys.argv[1:])
@@ -0,0 +1,66 @@
+import argparse
+import asyncio
+import statistics
+import subprocess
+import sys
+import time
+from app.config import settings
+from app import plots
+
+"""
+    Cold start of the API processes and throughput of the plot rendering processes.
+    Run from the project root with: python -m benchmarks.bench_plots [--runs N] [--processes N] [--concurrency 1,4,16] [--plots N]
+    The import of app.main is timed in fresh interpreters, as uvicorn workers start or reload, both
+    as it is and along matplotlib.pyplot as it was imported before the plots moved to their own
+    processes. Then the first plot is timed, spawning the pool, and the plots rendered per second are
+    measured for each format at every concurrency level, with the weekly averages of 3 regions.
+"""
+
+REGIONS = ['Hamburg', 'Prague', 'Turin']
+AVERAGES = [ 12.5, 30.25, 7.0 ]
+
+# Returns the median seconds a fresh interpreter takes to run some code.
+def interpreter_time(code, runs):
+    timings = []
+    for i in range(runs):
+        start = time.perf_counter()
+        subprocess.run([ sys.executable, '-c', code ], check=True)
+        timings.append(time.perf_counter() - start)
+    return statistics.median(timings)
+
+# Renders plots with a given amount at once, returning the plots rendered per second.
+async def throughput(format, concurrency, amount):
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def render():
+        async with semaphore:
+            await plots.bar(REGIONS, AVERAGES, format)
+
+    start = time.perf_counter()
+    await asyncio.gather(*[ render() for i in range(amount) ])
+    return amount / (time.perf_counter() - start)
+
+async def run(args):
+    start = time.perf_counter()
+    await plots.bar(REGIONS, AVERAGES)
+    print(f"first plot, spawning {settings.PLOT_PROCESSES} processes: {(time.perf_counter() - start) * 1000:8.1f} ms")
+    for format in plots.MEDIA_TYPES:
+        for concurrency in args.concurrency:
+            print(f"{format} concurrency {concurrency:>3}: {await throughput(format, concurrency, args.plots):8.1f} plots/s")
+    plots.shutdown_pool()
+
+def main():
+    parser = argparse.ArgumentParser(prog='python -m benchmarks.bench_plots')
+    parser.add_argument('--runs', type=int, default=5, help='Interpreters started to time the imports')
+    parser.add_argument('--processes', type=int, default=settings.PLOT_PROCESSES)
+    parser.add_argument('--concurrency', type=lambda value: [ int(level) for level in value.split(',') ], default=[1, 4, 16])
+    parser.add_argument('--plots', type=int, default=100, help='Plots rendered at each concurrency level')
+    args = parser.parse_args()
+
+    print(f"import app.main: {interpreter_time('import app.main', args.runs) * 1000:8.1f} ms")
+    print(f"import app.main with pyplot: {interpreter_time('import app.main, matplotlib.pyplot', args.runs) * 1000:8.1f} ms")
+    settings.PLOT_PROCESSES = args.processes
+    asyncio.run(run(args))
+
+if __name__ == '__main__':
+    main()
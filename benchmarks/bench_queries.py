@@ -0,0 +1,54 @@
+import asyncio
+import sys
+import time
+import timeit
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.sql import text
+from app import queries
+
+"""
+    Per-call overhead of the analytical queries, before and after the query registry.
+    Run from the project root with: python -m benchmarks.bench_queries [--db] [region]
+    Without --db only the client side cost is measured: reading the file, splicing the input and
+    compiling the text query, against looking the query up in the registry. With --db both are run
+    against the database in the .env settings, so the server-side parse and plan are included.
+"""
+
+# Builds the query the way the endpoints did before the registry.
+def old_statement(region):
+    f = open('Queries/similar_trips_by_region.sql', "r")
+    query = f.read().replace(":region", f"'{region}'")
+    f.close()
+    return text(query)
+
+def main(args):
+    use_db = '--db' in args
+    args = [ arg for arg in args if arg != '--db' ]
+    region = args[0] if args else 'Prague'
+    number = 1000
+    dialect = postgresql.dialect()
+
+    old = timeit.timeit(lambda: str(old_statement(region).compile(dialect=dialect)), number=number)
+    new = timeit.timeit(lambda: queries.QUERIES['similar_trips_by_region'].statement.compile(dialect=dialect), number=number)
+    print(f"client side  old: {old / number * 1e6:8.1f} us/call  registry: {new / number * 1e6:8.1f} us/call")
+
+    if use_db:
+        asyncio.run(round_trips(region, number))
+
+# Times both versions against the DB, awaiting each call in turn.
+async def round_trips(region, number):
+    from app.database import SessionLocal, engine
+    async with SessionLocal() as db:
+        start = time.perf_counter()
+        for i in range(number):
+            (await db.execute(old_statement(region))).all()
+        old = time.perf_counter() - start
+        start = time.perf_counter()
+        for i in range(number):
+            (await queries.execute(db, 'similar_trips_by_region', region=region)).all()
+        new = time.perf_counter() - start
+    await engine.dispose()
+    print(f"round trip   old: {old / number * 1e3:8.3f} ms/call  registry: {new / number * 1e3:8.3f} ms/call")
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
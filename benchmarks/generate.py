@@ -0,0 +1,148 @@
+import argparse
+import csv
+import multiprocessing
+import time
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from app import parsing
+
+"""
+    Synthetic trips following the distribution of a sample file, scaled to any amount of rows.
+    Run from the project root with:
+        python -m benchmarks.generate --rows 1000000 [--regions N] [--skew S] [--days D] [--seed N] [--processes N] output.csv
+    The sample is summarized into a model: the centre and spread of the points of each region,
+    the datasources used in each region, and the hours of the day and days of the week the trips
+    start at. The regions are drawn with a Zipf distribution of exponent --skew, ranked by their
+    frequency in the sample, so a few regions hold most of the trips. With --regions above the
+    amount in the sample, extra regions are placed around Europe with the spread of a sample one.
+    The rows are generated in chunks, each from its own seed derived from --seed, so the output is
+    the same for the same arguments whatever the amount of processes.
+"""
+
+#Rows generated by a process at a time.
+CHUNK_ROWS = 250000
+
+#Area where the extra regions are placed, as min_x,min_y,max_x,max_y.
+EXTRA_REGIONS_AREA = (-9.0, 37.0, 28.0, 60.0)
+
+class TripModel:
+    def __init__(self, regions, weights, centres, spreads, datasources, datasource_weights, start, days, hour_weights, weekday_weights):
+        self.regions = regions
+        self.weights = weights
+        #Centre and standard deviation of the points of each region, as (x, y) rows.
+        self.centres = centres
+        self.spreads = spreads
+        self.datasources = datasources
+        #Probability of each datasource in each region, one row per region.
+        self.datasource_weights = datasource_weights
+        self.start = start
+        self.days = days
+        self.hour_weights = hour_weights
+        self.weekday_weights = weekday_weights
+
+# Builds the model of a sample file, with the given amount of regions, skew and days.
+"""
+    The hours and weekdays are counted with one extra trip each, so none of them is left out
+    because the sample is small.
+"""
+def build_model(path, regions=None, skew=1.0, days=None, seed=0):
+    with open(path, newline='') as f:
+        rows = list(csv.DictReader(f))
+    parsed = parsing.parse_trips(*[ [ row[column] for row in rows ] for column in ('region', 'origin_coord', 'destination_coord', 'datetime', 'datasource') ])
+    indexes = np.flatnonzero(parsed.valid)
+    names, counts = np.unique(parsed.region[indexes].astype(str), return_counts=True)
+    order = np.argsort(-counts, kind='stable')
+    names = names[order].tolist()
+    datasources = sorted(set(parsed.datasource[indexes].tolist()))
+
+    centres, spreads, datasource_weights = [], [], []
+    for name in names:
+        region_indexes = indexes[parsed.region[indexes] == name]
+        points = np.concatenate([ parsed.origin[region_indexes], parsed.destination[region_indexes] ])
+        centres.append(points.mean(axis=0))
+        spreads.append(points.std(axis=0))
+        sources = parsed.datasource[region_indexes].tolist()
+        datasource_weights.append([ sources.count(source) / len(sources) for source in datasources ])
+
+    rng = np.random.default_rng(seed)
+    regions = regions or len(names)
+    overall = np.asarray(datasource_weights).mean(axis=0)
+    while len(names) < regions:
+        names.append(f"Region {len(names) + 1}")
+        centres.append(rng.uniform(EXTRA_REGIONS_AREA[:2], EXTRA_REGIONS_AREA[2:]))
+        spreads.append(spreads[rng.integers(len(spreads))])
+        datasource_weights.append(overall)
+    names, centres, spreads, datasource_weights = names[:regions], centres[:regions], spreads[:regions], datasource_weights[:regions]
+
+    weights = 1 / np.arange(1, regions + 1) ** skew
+    datetimes = parsed.datetime[indexes]
+    start = datetimes.min().astype('datetime64[D]')
+    hours = (datetimes.astype('datetime64[h]') - datetimes.astype('datetime64[D]')).astype(int)
+    #1970-01-01 was a Thursday, shift it so Monday is 0.
+    weekdays = (datetimes.astype('datetime64[D]').astype(int) + 3) % 7
+    days = days or int((datetimes.max().astype('datetime64[D]') - start).astype(int)) + 1
+    return TripModel(names, weights / weights.sum(), np.asarray(centres), np.asarray(spreads), datasources,
+                     np.asarray(datasource_weights), start, days,
+                     normalize(np.bincount(hours, minlength=24) + 1), normalize(np.bincount(weekdays, minlength=7) + 1))
+
+def normalize(weights):
+    return weights / weights.sum()
+
+# Generates a chunk of rows as CSV lines, from its own seed.
+def generate_chunk(model, rows, seed):
+    rng = np.random.default_rng(seed)
+    regions = rng.choice(len(model.regions), size=rows, p=model.weights)
+    origin = rng.normal(model.centres[regions], model.spreads[regions])
+    destination = rng.normal(model.centres[regions], model.spreads[regions])
+    #Pick each datasource by inverting the cumulative weights of the region of the trip.
+    cumulative = np.cumsum(model.datasource_weights, axis=1)[regions]
+    datasources = np.minimum((cumulative < rng.random((rows, 1))).sum(axis=1), len(model.datasources) - 1)
+
+    #Days are drawn weighted by their weekday, then an hour of the day and the seconds within it.
+    day_weights = model.weekday_weights[(np.arange(model.days) + (model.start.astype(int) + 3)) % 7]
+    days = rng.choice(model.days, size=rows, p=normalize(day_weights))
+    hours = rng.choice(24, size=rows, p=model.hour_weights)
+    seconds = days * 86400 + hours * 3600 + rng.integers(3600, size=rows)
+    datetimes = np.datetime_as_string(model.start.astype('datetime64[s]') + seconds.astype('timedelta64[s]'), unit='s')
+
+    names = model.regions
+    sources = model.datasources
+    return ''.join([
+        f"{names[region]},POINT ({ox!r} {oy!r}),POINT ({dx!r} {dy!r}),{dt[:10]} {dt[11:]},{sources[source]}\n"
+        for region, (ox, oy), (dx, dy), dt, source in zip(regions.tolist(), origin.tolist(), destination.tolist(), datetimes.tolist(), datasources.tolist())
+        ])
+
+# Writes the given amount of rows to a CSV file, generating the chunks on a pool of processes.
+def generate_file(model, output, rows, seed=0, processes=1):
+    sizes = [ min(CHUNK_ROWS, rows - start) for start in range(0, rows, CHUNK_ROWS) ]
+    seeds = np.random.SeedSequence(seed).spawn(len(sizes))
+    with open(output, 'w', newline='') as file:
+        file.write("region,origin_coord,destination_coord,datetime,datasource\n")
+        if processes > 1:
+            with ProcessPoolExecutor(processes, mp_context=multiprocessing.get_context('spawn')) as executor:
+                for chunk in executor.map(generate_chunk, [ model ] * len(sizes), sizes, seeds):
+                    file.write(chunk)
+        else:
+            for size, chunk_seed in zip(sizes, seeds):
+                file.write(generate_chunk(model, size, chunk_seed))
+
+def main():
+    parser = argparse.ArgumentParser(prog='python -m benchmarks.generate')
+    parser.add_argument('output')
+    parser.add_argument('--rows', type=int, default=1000000)
+    parser.add_argument('--sample', default='Data/trips.csv')
+    parser.add_argument('--regions', type=int, default=None, help='Amount of regions, the ones in the sample by default')
+    parser.add_argument('--skew', type=float, default=1.0, help='Zipf exponent of the region frequencies, 0 for uniform')
+    parser.add_argument('--days', type=int, default=None, help='Days spanned by the trips, the ones in the sample by default')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--processes', type=int, default=1)
+    args = parser.parse_args()
+
+    model = build_model(args.sample, args.regions, args.skew, args.days, args.seed)
+    start = time.perf_counter()
+    generate_file(model, args.output, args.rows, args.seed, args.processes)
+    elapsed = time.perf_counter() - start
+    print(f"{args.rows:,} trips in {len(model.regions)} regions over {model.days} days written to {args.output} in {elapsed:.1f} s ({args.rows / elapsed:,.0f} rows/s)")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,172 @@
+import argparse
+import asyncio
+import csv
+import itertools
+import os
+import time
+from urllib.parse import quote
+import httpx
+from benchmarks import report
+
+"""
+    Load harness driving every endpoint of a running API at several concurrency levels.
+    Run from the project root, with the API and its PostGIS container up (see Running the project), with:
+        python -m benchmarks.load data.csv [--ingest] [--url http://localhost:8000] [--concurrency 1,8,32]
+                                           [--requests 200] [--output result.json] [--baseline benchmarks/baseline.json]
+    With --ingest the file, usually one from benchmarks.generate, is first uploaded and the job
+    polled until it finishes, measuring the ingest rows per second. The parameters of every
+    endpoint are taken from the first rows of the file, so they match stored trips. Every endpoint
+    then gets --requests requests per concurrency level, sent by as many concurrent clients, and
+    the latency percentiles are stored in --output and compared against --baseline.
+    The response cache answers the repeated reads; run the API with CACHE_ENABLED=false to measure
+    the queries themselves.
+"""
+
+#Rows of the file read to pick the parameters of the endpoints.
+SAMPLE_ROWS = 1000
+
+#Seconds between polls of the ingest job.
+POLL_INTERVAL = 0.5
+
+# Returns the parameters of the endpoints, picked from the first rows of the data file.
+def sample_params(path):
+    with open(path, newline='') as f:
+        rows = list(itertools.islice(csv.DictReader(f), SAMPLE_ROWS))
+    row = rows[0]
+    x, y = [ float(value) for value in row['origin_coord'].strip().removeprefix('POINT').strip(' ()').split() ]
+    return {
+        'region' : row['region'],
+        'datasource' : row['datasource'],
+        'date' : row['datetime'][:10],
+        'datetime' : row['datetime'],
+        'bbox' : f"{x - 0.05},{y - 0.05},{x + 0.05},{y + 0.05}",
+        'bottom_left' : f"POINT({x - 0.05} {y - 0.05})",
+        'top_right' : f"POINT({x + 0.05} {y + 0.05})",
+        'origin' : row['origin_coord'],
+        'destination' : row['destination_coord'],
+        'trip' : {key : row[key] for key in ('region', 'origin_coord', 'destination_coord', 'datetime', 'datasource')}
+        }
+
+# Returns the (name, method, path, JSON body) of every endpoint measured.
+"""
+    The listings ask for pages of 100 trips, since the unpaginated ones return every stored trip.
+"""
+def endpoints(params, trip_id, job_id):
+    p = { key : quote(str(value), safe=',') for key, value in params.items() if key != 'trip' }
+    cases = [
+        ('GET /api/healthchecker', 'GET', '/api/healthchecker', None),
+        ('GET /api/trips/', 'GET', '/api/trips/?limit=100', None),
+        ('GET /api/trips/search', 'GET', f"/api/trips/search?region={p['region']}&datasource={p['datasource']}&origin_bbox={p['bbox']}&limit=100", None),
+        ('GET /api/trips/bbox', 'GET', f"/api/trips/bbox?origin_bbox={p['bbox']}&limit=100", None),
+        ('GET /api/trips/bbox/count', 'GET', f"/api/trips/bbox/count?origin_bbox={p['bbox']}", None),
+        ('GET /api/trips/{id}', 'GET', f"/api/trips/{trip_id}", None),
+        ('GET /api/trips/{id}/similar', 'GET', f"/api/trips/{trip_id}/similar?k=10", None),
+        ('GET /api/trips/similar', 'GET', f"/api/trips/similar?origin={p['origin']}&destination={p['destination']}&datetime={p['datetime']}&k=10", None),
+        ('GET /api/trips/region/{region}', 'GET', f"/api/trips/region/{p['region']}?limit=100", None),
+        ('GET /api/trips/datasource/{datasource}', 'GET', f"/api/trips/datasource/{p['datasource']}?limit=100", None),
+        ('GET /api/trips/date/{date}', 'GET', f"/api/trips/date/{p['date']}?limit=100", None),
+        ('GET /api/trips/datetime/{datetime}', 'GET', f"/api/trips/datetime/{p['datetime']}?limit=100", None),
+        ('GET /api/trips/weekly/{region}', 'GET', f"/api/trips/weekly/{p['region']}", None),
+        ('GET /api/trips/weekly/{bottom_left}/{top_right}', 'GET', f"/api/trips/weekly/{p['bottom_left']}/{p['top_right']}", None),
+        ('GET /api/trips/cheap_mobile/', 'GET', '/api/trips/cheap_mobile/', None),
+        ('GET /api/trips/datasource_regions/{datasource}', 'GET', f"/api/trips/datasource_regions/{p['datasource']}", None),
+        ('GET /api/trips/latest_datasources/', 'GET', '/api/trips/latest_datasources/', None),
+        ('GET /api/trips/plot/', 'GET', '/api/trips/plot/', None),
+        ('GET /api/cache/', 'GET', '/api/cache/', None),
+        ('POST /api/trips/add', 'POST', '/api/trips/add', params['trip']),
+        ('POST /api/trips/addlist', 'POST', '/api/trips/addlist', {'trips' : [ params['trip'] ] * 100}),
+        ]
+    if job_id is not None:
+        cases += [
+            ('GET /api/jobs/{id}', 'GET', f"/api/jobs/{job_id}", None),
+            ('GET /api/webhooks/{id}', 'GET', f"/api/webhooks/{job_id}", None),
+            ]
+    return cases
+
+# Uploads the data file and polls its job until it finishes, returning the ingest measures and the job ID.
+async def ingest(client, path):
+    rows = sum(1 for line in open(path, 'rb')) - 1
+    start = time.perf_counter()
+    with open(path, 'rb') as file:
+        response = await client.post('/api/trips/upload', files={'file' : (os.path.basename(path), file, 'text/csv')})
+    response.raise_for_status()
+    job_url = response.json()['job_url']
+    while True:
+        job = (await client.get(job_url)).json()
+        if job['status'] in ('succeeded', 'failed'):
+            break
+        await asyncio.sleep(POLL_INTERVAL)
+    elapsed = time.perf_counter() - start
+    if job['status'] == 'failed':
+        raise RuntimeError(f"The ingest job failed: {job['detail']}")
+    return {"rows" : rows, "ingested" : job['rows_done'], "rejected" : job['rejected'], "seconds" : elapsed,
+            "rows_per_second" : job['rows_per_second'], "total_rows_per_second" : job['rows_done'] / elapsed}, job['id']
+
+# Sends the requests of an endpoint from as many concurrent clients as the concurrency, returning their summary.
+async def run_level(client, method, path, body, concurrency, requests):
+    latencies = []
+    errors = 0
+    remaining = iter(range(requests))
+
+    async def worker():
+        nonlocal errors
+        for i in remaining:
+            start = time.perf_counter()
+            try:
+                response = await client.request(method, path, json=body)
+                ok = response.is_success or response.status_code == 304
+            except httpx.HTTPError:
+                ok = False
+            if ok:
+                latencies.append(time.perf_counter() - start)
+            else:
+                errors += 1
+
+    start = time.perf_counter()
+    await asyncio.gather(*[ worker() for i in range(concurrency) ])
+    return report.summarize(latencies, errors, time.perf_counter() - start)
+
+async def run(args):
+    params = sample_params(args.data)
+    result = report.new_result(args.url, {"file" : args.data, "rows" : None})
+    limits = httpx.Limits(max_connections=max(args.concurrency), max_keepalive_connections=max(args.concurrency))
+    async with httpx.AsyncClient(base_url=args.url, timeout=args.timeout, limits=limits) as client:
+        job_id = None
+        if args.ingest:
+            result['ingest'], job_id = await ingest(client, args.data)
+            result['data']['rows'] = result['ingest']['rows']
+            print(f"ingested {result['ingest']['ingested']:,} rows in {result['ingest']['seconds']:.1f} s")
+        first = (await client.get('/api/trips/?limit=1')).json()
+        trip_id = first['trips'][0]['id'] if first.get('trips') else 1
+        result['cache'] = (await client.get('/api/cache/')).json()
+        for name, method, path, body in endpoints(params, trip_id, job_id):
+            #A few requests first, so connections are open and the first query is planned.
+            await run_level(client, method, path, body, 1, args.warmup)
+            result['endpoints'][name] = {}
+            for concurrency in args.concurrency:
+                result['endpoints'][name][str(concurrency)] = await run_level(client, method, path, body, concurrency, args.requests)
+    return result
+
+def main():
+    parser = argparse.ArgumentParser(prog='python -m benchmarks.load')
+    parser.add_argument('data', nargs='?', default='Data/long.csv')
+    parser.add_argument('--url', default='http://localhost:8000')
+    parser.add_argument('--ingest', action='store_true', help='Upload the data file first and measure the ingest')
+    parser.add_argument('--concurrency', type=lambda value: [ int(level) for level in value.split(',') ], default=[1, 8, 32])
+    parser.add_argument('--requests', type=int, default=200, help='Requests per endpoint and concurrency level')
+    parser.add_argument('--warmup', type=int, default=5)
+    parser.add_argument('--timeout', type=float, default=60)
+    parser.add_argument('--output', default=None, help='File where the result is stored as JSON')
+    parser.add_argument('--baseline', default=None, help='Stored result to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.2)
+    args = parser.parse_args()
+
+    result = asyncio.run(run(args))
+    if args.output:
+        report.save(result, args.output)
+    regressions = report.compare(result, report.load(args.baseline) if args.baseline else None, args.tolerance)
+    if regressions:
+        raise SystemExit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,97 @@
+import argparse
+import json
+import subprocess
+import sys
+from datetime import datetime
+import numpy as np
+
+"""
+    Results of the load harness, stored as JSON and compared against a baseline.
+    Run from the project root with: python -m benchmarks.report results.json [--baseline benchmarks/baseline.json] [--tolerance 0.2]
+    A result holds the commit it was measured at, the ingest rows per second and the latency
+    percentiles of every endpoint at every concurrency level. Comparing two results flags as a
+    regression any p95 slower, or ingest rate lower, than the baseline by more than the tolerance.
+"""
+
+# Returns the current git commit, or None outside a repository.
+def current_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+# Returns a new empty result.
+def new_result(url, data):
+    return {"commit" : current_commit(), "created_at" : datetime.utcnow().isoformat(timespec='seconds'), "url" : url,
+            "data" : data, "cache" : None, "ingest" : None, "endpoints" : {}}
+
+# Summarizes the latencies in seconds of a run at a concurrency level.
+def summarize(latencies, errors, elapsed):
+    latencies = np.asarray(latencies) * 1000
+    p50, p95, p99 = np.percentile(latencies, (50, 95, 99)) if len(latencies) else (None, None, None)
+    return {
+        "requests" : len(latencies) + errors,
+        "errors" : errors,
+        "p50_ms" : p50,
+        "p95_ms" : p95,
+        "p99_ms" : p99,
+        "requests_per_second" : (len(latencies) + errors) / elapsed if elapsed > 0 else 0.0
+        }
+
+def load(path):
+    with open(path) as f:
+        return json.load(f)
+
+def save(result, path):
+    with open(path, 'w') as f:
+        json.dump(result, f, indent=2)
+
+# Helper function to format a value against its baseline.
+def change(value, base):
+    if value is None:
+        return f"{'-':>10}"
+    if base is None or not base:
+        return f"{value:10.2f}"
+    return f"{value:10.2f} ({(value - base) / base:+6.1%})"
+
+# Prints a result, against a baseline when given, returning the regressions found.
+def compare(result, baseline=None, tolerance=0.2, out=sys.stdout):
+    regressions = []
+    print(f"commit {result['commit']} at {result['created_at']}" + (f", baseline {baseline['commit']} at {baseline['created_at']}" if baseline else ""), file=out)
+    ingest = result.get('ingest')
+    base_ingest = (baseline or {}).get('ingest') or {}
+    if ingest:
+        base_rate = base_ingest.get('rows_per_second')
+        print(f"ingest {ingest['rows']:,} rows: job {change(ingest['rows_per_second'], base_rate)} rows/s, "
+              f"with the upload {ingest['total_rows_per_second']:,.0f} rows/s", file=out)
+        if base_rate and ingest['rows_per_second'] < base_rate * (1 - tolerance):
+            regressions.append(f"ingest rows/s {ingest['rows_per_second']:,.0f} < {base_rate:,.0f}")
+    print(f"{'endpoint':<48} {'conc':>4} {'p50 ms':>19} {'p95 ms':>19} {'p99 ms':>19} {'req/s':>9} {'errors':>6}", file=out)
+    base_endpoints = (baseline or {}).get('endpoints', {})
+    for endpoint, levels in result['endpoints'].items():
+        for concurrency, stats in levels.items():
+            base = base_endpoints.get(endpoint, {}).get(concurrency, {})
+            line = (f"{endpoint:<48} {concurrency:>4} {change(stats['p50_ms'], base.get('p50_ms')):>19} {change(stats['p95_ms'], base.get('p95_ms')):>19} "
+                    f"{change(stats['p99_ms'], base.get('p99_ms')):>19} {stats['requests_per_second']:9.1f} {stats['errors']:6}")
+            if stats['errors']:
+                regressions.append(f"{endpoint} at {concurrency}: {stats['errors']} errors")
+            if base.get('p95_ms') and stats['p95_ms'] is not None and stats['p95_ms'] > base['p95_ms'] * (1 + tolerance):
+                regressions.append(f"{endpoint} at {concurrency}: p95 {stats['p95_ms']:.2f} ms > {base['p95_ms']:.2f} ms")
+                line += "  REGRESSION"
+            print(line, file=out)
+    for regression in regressions:
+        print(f"regression: {regression}", file=out)
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(prog='python -m benchmarks.report')
+    parser.add_argument('result')
+    parser.add_argument('--baseline', default=None)
+    parser.add_argument('--tolerance', type=float, default=0.2)
+    args = parser.parse_args()
+    regressions = compare(load(args.result), load(args.baseline) if args.baseline else None, args.tolerance)
+    if regressions:
+        raise SystemExit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,3 @@
+#!/bin/bash
+#Allow the read replica of docker-compose to stream the WAL of this instance.
+echo "host replication all all scram-sha-256" >> "$PGDATA/pg_hba.conf"
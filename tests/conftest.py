@@ -0,0 +1,28 @@
+import os
+import pytest
+
+"""
+    The tests marked as db run against the DB in the .env settings, migrated to the last revision.
+    They only run with --db, and then fail when the DB can't be reached instead of being skipped.
+    The other tests run without a DB, and placeholders are set for the connection variables of the
+    settings when there is no .env file.
+"""
+
+if not os.path.exists('.env'):
+    for name, value in (('DATABASE_PORT', '6500'), ('POSTGRES_PASSWORD', 'password'), ('POSTGRES_USER', 'postgres'), ('POSTGRES_DB', 'jobsity'),
+                        ('POSTGRES_HOST', 'postgres'), ('POSTGRES_HOSTNAME', '127.0.0.1'), ('CLIENT_ORIGIN', 'http://localhost:3000')):
+        os.environ.setdefault(name, value)
+
+def pytest_addoption(parser):
+    parser.addoption('--db', action='store_true', help="Run the tests marked as db against the DB in the .env settings")
+
+def pytest_configure(config):
+    config.addinivalue_line('markers', "db: needs the DB in the .env settings, only run with --db")
+
+def pytest_collection_modifyitems(config, items):
+    if config.getoption('--db'):
+        return
+    skip = pytest.mark.skip(reason="Needs the DB in the .env settings, run with --db")
+    for item in items:
+        if 'db' in item.keywords:
+            item.add_marker(skip)
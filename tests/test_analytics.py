@@ -0,0 +1,79 @@
+import numpy as np
+import pytest
+from app import analytics
+
+#Boxes in every quadrant, crossing both axes, and covering everything.
+BOXES = [
+    (1.0, 1.0, 6.0, 6.0),
+    (-6.0, 1.0, -1.0, 6.0),
+    (-6.0, -6.0, -1.0, -1.0),
+    (1.0, -6.0, 6.0, -1.0),
+    (-2.5, -2.5, 2.5, 2.5),
+    (-0.3, -9.0, 0.3, 9.0),
+    (-10.0, -10.0, 10.0, 10.0),
+    ]
+
+@pytest.fixture(scope='module')
+def trips():
+    random = np.random.default_rng(7)
+    size = 20000
+    return {
+        'id' : np.arange(1, size + 1),
+        'origin' : random.uniform(-8, 8, (size, 2)),
+        'destination' : random.uniform(-8, 8, (size, 2)),
+        'datetime' : np.datetime64('2018-05-01T00:00:00') + random.integers(0, 60 * 86400, size).astype('timedelta64[s]'),
+        'region' : random.choice(['Prague', 'Turin', 'Hamburg'], size),
+        'datasource' : random.choice(['cheap_mobile', 'funny_car'], size),
+        'group' : random.choice([ f'g{i}' for i in range(500) ] + [ None ], size),
+        }
+
+@pytest.fixture(scope='module')
+def store(trips):
+    store = analytics.TripStore(cell_size=0.5)
+    store.append(trips['id'], trips['origin'], trips['destination'], trips['datetime'], trips['region'], trips['datasource'], trips['group'])
+    store.refresh_indexes()
+    return store
+
+def inside(points, bbox):
+    return (points[:, 0] >= bbox[0]) & (points[:, 0] <= bbox[2]) & (points[:, 1] >= bbox[1]) & (points[:, 1] <= bbox[3])
+
+@pytest.mark.parametrize('bbox', BOXES)
+def test_origin_bbox_search_matches_brute_force(store, trips, bbox):
+    expected = trips['id'][inside(trips['origin'], bbox)]
+    assert len(expected)
+    assert store.column('id')[store.search(origin_bbox=bbox)].tolist() == expected.tolist()
+
+@pytest.mark.parametrize('bbox', BOXES)
+def test_destination_bbox_search_matches_brute_force(store, trips, bbox):
+    expected = trips['id'][inside(trips['destination'], bbox)]
+    assert store.column('id')[store.search(destination_bbox=bbox)].tolist() == expected.tolist()
+
+def test_combined_filters_match_brute_force(store, trips):
+    bbox = (-4.0, -4.0, 0.5, 0.5)
+    start, end = np.datetime64('2018-05-10T00:00:00'), np.datetime64('2018-06-01T00:00:00')
+    mask = inside(trips['origin'], bbox) & (trips['region'] == 'Turin') & (trips['datetime'] >= start) & (trips['datetime'] < end)
+    rows = store.search(region='Turin', start=start.item(), end=end.item(), origin_bbox=bbox)
+    assert store.column('id')[rows].tolist() == trips['id'][mask].tolist()
+
+@pytest.mark.parametrize('bbox', BOXES)
+def test_weekly_average_by_bbox_matches_brute_force(store, trips, bbox):
+    mask = inside(trips['origin'], bbox) & inside(trips['destination'], bbox)
+    weeks = analytics.week_starts(trips['datetime'][mask])
+    groups = trips['group'][mask]
+    first_weeks = {}
+    for group, week in zip(groups.tolist(), weeks.tolist()):
+        if group is not None:
+            first_weeks.setdefault(group, week)
+    expected = len(first_weeks) / len(set(weeks.tolist())) if mask.any() else None
+    assert store.weekly_average_by_bbox(bbox) == pytest.approx(expected)
+
+def test_unindexed_tail_is_searched(trips):
+    store = analytics.TripStore(cell_size=0.5)
+    store.append(trips['id'], trips['origin'], trips['destination'], trips['datetime'], trips['region'], trips['datasource'], trips['group'])
+    store.refresh_indexes()
+    store.append([ 0 ], [ [ -3.2, -3.2 ] ], [ [ 3.2, 3.2 ] ], [ '2018-05-02T10:00:00' ], [ 'Prague' ], [ 'funny_car' ], [ None ])
+    assert 0 in store.column('id')[store.search(origin_bbox=(-3.3, -3.3, -3.1, -3.1))].tolist()
+
+def test_week_starts_are_mondays():
+    datetimes = np.array([ '2018-05-27T23:59:59', '2018-05-28T00:00:00', '2018-06-03T12:00:00' ], dtype='datetime64[s]')
+    assert analytics.week_starts(datetimes).astype('datetime64[D]').astype(str).tolist() == [ '2018-05-21', '2018-05-28', '2018-05-28' ]
@@ -0,0 +1,137 @@
+import asyncio
+import sqlite3
+import time
+import pytest
+from fastapi import Request, Response
+from fastapi.responses import StreamingResponse
+from app import cache
+
+"""
+    Eviction and expiry of the cache backends, and the hits, misses and 304s of the response cache.
+"""
+
+@pytest.fixture(params=[ 'memory', 'sqlite' ])
+def new_backend(request, tmp_path):
+    if request.param == 'memory':
+        return cache.MemoryBackend
+    return lambda max_bytes: cache.SQLiteBackend(str(tmp_path / 'cache.sqlite3'), max_bytes)
+
+# Helper function to create an entry expiring in an hour.
+def entry(body, etag='"etag"'):
+    return cache.CacheEntry(body, 'application/json', etag, time.time() + 3600)
+
+# Helper function to create a GET request.
+def request(path='/api/trips/', query=b'', headers=()):
+    return Request({'type' : 'http', 'method' : 'GET', 'path' : path, 'query_string' : query,
+                    'headers' : [ (name.encode(), value.encode()) for name, value in headers ]})
+
+def test_backends_evict_the_least_recently_used(new_backend):
+    backend = new_backend(10)
+    backend.set('a', entry(b'aaaa'))
+    backend.set('b', entry(b'bbbb'))
+    assert backend.get('a').body == b'aaaa'
+    backend.set('c', entry(b'cccc'))
+    assert backend.get('b') is None
+    assert backend.get('a').body == b'aaaa'
+    assert backend.get('c').body == b'cccc'
+    assert tuple(backend.usage()) == (2, 8)
+
+def test_backends_replace_entries(new_backend):
+    backend = new_backend(10)
+    backend.set('a', entry(b'aaaa'))
+    backend.set('a', entry(b'aaaaaa'))
+    assert backend.get('a').body == b'aaaaaa'
+    assert tuple(backend.usage()) == (1, 6)
+
+def test_backends_drop_entries_larger_than_the_limit(new_backend):
+    backend = new_backend(10)
+    backend.set('a', entry(b'a' * 11))
+    assert backend.get('a') is None
+    assert tuple(backend.usage()) == (0, 0)
+
+def test_backends_drop_expired_entries(new_backend):
+    backend = new_backend(10)
+    backend.set('a', cache.CacheEntry(b'aaaa', 'application/json', '"etag"', time.time() - 1))
+    assert backend.get('a') is None
+    backend.clear()
+    assert tuple(backend.usage()) == (0, 0)
+
+def test_sqlite_backend_closes_its_connections(tmp_path, monkeypatch):
+    opened = []
+
+    class Connection(sqlite3.Connection):
+        def close(self):
+            opened.remove(self)
+            super().close()
+
+    backend = cache.SQLiteBackend(str(tmp_path / 'cache.sqlite3'), 10)
+    monkeypatch.setattr(backend, 'connect', lambda: opened.append(sqlite3.connect(backend.path, isolation_level=None, factory=Connection)) or opened[-1])
+    backend.set('a', entry(b'aaaa'))
+    backend.get('a')
+    backend.usage()
+    backend.clear()
+    with pytest.raises(sqlite3.Error):
+        backend.set('b', entry(None))
+    assert opened == []
+    assert tuple(backend.usage()) == (0, 0)
+
+def test_cache_key_sorts_the_query_and_keeps_the_accept_header():
+    first = request(query=b'page=2&limit=5', headers=[ ('accept', 'application/x-ndjson') ])
+    second = request(query=b'limit=5&page=2', headers=[ ('accept', 'application/x-ndjson') ])
+    assert cache.cache_key(first, 3) == cache.cache_key(second, 3)
+    assert cache.cache_key(first, 3) != cache.cache_key(first, 4)
+    assert cache.cache_key(first, 3) != cache.cache_key(request(query=b'page=2&limit=5'), 3)
+
+@pytest.mark.parametrize('if_none_match, matches', [
+    (None, False),
+    ('"abc"', True),
+    ('W/"abc"', True),
+    ('"xyz", "abc"', True),
+    ('*', True),
+    ('"abcd"', False),
+    ])
+def test_etag_matches(if_none_match, matches):
+    assert cache.etag_matches(if_none_match, '"abc"') == matches
+
+class Builder:
+    def __init__(self, content):
+        self.content = content
+        self.calls = 0
+
+    async def __call__(self):
+        self.calls += 1
+        return self.content
+
+def test_respond_builds_on_misses_only():
+    response_cache = cache.ResponseCache(cache.MemoryBackend(1024), 60, 0)
+    build = Builder({'status' : 'success', 'trips' : []})
+    first = asyncio.run(response_cache.respond(request(), 1, build))
+    second = asyncio.run(response_cache.respond(request(), 1, build))
+    assert build.calls == 1
+    assert first.body == second.body
+    assert first.headers['etag'] == second.headers['etag']
+    assert first.headers['cache-control'] == 'no-cache'
+    asyncio.run(response_cache.respond(request(), 2, build))
+    assert build.calls == 2
+    assert (response_cache.hits, response_cache.misses) == (1, 2)
+
+def test_respond_answers_matching_etags_with_304():
+    response_cache = cache.ResponseCache(cache.MemoryBackend(1024), 60, 30)
+    build = Builder({'status' : 'success'})
+    etag = asyncio.run(response_cache.respond(request(), 1, build)).headers['etag']
+    response = asyncio.run(response_cache.respond(request(headers=[ ('if-none-match', etag) ]), 1, build))
+    assert response.status_code == 304
+    assert response.body == b''
+    assert response.headers['etag'] == etag
+    assert response.headers['cache-control'] == 'max-age=30'
+    response = asyncio.run(response_cache.respond(request(headers=[ ('if-none-match', '"other"') ]), 1, build))
+    assert response.status_code == 200
+
+def test_respond_doesnt_store_errors_or_streams():
+    response_cache = cache.ResponseCache(cache.MemoryBackend(1024), 60, 0)
+    for content in (Response(b'{"detail":"No trips found"}', status_code=404), StreamingResponse(iter([ b'{}\n' ]))):
+        build = Builder(content)
+        assert asyncio.run(response_cache.respond(request(), 1, build)) is content
+        assert asyncio.run(response_cache.respond(request(), 1, build)) is content
+        assert build.calls == 2
+    assert tuple(response_cache.backend.usage()) == (0, 0)
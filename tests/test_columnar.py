@@ -0,0 +1,97 @@
+from datetime import datetime, timezone
+import pyarrow as pa
+import pyarrow.parquet as pq
+import pytest
+from app import columnar, ingest
+
+"""
+    Round trips of the columnar export through the import parsing, and the rejection of invalid rows.
+"""
+
+ROWS = [
+    (1, 'Prague', 14.4973794438195, 50.00136875782316, 14.43109483523328, 50.04052930943246, datetime(2018, 5, 28, 9, 3, 40), 'funny_car'),
+    (2, 'Turin', 7.672837913286881, 44.9957109242058, 7.720368637535126, 45.06782385393849, datetime(2018, 5, 21, 2, 54, 4), 'baba_car'),
+    (3, 'Prague', -10.5, -0.1, 0.0, 0.0, datetime(2018, 12, 31, 23, 59, 59), 'cheap_mobile'),
+    ]
+
+# Helper function to write rows with a BatchWriter to a file, in batches of the given size.
+def export(path, format, rows, size=2):
+    writer = columnar.BatchWriter(format)
+    with open(path, 'wb') as file:
+        for start in range(0, len(rows), size):
+            file.write(writer.write(rows[start:start + size]))
+        file.write(writer.close())
+    return path
+
+# Helper function to write a table with the import columns, the datetimes given as a list of values of any type.
+def write_table(path, datetimes, **columns):
+    values = {'region' : [ 'Prague' ] * len(datetimes), 'origin_lon' : [ 14.5 ] * len(datetimes), 'origin_lat' : [ 50.0 ] * len(datetimes),
+              'destination_lon' : [ 14.4 ] * len(datetimes), 'destination_lat' : [ 50.1 ] * len(datetimes), 'datetime' : datetimes,
+              'datasource' : [ 'funny_car' ] * len(datetimes)}
+    values.update(columns)
+    pq.write_table(pa.table(values), path)
+    return path
+
+@pytest.mark.parametrize('format', [ columnar.PARQUET, columnar.ARROW ])
+def test_exports_are_read_back_by_the_import(tmp_path, format):
+    path = export(tmp_path / f"trips.{format}", format, ROWS)
+    batches = list(columnar.read_batches(str(path), format))
+    assert sum(batch.num_rows for batch in batches) == len(ROWS)
+    rows = [ row for batch in batches for row in columnar.parse_batch(batch).valid_rows() ]
+    assert [ (region, origin, destination, when, datasource) for index, region, origin, destination, when, datasource in rows ] == [
+        (region, [ origin_lon, origin_lat ], [ destination_lon, destination_lat ], when, datasource)
+        for id, region, origin_lon, origin_lat, destination_lon, destination_lat, when, datasource in ROWS ]
+
+@pytest.mark.parametrize('format', [ columnar.PARQUET, columnar.ARROW ])
+def test_empty_exports_keep_the_schema(tmp_path, format):
+    path = export(tmp_path / f"trips.{format}", format, [])
+    reader = pq.ParquetFile(path) if format == columnar.PARQUET else pa.ipc.open_stream(path)
+    schema = reader.schema_arrow if format == columnar.PARQUET else reader.schema
+    assert schema.names == columnar.SCHEMA.names
+    assert sum(batch.num_rows for batch in columnar.read_batches(str(path), format)) == 0
+
+def test_import_reads_arrow_files_in_the_file_format(tmp_path):
+    path = tmp_path / 'trips.arrow'
+    with pa.ipc.new_file(str(path), columnar.SCHEMA) as writer:
+        writer.write_batch(columnar.record_batch(ROWS))
+    batches = list(columnar.read_batches(str(path), columnar.ARROW))
+    assert sum(batch.num_rows for batch in batches) == len(ROWS)
+
+def test_import_requires_the_columns(tmp_path):
+    path = tmp_path / 'trips.parquet'
+    pq.write_table(pa.table({'region' : [ 'Prague' ], 'datetime' : [ datetime(2018, 5, 28) ]}), path)
+    with pytest.raises(ingest.IngestError, match='origin_lon, origin_lat, destination_lon, destination_lat, datasource'):
+        list(columnar.read_batches(str(path), columnar.PARQUET))
+
+def test_parse_batch_rejects_missing_values_and_invalid_coordinates(tmp_path):
+    path = write_table(tmp_path / 'trips.parquet', [ datetime(2018, 5, 28) ] * 5, region=[ 'Prague', None, '', 'Prague', 'Prague' ],
+                       origin_lon=[ 14.5, 14.5, 14.5, float('nan'), 14.5 ], destination_lat=[ 50.1, 50.1, 50.1, 50.1, float('inf') ])
+    parsed = columnar.parse_batch(next(columnar.read_batches(str(path), columnar.PARQUET)))
+    assert parsed.valid.tolist() == [ True, False, False, False, False ]
+    assert parsed.errors[1] == "Missing value for column 'region'"
+    assert parsed.errors[2] == "Missing value for column 'region'"
+    assert parsed.errors[3].startswith("Invalid coordinates for the origin")
+    assert parsed.errors[4].startswith("Invalid coordinates for the destination")
+
+def test_parse_batch_truncates_datetimes_to_utc_seconds(tmp_path):
+    path = tmp_path / 'trips.parquet'
+    datetimes = pa.array([ datetime(2018, 5, 28, 11, 3, 40, 999999, tzinfo=timezone.utc) ], pa.timestamp('us', tz='Europe/Prague'))
+    write_table(path, datetimes)
+    parsed = columnar.parse_batch(next(columnar.read_batches(str(path), columnar.PARQUET)))
+    assert [ row[4] for row in parsed.valid_rows() ] == [ datetime(2018, 5, 28, 11, 3, 40) ]
+
+def test_parse_batch_requires_timestamps(tmp_path):
+    path = write_table(tmp_path / 'trips.parquet', [ '2018-05-28 09:03:40' ])
+    with pytest.raises(ingest.IngestError, match='must be a timestamp'):
+        columnar.parse_batch(next(columnar.read_batches(str(path), columnar.PARQUET)))
+
+@pytest.mark.parametrize('filename, format', [
+    ('trips.parquet', columnar.PARQUET),
+    ('TRIPS.PQ', columnar.PARQUET),
+    ('trips.arrow', columnar.ARROW),
+    ('trips.feather', columnar.ARROW),
+    ('trips.csv', None),
+    (None, None),
+    ])
+def test_format_from_filename(filename, format):
+    assert columnar.format_from_filename(filename) == format
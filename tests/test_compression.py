@@ -0,0 +1,152 @@
+import gzip
+import os
+import pytest
+import zstandard
+from fastapi import FastAPI, HTTPException, Request
+from starlette.applications import Starlette
+from starlette.responses import JSONResponse
+from starlette.routing import Route
+from starlette.testclient import TestClient
+from app import compression
+from app.config import settings
+
+"""
+    Round trips of the request and response compression, and the limits of the decompression.
+"""
+
+BODY = b''.join(b'%d,%f,%f,Hamburg,2018-05-28 09:03:40,cheap_mobile\n' % (i, i * 0.37, i * 1.3) for i in range(20000)) + os.urandom(100000)
+
+# Returns a body compressed in several gzip members or zstd frames.
+def compress(encoding, parts):
+    if encoding == compression.GZIP:
+        return b''.join(gzip.compress(part) for part in parts)
+    return b''.join(zstandard.ZstdCompressor().compress(part) for part in parts)
+
+# Returns a body decoded from chunks of a given size, checking the size of every piece handed out.
+def decode(encoding, data, chunk_size):
+    decoder = compression.Decoder(encoding)
+    output = []
+    for start in range(0, len(data), chunk_size):
+        for piece in decoder.decompress(data[start:start + chunk_size]):
+            assert len(piece) < compression.DECOMPRESSION_CHUNK_SIZE + (8 << 20)
+            output.append(piece)
+    decoder.finish()
+    return b''.join(output)
+
+@pytest.mark.parametrize('encoding', compression.ENCODINGS)
+@pytest.mark.parametrize('chunk_size', [ 1, 1000, 65536, 1 << 30 ])
+def test_decoder_round_trips_several_members(encoding, chunk_size):
+    parts = [ BODY[:300000], b'', BODY[300000:] ]
+    if chunk_size == 1:
+        parts = [ BODY[:5000], BODY[5000:6000] ]
+    expected = b''.join(parts)
+    assert decode(encoding, compress(encoding, parts), chunk_size) == expected
+
+@pytest.mark.parametrize('encoding', compression.ENCODINGS)
+def test_decoder_refuses_truncated_bodies(encoding):
+    data = compress(encoding, [ BODY ])
+    with pytest.raises(HTTPException) as error:
+        decode(encoding, data[:-10], 65536)
+    assert error.value.status_code == 400
+
+@pytest.mark.parametrize('encoding', compression.ENCODINGS)
+def test_decoder_refuses_corrupt_bodies(encoding):
+    with pytest.raises(HTTPException) as error:
+        decode(encoding, b'not compressed at all', 65536)
+    assert error.value.status_code == 400
+
+@pytest.mark.parametrize('encoding', compression.ENCODINGS)
+def test_decoder_stops_bombs_at_the_limit(encoding, monkeypatch):
+    monkeypatch.setattr(settings, 'COMPRESSION_MAX_BODY_SIZE', 10 << 20)
+    data = compress(encoding, [ bytes(1 << 30) ])
+    assert len(data) < 2 << 20
+    decoder = compression.Decoder(encoding)
+    with pytest.raises(HTTPException) as error:
+        for piece in decoder.decompress(data):
+            assert len(piece) <= 10 << 20
+    assert error.value.status_code == 413
+    #The byte ending a zstd run-length block of 128 KiB may come last.
+    assert decoder.size <= (10 << 20) + (128 << 10)
+
+def test_decoder_feeds_zstd_in_chunks(monkeypatch):
+    #With the default limit of 1 GiB, even run-length blocks can't expand 32 KiB of input past it.
+    monkeypatch.setattr(settings, 'COMPRESSION_MAX_BODY_SIZE', 1 << 30)
+    data = compress(compression.ZSTD, [ os.urandom(1 << 20) ])
+    steps = []
+    step = compression.Decoder.step
+    monkeypatch.setattr(compression.Decoder, 'step', lambda decoder, data: steps.append(len(data)) or step(decoder, data))
+    assert decode(compression.ZSTD, data, len(data)) == zstandard.ZstdDecompressor().decompress(data)
+    assert len(steps) <= len(data) // (32 << 10) + 1
+
+async def echo(request: Request):
+    body = await request.body()
+    return JSONResponse({'size' : len(body), 'encoding' : request.headers.get('content-encoding'),
+                         'length' : request.headers.get('content-length')})
+
+@pytest.fixture(scope='module')
+def client():
+    app = Starlette(routes=[ Route('/echo', echo, methods=['POST']) ])
+    app.add_middleware(compression.DecompressionMiddleware)
+    return TestClient(app)
+
+@pytest.mark.parametrize('encoding', compression.ENCODINGS)
+def test_middleware_decompresses_the_body(client, encoding):
+    response = client.post('/echo', content=compress(encoding, [ BODY, BODY ]), headers={'Content-Encoding' : encoding})
+    assert response.status_code == 200
+    assert response.json() == {'size' : 2 * len(BODY), 'encoding' : None, 'length' : None}
+
+def test_middleware_refuses_unknown_encodings(client):
+    response = client.post('/echo', content=b'abc', headers={'Content-Encoding' : 'br'})
+    assert response.status_code == 415
+
+@pytest.mark.parametrize('encoding', compression.ENCODINGS)
+def test_middleware_refuses_bombs(client, encoding, monkeypatch):
+    monkeypatch.setattr(settings, 'COMPRESSION_MAX_BODY_SIZE', 1 << 20)
+    response = client.post('/echo', content=compress(encoding, [ bytes(10 << 20) ]), headers={'Content-Encoding' : encoding})
+    assert response.status_code == 413
+
+@pytest.mark.parametrize('accept_encoding, expected', [
+    ('gzip, zstd', compression.ZSTD),
+    ('gzip;q=1.0, zstd;q=0.5', compression.GZIP),
+    ('*', compression.GZIP),
+    ('br, identity', None),
+    ('zstd;q=0, gzip;q=0', None),
+    ])
+def test_choose_encoding(accept_encoding, expected):
+    assert compression.choose_encoding(accept_encoding) == expected
+
+@pytest.mark.parametrize('encoding', compression.ENCODINGS)
+def test_encoder_flushes_decodable_chunks(encoding):
+    encoder = compression.Encoder(encoding)
+    decoder = compression.Decoder(encoding)
+    output = []
+    for start in range(0, len(BODY), 100000):
+        chunk = encoder.compress(BODY[start:start + 100000], final=start + 100000 >= len(BODY))
+        #Every flushed chunk decodes on its own, as streamed responses need.
+        output.extend(decoder.decompress(chunk))
+    decoder.finish()
+    assert b''.join(output) == BODY
+
+@pytest.mark.parametrize('headers', [
+    {'Content-Encoding' : compression.GZIP},
+    {'Accept-Encoding' : compression.ZSTD, 'If-None-Match' : '"abc-zstd"'},
+    ])
+def test_middlewares_keep_the_route_in_the_scope(headers):
+    scopes = []
+
+    #Stands for the metrics, which label the requests by the route the router adds to the scope.
+    def recorder(app):
+        async def record(scope, receive, send):
+            await app(scope, receive, send)
+            scopes.append(scope)
+        return record
+
+    app = FastAPI()
+    app.add_api_route('/echo', echo, methods=['POST'])
+    app.add_middleware(compression.DecompressionMiddleware)
+    app.add_middleware(compression.CompressionMiddleware)
+    app.add_middleware(recorder)
+    content = gzip.compress(b'abc') if 'Content-Encoding' in headers else b'abc'
+    response = TestClient(app).post('/echo', content=content, headers=headers)
+    assert response.status_code == 200
+    assert scopes[0]['route'].path == '/echo'
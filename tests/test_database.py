@@ -0,0 +1,171 @@
+import random
+import time
+import pytest
+from fastapi import Depends, FastAPI, HTTPException
+from fastapi.routing import APIRoute
+from fastapi.testclient import TestClient
+from sqlalchemy import delete
+from sqlalchemy.sql import text
+from app import database, jobs, models
+from app.config import settings
+from app.main import app as main_app
+
+"""
+    Routing of the DB sessions between the primary and the read replicas, with stubbed sessionmakers,
+    and against the replica profile of docker-compose with --db when DB_READ_REPLICAS points at it.
+"""
+
+# Returns a sessionmaker recording the name of its engine every time a session is taken.
+def recording(name, used):
+    class Session:
+        async def __aenter__(self):
+            used.append(name)
+            return self
+
+        async def __aexit__(self, *exc_info):
+            pass
+    return Session
+
+@pytest.fixture
+def used(monkeypatch):
+    used = []
+    monkeypatch.setattr(database, 'SessionLocal', recording('write', used))
+    monkeypatch.setattr(database, 'next_read_session', lambda: recording('read', used))
+    return used
+
+@pytest.fixture
+def client(used):
+    app = FastAPI()
+
+    @app.post('/trips')
+    async def write(fail: bool = False, db=Depends(database.get_db)):
+        if fail:
+            raise HTTPException(status_code=400, detail="Invalid trip")
+        return {}
+
+    @app.get('/trips')
+    async def read(db=Depends(database.get_read_db)):
+        return {}
+
+    app.add_middleware(database.ReadYourWritesMiddleware)
+    return TestClient(app)
+
+def test_reads_without_the_cookie_go_to_the_replicas(client, used):
+    assert client.get('/trips').status_code == 200
+    assert used == [ 'read' ]
+
+def test_reads_after_a_write_go_to_the_primary(client, used):
+    assert client.post('/trips').status_code == 200
+    assert database.PRIMARY_COOKIE in client.cookies
+    assert client.get('/trips').status_code == 200
+    assert used == [ 'write', 'write' ]
+
+def test_failed_writes_dont_pin_to_the_primary(client, used):
+    assert client.post('/trips', params={'fail' : True}).status_code == 400
+    assert database.PRIMARY_COOKIE not in client.cookies
+    client.get('/trips')
+    assert used == [ 'write', 'read' ]
+
+@pytest.mark.parametrize('value', [ lambda: str(time.time() - 1), lambda: 'not a time' ])
+def test_expired_or_invalid_pins_read_from_the_replicas(client, used, value):
+    client.cookies.set(database.PRIMARY_COOKIE, value())
+    client.get('/trips')
+    assert used == [ 'read' ]
+
+# Helper function to list the dependencies of a route, including the ones of its dependencies.
+def dependencies(dependant):
+    for dependency in dependant.dependencies:
+        yield dependency.call
+        yield from dependencies(dependency)
+
+@pytest.mark.parametrize('prefix', [ '/api/jobs', '/api/webhooks', '/api/cache' ])
+def test_jobs_webhooks_and_cache_stay_on_the_primary(prefix):
+    routes = [ route for route in main_app.routes if isinstance(route, APIRoute) and route.path.startswith(prefix) ]
+    assert routes
+    for route in routes:
+        calls = list(dependencies(route.dependant))
+        assert database.get_read_db not in calls
+        if prefix != '/api/cache':
+            assert database.get_db in calls
+
+def test_job_workers_use_the_primary():
+    assert jobs.SessionLocal is database.SessionLocal
+    assert database.SessionLocal.kw['bind'] is database.engine
+
+#Datasource of the trips written by the replica tests, deleted after them.
+REPLICA_TEST_DATASOURCE = 'replica_test'
+
+# Returns a client of the app, running its startup and shutdown, with the trips it wrote deleted afterwards.
+@pytest.fixture(scope='module')
+def replica_client():
+    if not database.read_replicas():
+        pytest.skip("No read replica in DB_READ_REPLICAS: start one with sudo docker-compose --profile replica up -d, "
+                    "on a primary set up by db/replication.sh, and set DB_READ_REPLICAS=127.0.0.1:6501")
+    with TestClient(main_app) as client:
+        yield client
+        client.portal.call(delete_test_trips)
+
+async def delete_test_trips():
+    async with database.SessionLocal() as db:
+        await db.execute(delete(models.Trip).where(models.Trip.datasource == REPLICA_TEST_DATASOURCE))
+        await db.execute(delete(models.TripRollup).where(models.TripRollup.datasource == REPLICA_TEST_DATASOURCE))
+        await db.commit()
+
+# Returns a sessionmaker recording the name of the engine it was taken for, before taking a session from the real one.
+def served_by(name, sessionmaker, served):
+    def session():
+        served.append(name)
+        return sessionmaker()
+    return session
+
+@pytest.fixture
+def served(monkeypatch):
+    served = []
+    next_read_session = database.next_read_session
+    monkeypatch.setattr(database, 'SessionLocal', served_by('primary', database.SessionLocal, served))
+    monkeypatch.setattr(database, 'next_read_session', lambda: served_by('replica', next_read_session(), served))
+    return served
+
+# Posts a new trip, returning it as stored.
+def post_trip(client):
+    trip = {'region' : 'Prague', 'origin_coord' : f"POINT({random.uniform(14, 15)!r} {random.uniform(49, 51)!r})",
+            'destination_coord' : 'POINT(14.43109483523328 50.04052930943246)', 'datetime' : '2018-05-28 09:03:40',
+            'datasource' : REPLICA_TEST_DATASOURCE}
+    response = client.post('/api/trips/add', json=trip)
+    assert response.status_code == 201
+    return response.json()
+
+@pytest.mark.db
+def test_read_engines_are_on_the_replicas(replica_client):
+    async def in_recovery(sessionmaker):
+        async with sessionmaker() as db:
+            return (await db.execute(text("SELECT pg_is_in_recovery()"))).scalar()
+
+    assert replica_client.portal.call(in_recovery, database.SessionLocal) is False
+    for sessionmaker in database.ReadSessions:
+        assert replica_client.portal.call(in_recovery, sessionmaker) is True
+
+@pytest.mark.db
+def test_reads_right_after_a_write_see_it_on_the_primary(replica_client, served):
+    replica_client.cookies.clear()
+    trip = post_trip(replica_client)
+    assert database.PRIMARY_COOKIE in replica_client.cookies
+    response = replica_client.get(f"/api/trips/{trip['id']}")
+    assert response.status_code == 200
+    assert response.json() == trip
+    assert set(served) == { 'primary' }
+
+@pytest.mark.db
+def test_reads_without_the_cookie_go_to_the_replicas(replica_client, served):
+    trip = post_trip(replica_client)
+    replica_client.cookies.clear()
+    served.clear()
+    #The replica has to catch up within the pin of the cookie, which is what read-your-writes relies on.
+    deadline = time.monotonic() + settings.DB_READ_YOUR_WRITES
+    response = replica_client.get(f"/api/trips/{trip['id']}")
+    while response.status_code == 404 and time.monotonic() < deadline:
+        time.sleep(0.1)
+        response = replica_client.get(f"/api/trips/{trip['id']}")
+    assert set(served) == { 'replica' }
+    assert response.status_code == 200
+    assert response.json() == trip
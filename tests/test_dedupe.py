@@ -0,0 +1,94 @@
+import asyncio
+import hashlib
+import importlib.util
+import os
+import re
+import struct
+from datetime import datetime
+import pytest
+from sqlalchemy.sql import text
+from app import dedupe, parsing
+from app.database import SessionLocal, engine
+
+"""
+    Parity of the content hashes computed at ingest with the SQL of the migration hashing the trips
+    already stored. The SQL is emulated with the EWKB PostGIS returns for a point written by hand,
+    and run against the DB in the .env settings with --db.
+"""
+
+MIGRATION = os.path.join(os.path.dirname(__file__), '..', 'alembic', 'versions', '5c2e7a9d40f1_add_trip_content_hashes.py')
+
+TRIPS = [
+    ('Prague', 'POINT (14.4973794438195 50.00136875782316)', 'POINT (14.43109483523328 50.04052930943246)', '2018-05-28 09:03:40', 'funny_car'),
+    ('Turin', 'POINT (7.672837913286881 44.9957109242058)', 'POINT (7.720368637535126 45.06782385393849)', '2018-05-21 02:54:04', 'baba_car'),
+    ('Hamburg', 'POINT (-10.5 -0.1)', 'POINT (0 0)', '2018-12-31 23:59:59', 'cheap_mobile'),
+    ('São Paulo', 'POINT (0.30000000000000004 1e-07)', 'POINT (180 -90)', '2020-02-29 00:00:00', 'pt_search_app'),
+    ]
+
+@pytest.fixture(scope='module')
+def content_hash_sql():
+    spec = importlib.util.spec_from_file_location('add_trip_content_hashes', MIGRATION)
+    migration = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(migration)
+    return migration.CONTENT_HASH_SQL
+
+@pytest.fixture(scope='module')
+def parsed():
+    return parsing.parse_trips(*[ list(column) for column in zip(*TRIPS) ])
+
+# Helper function to compute the hash the SQL of the migration gives a trip.
+def sql_hash(sql, region, origin, destination, dt, datasource):
+    separator = re.search(r"concat_ws\(E'\\x([0-9a-f]{2})'", sql)[1]
+
+    #ST_AsEWKB(point, 'NDR'): little endian, the point type with the SRID flag, the SRID and the coordinates, as upper case hex.
+    def ewkb(point):
+        return struct.pack('<BII2d', 1, 0x20000001, 4326, *point_coords(point)).hex().upper()
+
+    fields = (region, ewkb(origin), ewkb(destination), datetime.fromisoformat(dt).strftime('%Y-%m-%d %H:%M:%S'), datasource)
+    return hashlib.md5(chr(int(separator, 16)).join(fields).encode()).digest()
+
+# Helper function to read the coordinates of a WKT point.
+def point_coords(wkt):
+    return [ float(value) for value in wkt.removeprefix('POINT').strip(' ()').split() ]
+
+def test_migration_hashes_the_fields_in_order(content_hash_sql):
+    assert re.findall(r'\b(region|origin_coord|destination_coord|datetime|datasource)\b', content_hash_sql) == [
+        'region', 'origin_coord', 'destination_coord', 'datetime', 'datasource' ]
+    assert "to_char(datetime, 'YYYY-MM-DD HH24:MI:SS')" in content_hash_sql
+    assert content_hash_sql.count("'NDR'") == 2
+
+def test_content_hashes_match_the_migration(content_hash_sql, parsed):
+    hashes, origins, destinations = dedupe.content_hashes(parsed, list(range(len(TRIPS))))
+    assert hashes == [ sql_hash(content_hash_sql, *trip) for trip in TRIPS ]
+
+def test_content_hashes_skip_the_trips_not_given(parsed):
+    hashes, origins, destinations = dedupe.content_hashes(parsed, [ 1, 3 ])
+    assert hashes[0] is None and hashes[2] is None
+    assert len(origins) == len(destinations) == 2
+
+def test_first_occurrences_keep_the_first_copy():
+    hashes = [ b'a', b'b', b'a', None, b'b', b'c' ]
+    assert dedupe.first_occurrences(hashes, [ 0, 1, 2, 4, 5 ]) == [ 0, 1, 5 ]
+
+@pytest.mark.db
+def test_content_hashes_match_the_migration_in_the_db(content_hash_sql, parsed):
+    hashes = dedupe.content_hashes(parsed, list(range(len(TRIPS))))[0]
+
+    async def hash_in_db():
+        try:
+            async with SessionLocal() as db:
+                stored = []
+                for region, origin, destination, dt, datasource in TRIPS:
+                    stored.append((await db.execute(text(f"""
+                        SELECT {content_hash_sql} FROM (
+                            SELECT CAST(:region AS varchar) AS region, ST_GeomFromText(:origin, 4326) AS origin_coord,
+                                ST_GeomFromText(:destination, 4326) AS destination_coord, CAST(:datetime AS timestamp) AS datetime,
+                                CAST(:datasource AS varchar) AS datasource
+                        ) trips
+                        """), {'region' : region, 'origin' : origin, 'destination' : destination, 'datetime' : dt, 'datasource' : datasource})).scalar())
+                return stored
+        finally:
+            await engine.dispose()
+
+    stored = asyncio.run(hash_in_db())
+    assert [ bytes(value) for value in stored ] == hashes
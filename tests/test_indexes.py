@@ -0,0 +1,64 @@
+import asyncio
+import pytest
+from app import cli, filters
+from app.database import SessionLocal, dispose
+
+"""
+    EXPLAIN checks of the indexes, like python -m app.cli check-indexes. The ones marked as db run
+    against the DB in the .env settings, migrated to the last revision, with --db.
+"""
+
+BBOX = filters.parse_bbox('14,49,15,51')
+
+#GiST indexes on (coordinate, datetime) the similar trips lookup takes the nearest trips from with <->.
+KNN_INDEXES = ('idx_trips_origin_coord_datetime', 'idx_trips_destination_coord_datetime')
+
+@pytest.fixture(scope='module')
+def explained():
+    async def explain():
+        try:
+            async with SessionLocal() as db:
+                return await cli.explain_indexes(db, BBOX)
+        finally:
+            await dispose()
+
+    return asyncio.run(explain())
+
+@pytest.mark.db
+def test_required_indexes_exist(explained):
+    missing, plans = explained
+    assert missing == []
+
+@pytest.mark.db
+@pytest.mark.parametrize('name, index', [
+    ('region and datetime count', 'idx_trips_region_datetime'),
+    ('datasource count', 'idx_trips_datasource'),
+    ('datetime count', 'idx_trips_datetime'),
+    ])
+def test_filters_use_their_btree_index(explained, name, index):
+    missing, plans = explained
+    used, expected = plans[name]
+    assert index in used
+
+@pytest.mark.db
+@pytest.mark.parametrize('name', [ 'weekly average by bounding box', 'bbox listing', 'bbox count' ])
+def test_bbox_queries_use_the_gist_indexes(explained, name):
+    missing, plans = explained
+    used, expected = plans[name]
+    assert set(used) & set(cli.GIST_INDEXES)
+
+@pytest.mark.db
+def test_similar_trips_order_both_points_with_the_knn_indexes(explained):
+    missing, plans = explained
+    used, expected = plans['similar trips']
+    assert set(KNN_INDEXES) <= set(used)
+
+def test_plan_indexes_finds_every_index_scan():
+    plan = [{'Plan' : {'Node Type' : 'Aggregate', 'Plans' : [
+        {'Node Type' : 'Append', 'Plans' : [
+            {'Node Type' : 'Bitmap Heap Scan', 'Plans' : [ {'Node Type' : 'Bitmap Index Scan', 'Index Name' : 'trips_2018_05_datasource_idx'} ]},
+            {'Node Type' : 'Index Only Scan', 'Index Name' : 'trips_2018_06_datasource_idx'},
+            {'Node Type' : 'Seq Scan', 'Relation Name' : 'trips_default'},
+            ]},
+        ]}}]
+    assert list(cli.plan_indexes(plan)) == [ 'trips_2018_05_datasource_idx', 'trips_2018_06_datasource_idx' ]
@@ -0,0 +1,115 @@
+import asyncio
+import time
+from fastapi import FastAPI, HTTPException
+from fastapi.testclient import TestClient
+from app import metrics
+from app.config import settings
+
+"""
+    Prometheus text format of the counters and histograms, and the labels of the requests middleware.
+"""
+
+def test_counter_renders_its_values_by_labels():
+    counter = metrics.Counter('jobs_total', 'Jobs run.', ('status',))
+    counter.inc(('succeeded',))
+    counter.inc(('failed',), 2)
+    counter.inc(('succeeded',))
+    assert counter.render() == [
+        '# HELP jobs_total Jobs run.',
+        '# TYPE jobs_total counter',
+        'jobs_total{status="failed"} 2',
+        'jobs_total{status="succeeded"} 2',
+        ]
+
+def test_histogram_buckets_are_cumulative():
+    histogram = metrics.Histogram('duration_seconds', 'Durations.', ('query',), buckets=(0.1, 1.0))
+    for value in (0.05, 0.1, 0.5, 3.0):
+        histogram.observe(('trips',), value)
+    assert histogram.render() == [
+        '# HELP duration_seconds Durations.',
+        '# TYPE duration_seconds histogram',
+        'duration_seconds_bucket{query="trips",le="0.1"} 2',
+        'duration_seconds_bucket{query="trips",le="1.0"} 3',
+        'duration_seconds_bucket{query="trips",le="+Inf"} 4',
+        'duration_seconds_sum{query="trips"} 3.65',
+        'duration_seconds_count{query="trips"} 4',
+        ]
+
+def test_format_labels_escapes_the_values():
+    assert metrics.format_labels((), ()) == ''
+    assert metrics.format_labels(('route', 'status'), ('/api/"trips"\\\n', 200)) == '{route="/api/\\"trips\\"\\\\\\n",status="200"}'
+
+#Execution context of a statement, as given to the cursor events.
+class Context:
+    def __init__(self, **options):
+        self.execution_options = options
+        self.metrics_start = time.perf_counter()
+
+def test_query_name_falls_back_to_the_sql_command():
+    assert metrics.query_name('SELECT 1', Context(query_name='weekly_average')) == 'weekly_average'
+    assert metrics.query_name('  INSERT INTO trips VALUES (1)', Context()) == 'insert'
+    assert metrics.query_name('', Context()) == 'unknown'
+
+def test_is_read_only_explains_reads():
+    assert metrics.is_read('  select * from trips')
+    assert metrics.is_read('WITH weeks AS (SELECT 1) SELECT * FROM weeks')
+    assert not metrics.is_read('WITH rows AS (SELECT 1) INSERT INTO trips SELECT * FROM rows')
+    assert not metrics.is_read('UPDATE ingest_jobs SET status = 1')
+    assert not metrics.is_read('WITH moved AS (DELETE FROM trips_default RETURNING *) SELECT count(*) FROM moved')
+    assert not metrics.is_read('SELECT * FROM ingest_jobs WHERE status = 1 FOR UPDATE')
+    assert not metrics.is_read('SELECT * FROM ingest_jobs FOR NO KEY UPDATE SKIP LOCKED')
+    assert not metrics.is_read('SELECT * FROM trips FOR SHARE')
+    assert not metrics.is_read('SELECT pg_advisory_xact_lock(42)')
+    assert not metrics.is_read("SELECT nextval('trips_id_seq') FROM generate_series(1, 10)")
+
+def test_slow_queries_are_only_analyzed_when_they_are_registry_reads(monkeypatch):
+    monkeypatch.setattr(settings, 'SLOW_QUERY_MS', 0)
+    monkeypatch.setattr(metrics, 'QUERY_DURATION', metrics.Histogram('duration', '', ('query',)))
+    monkeypatch.setattr(metrics, 'SLOW_QUERIES', metrics.Counter('slow', '', ('query',)))
+    monkeypatch.setattr(metrics, 'explained', {})
+    analyzed = {}
+
+    async def explain(sync_engine, name, statement, parameters, analyze=False):
+        analyzed[name] = analyze
+
+    class Connection:
+        engine = None
+
+    monkeypatch.setattr(metrics, 'explain', explain)
+    statements = [
+        ('SELECT * FROM trip_rollups', Context(query_name='weekly_average_by_region')),
+        ('WITH moved AS (DELETE FROM trips_default RETURNING *) SELECT count(*) FROM moved', Context(query_name='move_trips')),
+        ('SELECT * FROM trips ORDER BY id', Context()),
+        ('UPDATE ingest_jobs SET status = 1', Context()),
+        ('COPY trips FROM STDIN', Context()),
+        ]
+
+    async def execute():
+        for statement, context in statements:
+            metrics.after_cursor_execute(Connection(), None, statement, (), context, False)
+        await asyncio.sleep(0)
+
+    asyncio.run(execute())
+    assert analyzed == {'weekly_average_by_region' : True, 'move_trips' : False, 'select' : False, 'update' : False}
+
+def test_middleware_labels_requests_by_route_template(monkeypatch):
+    monkeypatch.setattr(metrics, 'REQUESTS', metrics.Counter('requests', '', ('method', 'route', 'status')))
+    monkeypatch.setattr(metrics, 'REQUEST_DURATION', metrics.Histogram('duration', '', ('method', 'route')))
+    app = FastAPI()
+
+    @app.get('/trips/{id}')
+    async def get_trip(id: int):
+        if id == 0:
+            raise HTTPException(status_code=404, detail="No trip")
+        return {}
+
+    app.add_middleware(metrics.MetricsMiddleware)
+    client = TestClient(app)
+    for path in ('/trips/1', '/trips/2', '/trips/0', '/missing'):
+        client.get(path)
+    assert metrics.REQUESTS.values == {
+        ('GET', '/trips/{id}', '200') : 2,
+        ('GET', '/trips/{id}', '404') : 1,
+        ('GET', 'unmatched', '404') : 1,
+        }
+    assert metrics.REQUEST_DURATION.values[('GET', '/trips/{id}')][-1] == 3
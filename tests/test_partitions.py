@@ -0,0 +1,52 @@
+from datetime import datetime, timedelta
+import pytest
+from app import partitions
+
+"""
+    Bounds of the monthly partitions of the trips, which hold whole weeks.
+"""
+
+MONTHS = [ partitions.add_months(datetime(2017, 1, 1), offset) for offset in range(120) ]
+
+@pytest.mark.parametrize('value, monday', [
+    (datetime(2018, 5, 28, 9, 3, 40), datetime(2018, 5, 28)),
+    (datetime(2018, 6, 3, 23, 59, 59), datetime(2018, 5, 28)),
+    (datetime(2019, 1, 1), datetime(2018, 12, 31)),
+    (datetime(2020, 3, 1), datetime(2020, 2, 24)),
+    ])
+def test_week_start_is_the_monday_of_the_week(value, monday):
+    assert partitions.week_start(value) == monday
+
+@pytest.mark.parametrize('month, months, expected', [
+    (datetime(2018, 11, 1), 1, datetime(2018, 12, 1)),
+    (datetime(2018, 12, 1), 1, datetime(2019, 1, 1)),
+    (datetime(2018, 1, 1), -1, datetime(2017, 12, 1)),
+    (datetime(2018, 5, 1), -17, datetime(2016, 12, 1)),
+    (datetime(2018, 5, 1), 0, datetime(2018, 5, 1)),
+    ])
+def test_add_months(month, months, expected):
+    assert partitions.add_months(month, months) == expected
+
+def test_partitions_are_week_aligned_and_contiguous():
+    for month, following in zip(MONTHS, MONTHS[1:]):
+        start, end = partitions.partition_bounds(month)
+        assert start.weekday() == 0 and end.weekday() == 0
+        assert timedelta(0) <= month - start < timedelta(days=7)
+        assert end == partitions.partition_bounds(following)[0]
+        assert timedelta(weeks=4) <= end - start <= timedelta(weeks=5)
+
+def test_every_datetime_falls_in_the_partition_of_its_month():
+    value = datetime(2017, 1, 1, 12)
+    while value < datetime(2021, 1, 1):
+        start, end = partitions.partition_bounds(partitions.partition_month(value))
+        assert start <= value < end
+        #The whole week of the datetime, as date_trunc('week') buckets it, is in the same partition.
+        assert start <= partitions.week_start(value) and partitions.week_start(value) + timedelta(days=7) <= end
+        value += timedelta(hours=13)
+
+def test_partition_names_round_trip():
+    for month in MONTHS:
+        assert partitions.name_month(partitions.partition_name(month)) == month
+    assert partitions.partition_name(datetime(2018, 5, 1)) == 'trips_p2018_05'
+    assert partitions.name_month(partitions.DEFAULT_PARTITION) is None
+    assert partitions.name_month('trips_p2018_05_old') is None
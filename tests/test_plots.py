@@ -0,0 +1,27 @@
+import os
+import subprocess
+import sys
+from app import plots
+
+"""
+    Rendering of the plots, and the API processes starting without matplotlib or pyarrow.
+"""
+
+def test_render_bar_returns_a_png():
+    image = plots.render_bar([ 'Prague', 'Turin' ], [ 2.5, 1.0 ], plots.PNG, 320, 200)
+    assert image.startswith(b'\x89PNG\r\n\x1a\n')
+    #The IHDR chunk holds the width and height in pixels.
+    assert int.from_bytes(image[16:20], 'big') == 320
+    assert int.from_bytes(image[20:24], 'big') == 200
+
+def test_render_bar_returns_an_svg():
+    image = plots.render_bar([ 'Prague' ], [ 2.5 ], plots.SVG, 320, 200)
+    assert b'<svg' in image
+    assert b'width="230.4pt"' in image
+
+def test_api_doesnt_import_matplotlib_or_pyarrow():
+    code = "import sys, app.main; print('matplotlib' in sys.modules, 'pyarrow' in sys.modules)"
+    result = subprocess.run([ sys.executable, '-c', code ], capture_output=True, text=True,
+                            cwd=os.path.join(os.path.dirname(__file__), '..'))
+    assert result.returncode == 0, result.stderr
+    assert result.stdout.strip() == 'False False'
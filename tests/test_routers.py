@@ -0,0 +1,35 @@
+import pytest
+from fastapi.testclient import TestClient
+from app.main import app
+
+"""
+    Endpoint tests that fail before reaching the DB, so no DB is needed to run them.
+"""
+
+@pytest.fixture(scope='module')
+def client():
+    return TestClient(app)
+
+@pytest.mark.parametrize('bottom_left, top_right', [
+    ('POINT(1 2', 'POINT(3 4)'),
+    ('POINT(1 2)', 'LINESTRING(0 0, 1 1)'),
+    ('POINT EMPTY', 'POINT(3 4)'),
+    ('nope', 'nope'),
+    ])
+def test_weekly_average_by_bbox_rejects_invalid_points(client, bottom_left, top_right):
+    response = client.get(f'/api/trips/weekly/{bottom_left}/{top_right}')
+    assert response.status_code == 422
+    assert response.json()['detail'].startswith('Invalid WKT point')
+
+@pytest.mark.parametrize('origin, destination', [
+    ('POINT(14.4 50', 'POINT(14.5 50.1)'),
+    ('POINT(14.4 50)', 'LINESTRING(0 0, 1 1)'),
+    ])
+def test_similar_trips_rejects_invalid_points(client, origin, destination):
+    response = client.get('/api/trips/similar', params={'origin' : origin, 'destination' : destination, 'datetime' : '2018-05-28 09:03:40'})
+    assert response.status_code == 422
+    assert response.json()['detail'].startswith('Invalid WKT point')
+
+@pytest.mark.parametrize('params', [ {'k' : 0}, {'k' : 101}, {'max_distance' : 0}, {'max_minutes' : -1} ])
+def test_similar_trips_bounds_the_parameters(client, params):
+    assert client.get('/api/trips/1/similar', params=params).status_code == 422